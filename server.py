@@ -1,11 +1,49 @@
 import argparse
+import asyncio
+import atexit
+import bisect
+import codecs
+import errno
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
 import json
+import math
+import mmap
 import os
+import queue
 import re
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from pathlib import Path
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, unquote, urlparse
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; only needed for --processes
+    fcntl = None
+
+try:
+    import sqlite3
+except ImportError:  # Python built without sqlite; only needed for --storage sqlite
+    sqlite3 = None
 
 DATA_DIR = Path(__file__).parent / "data"
 DATA_DIR.mkdir(exist_ok=True)
@@ -13,8 +51,93 @@ LOG_DIR = Path(__file__).parent / "log"
 LOG_DIR.mkdir(exist_ok=True)
 DEFAULT_PORT = 8000
 DEFAULT_LOG_RETENTION_HOURS = 24
+DEFAULT_ENGINE = "threading"
+DEFAULT_WORKERS = 32
+DEFAULT_BACKLOG = 128
+DEFAULT_PROCESSES = 1
+ENGINES = ("threading", "pool", "asyncio")
+DEFAULT_STORAGE = "files"
+STORAGES = ("files", "sqlite", "log")
+STORAGE = DEFAULT_STORAGE
+SQLITE_NAME = "notes.sqlite3"
+SQLITE_PATH: Path | None = None
+DEFAULT_CACHE_MB = 256
+DEFAULT_MAX_BODY_MB = 16
+DEFAULT_MAX_UPLOAD_MB = 64
+DEFAULT_DURABILITY = "batch"
+DURABILITY_MODES = ("none", "batch", "always")
+DURABILITY = DEFAULT_DURABILITY
+GROUP_COMMIT_WINDOW_SECONDS = 0.002
+WRITE_BACK = False
+WRITE_BACK_SECONDS = 5.0
+WRITE_BACK_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_LAYOUT = "flat"
+LAYOUTS = ("flat", "sharded")
+LAYOUT = DEFAULT_LAYOUT
+MANIFEST_NAME = ".mini-keep-manifest"
+MANIFEST_SLACK_LINES = 10000
+TEMP_SWEEP_AGE_SECONDS = 60.0
+LOGSTORE_NAME = "segments"
+LOGSTORE_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+LOGSTORE_COMPACT_RATIO = 0.5
+LOGSTORE_COMPACT_SECONDS = 60.0
+LOGSTORE_COMPACT_SLICE_BYTES = 1024 * 1024
+RECORD_HEADER = struct.Struct("<IBHIq")
 PASSWORD = ""
+KEEPALIVE_TIMEOUT_SECONDS = 15.0
+KEEPALIVE_MAX_REQUESTS = 1000
+KEEPALIVE_DRAIN_LIMIT = 64 * 1024
+MAX_BODY_BYTES = DEFAULT_MAX_BODY_MB * 1024 * 1024
+MAX_UPLOAD_BYTES = DEFAULT_MAX_UPLOAD_MB * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 256 * 1024
+LINGER_SECONDS = 5.0
+LINGER_IDLE_SECONDS = 1.0
 LOG_RETENTION_HOURS = DEFAULT_LOG_RETENTION_HOURS
+LOG_NAME_FORMAT = "%Y-%m-%dT%H-%M-%S"
+LOG_SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+LOG_QUEUE_LIMIT = 10000
+LOG_FLUSH_SECONDS = 1.0
+LOG_CLEANUP_SECONDS = 600.0
+CATALOG_RESCAN_SECONDS = 30.0
+CHANGE_LOG_LIMIT = 10000
+WRITE_LOCK_STRIPES = 64
+PATCH_MAX_OPS = 1000
+BATCH_MAX_OPS = 1000
+BATCH_OPS = ("create", "update", "delete", "rename")
+JOURNAL_NAME = ".mini-keep-journal"
+SNAPSHOT_NAME = ".mini-keep-snapshot"
+SNAPSHOT_MAGIC = b"MKSNAP\n\0"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sIQ")
+WARM_UP_BATCH = 256
+SNAPSHOT_SECONDS = 300.0
+JOURNAL_MAX_BYTES = 4 * 1024 * 1024
+JOURNAL_POLL_SECONDS = 1.0
+JOURNAL_READ_BYTES = 65536
+SSE_HEARTBEAT_SECONDS = 15.0
+SSE_RETRY_MS = 3000
+SSE_SEND_TIMEOUT_SECONDS = 5.0
+EVENT_FRAME_CACHE_ENTRIES = 64
+SSE_MAX_PENDING_BYTES = 1024 * 1024
+SSE_FLUSH_SECONDS = 0.05
+EVENTS_TOKEN_SECONDS = 60
+# Signs /events tokens. Made once per server start, before any fork, so every
+# worker accepts the tokens the others hand out.
+EVENTS_TOKEN_KEY = os.urandom(32)
+LIST_MAX_LIMIT = 500
+PREVIEW_CHARS = 280
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+STREAM_CHUNK_BYTES = 64 * 1024
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SNIPPET_CHARS = 160
+MAX_MATCH_OFFSETS = 50
+BM25_K1 = 1.2
+BM25_B = 0.75
+NAME_BOOST = 2.0
+TOKEN_RE = re.compile(r"\w+")
+TEMP_FILE_RE = re.compile(r"\..+\.[0-9a-f]{8}\.tmp")
 
 HTML_PAGE = """<!doctype html>
 <html lang=\"en\">
@@ -164,6 +287,7 @@ HTML_PAGE = """<!doctype html>
       <div class="status" id="status"></div>
     </div>
     <div class="list" id="notes"></div>
+    <div id="pageSentinel"></div>
   </main>
 
   <div class="modal-backdrop" id="modalWrap">
@@ -208,12 +332,23 @@ HTML_PAGE = """<!doctype html>
     const appTitle = document.getElementById('appTitle');
     const reloadBtn = document.getElementById('reloadBtn');
     const newBtn = document.getElementById('newBtn');
+    const pageSentinel = document.getElementById('pageSentinel');
+    const PAGE_SIZE = 60;
 
     let currentMode = 'create';
     let currentNote = null;
     let searchTimer = null;
     let currentLang = (localStorage.getItem('miniKeepLang') || 'en');
     let authToken = localStorage.getItem('miniKeepPassword') || '';
+    let nextCursor = null;
+    let loadingPage = false;
+    let listGeneration = 0;
+    let totalNotes = 0;
+    let syncSeq = null;
+    let eventSource = null;
+    let eventsConnecting = false;
+    let eventsLive = false;
+    const cards = new Map();
 
     const i18n = {
       en: {
@@ -321,7 +456,11 @@ HTML_PAGE = """<!doctype html>
         await promptForPassword();
         return api(path, body, attempt + 1);
       }
-      if (!res.ok) throw new Error(data.error || 'Request failed');
+      if (!res.ok) {
+        const err = new Error(data.error || 'Request failed');
+        err.status = res.status;
+        throw err;
+      }
       return data;
     }
 
@@ -355,36 +494,189 @@ HTML_PAGE = """<!doctype html>
       return str.replace(/[&<>]/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;'}[c]));
     }
 
-    function renderNotes(list) {
-      notesGrid.innerHTML = '';
+    function noteCard(item) {
+      const card = document.createElement('div');
+      card.className = 'card';
+      card.innerHTML = `
+        <div class="meta">${formatTime(item.modified)}</div>
+        <h3>${item.name.replace(/\\.txt$/, '')}</h3>
+        <pre>${escapeHtml(item.preview)}${item.truncated ? '…' : ''}</pre>
+      `;
+      card.addEventListener('click', () => openNote(item.name));
+      return card;
+    }
+
+    function appendNotes(list) {
       list.forEach(item => {
-        const card = document.createElement('div');
-        card.className = 'card';
-        card.innerHTML = `
-          <div class="meta">${formatTime(item.modified)}</div>
-          <h3>${item.name.replace(/\\.txt$/, '')}</h3>
-          <pre>${escapeHtml(item.content)}</pre>
-        `;
-        card.addEventListener('click', () => openModal('edit', item));
+        if (cards.has(item.name)) return;
+        const card = noteCard(item);
+        cards.set(item.name, card);
         notesGrid.appendChild(card);
       });
-      const plural = list.length === 1 ? '' : 's';
-      countEl.textContent = t('count', { n: list.length, p: plural });
+    }
+
+    function removeCard(name) {
+      const card = cards.get(name);
+      if (!card) return;
+      card.remove();
+      cards.delete(name);
+    }
+
+    function applyChange(change) {
+      if (change.old_name) removeCard(change.old_name);
+      removeCard(change.name);
+      if (change.op === 'delete') return;
+      const card = noteCard(change);
+      cards.set(change.name, card);
+      notesGrid.prepend(card);
+    }
+
+    async function connectEvents() {
+      if (eventSource || eventsConnecting || !window.EventSource || syncSeq === null) return;
+      eventsConnecting = true;
+      let token;
+      try {
+        // EventSource cannot send headers; a short-lived token keeps the
+        // password out of the URL.
+        token = (await api('/events_token', {})).token;
+      } catch (err) {
+        return;
+      } finally {
+        eventsConnecting = false;
+      }
+      if (eventSource || syncSeq === null) return;
+      const params = new URLSearchParams({ since: syncSeq, token });
+      const source = new EventSource(`/events?${params}`);
+      eventSource = source;
+      source.onopen = () => { eventsLive = true; };
+      source.onerror = () => {
+        eventsLive = false;
+        // Reconnecting with an expired token is refused; start over.
+        if (source.readyState === EventSource.CLOSED && eventSource === source) {
+          eventSource = null;
+          setTimeout(connectEvents, 3000);
+        }
+      };
+      source.addEventListener('change', (e) => {
+        const change = JSON.parse(e.data);
+        if (syncSeq !== null && change.seq <= syncSeq) return;
+        if (searchBox.value.trim()) {
+          refreshNotes(searchBox.value);
+          return;
+        }
+        applyChange(change);
+        syncSeq = change.seq;
+        totalNotes = change.total;
+        updateCount();
+      });
+      source.addEventListener('reset', () => refreshNotes(searchBox.value));
+    }
+
+    async function syncChanges() {
+      if (eventsLive) return;
+      if (syncSeq === null || searchBox.value.trim()) return refreshNotes(searchBox.value);
+      const data = await api(`/list_files?since=${syncSeq}&fields=preview`);
+      if (data.reset) return refreshNotes(searchBox.value);
+      data.changes.forEach(applyChange);
+      syncSeq = data.seq;
+      totalNotes = data.total;
+      updateCount();
+    }
+
+    function updateCount() {
+      const plural = totalNotes === 1 ? '' : 's';
+      countEl.textContent = t('count', { n: totalNotes, p: plural });
+    }
+
+    function sentinelVisible() {
+      return pageSentinel.getBoundingClientRect().top < window.innerHeight + 600;
+    }
+
+    async function openNote(name) {
+      try {
+        const note = await api(`/get_file?name=${encodeURIComponent(name)}`);
+        openModal('edit', note);
+      } catch (err) {
+        setStatus(err.message, true);
+      }
     }
 
     async function refreshNotes(query = '') {
+      const generation = ++listGeneration;
+      const q = query.trim();
       try {
-        const path = query.trim() ? '/search_files' : '/list_files';
-        const data = await api(path, query.trim() ? { query } : undefined);
-        renderNotes(data.files);
+        const data = q
+          ? await api('/search_files', { query: q, fields: 'preview' })
+          : await api(`/list_files?limit=${PAGE_SIZE}&fields=preview`);
+        if (generation !== listGeneration) return;
+        notesGrid.innerHTML = '';
+        cards.clear();
+        appendNotes(data.files);
+        nextCursor = data.next_cursor || null;
+        syncSeq = q ? null : data.seq;
+        totalNotes = q ? data.files.length : data.total;
+        updateCount();
         setStatus('');
+        connectEvents();
+        if (nextCursor && sentinelVisible()) loadMore();
+      } catch (err) {
+        setStatus(err.message, true);
+      }
+    }
+
+    async function loadMore() {
+      if (!nextCursor || loadingPage) return;
+      const generation = listGeneration;
+      loadingPage = true;
+      try {
+        const data = await api(`/list_files?limit=${PAGE_SIZE}&fields=preview&cursor=${encodeURIComponent(nextCursor)}`);
+        if (generation !== listGeneration) return;
+        appendNotes(data.files);
+        nextCursor = data.next_cursor || null;
+        totalNotes = data.total;
+        updateCount();
       } catch (err) {
         setStatus(err.message, true);
+      } finally {
+        loadingPage = false;
       }
+      if (nextCursor && sentinelVisible()) loadMore();
     }
 
+    new IntersectionObserver((entries) => {
+      if (entries.some(entry => entry.isIntersecting)) loadMore();
+    }, { rootMargin: '600px' }).observe(pageSentinel);
+
     let autosaveTimer = null;
 
+    // One splice covering everything between the common prefix and suffix;
+    // offsets are JavaScript string indices, which is what /patch_file expects.
+    function textPatch(before, after) {
+      const max = Math.min(before.length, after.length);
+      let start = 0;
+      while (start < max && before.charCodeAt(start) === after.charCodeAt(start)) start++;
+      let end = 0;
+      while (end < max - start && before.charCodeAt(before.length - 1 - end) === after.charCodeAt(after.length - 1 - end)) end++;
+      if (start === before.length) return [{ op: 'append', text: after.slice(start) }];
+      return [{ op: 'splice', offset: start, delete: before.length - start - end, insert: after.slice(start, after.length - end) }];
+    }
+
+    async function saveContent(content) {
+      if (currentNote.version) {
+        try {
+          return await api('/patch_file', {
+            name: currentNote.name,
+            base_version: currentNote.version,
+            ops: textPatch(currentNote.content, content),
+          });
+        } catch (err) {
+          if (err.status !== 409) throw err;
+        }
+      }
+      // Changed elsewhere since we loaded it: this editor's text wins, as before.
+      return api('/update_file', { name: currentNote.name, content });
+    }
+
     function scheduleSave() {
       if (autosaveTimer) clearTimeout(autosaveTimer);
       autosaveTimer = setTimeout(autoSave, 400);
@@ -400,25 +692,28 @@ HTML_PAGE = """<!doctype html>
       const nameWithExt = rawName.endsWith('.txt') ? rawName : `${rawName}.txt`;
       try {
         if (currentMode === 'create') {
-          await api('/create_file', { name: rawName, content });
+          const saved = await api('/create_file', { name: rawName, content });
           currentMode = 'edit';
-          currentNote = { name: nameWithExt, content };
+          currentNote = { name: nameWithExt, content, version: saved.version };
           noteName.disabled = false;
           deleteBtn.style.display = 'inline-flex';
           setStatus(t('created'));
         } else if (currentNote) {
           if (nameWithExt !== currentNote.name) {
-            await api('/create_file', { name: rawName, content });
-            await api('/delete_file', { name: currentNote.name });
-            currentNote = { name: nameWithExt, content };
+            const ops = [{ op: 'rename', name: currentNote.name, new_name: rawName }];
+            if (content !== currentNote.content) ops.push({ op: 'update', name: rawName, content });
+            const data = await api('/batch', { ops });
+            const saved = data.results[data.results.length - 1];
+            currentNote = { name: saved.name, content, version: saved.version };
             setStatus(t('updated'));
-          } else {
-            await api('/update_file', { name: currentNote.name, content });
+          } else if (content !== currentNote.content) {
+            const saved = await saveContent(content);
             currentNote.content = content;
+            currentNote.version = saved.version;
             setStatus(t('updated'));
           }
         }
-        await refreshNotes(searchBox.value);
+        await syncChanges();
       } catch (err) {
         setStatus(err.message, true);
       }
@@ -439,7 +734,7 @@ HTML_PAGE = """<!doctype html>
         await api('/delete_file', { name: currentNote.name });
         setStatus(t('deleted'));
         closeModal();
-        await refreshNotes(searchBox.value);
+        await syncChanges();
       } catch (err) {
         setStatus(err.message, true);
       }
@@ -457,7 +752,7 @@ HTML_PAGE = """<!doctype html>
       currentLang = e.target.value || 'en';
       localStorage.setItem('miniKeepLang', currentLang);
       applyTranslations();
-      refreshNotes(searchBox.value);
+      updateCount();
     });
 
     modalWrap.addEventListener('click', (e) => {
@@ -475,6 +770,12 @@ HTML_PAGE = """<!doctype html>
 </html>
 """
 
+# The page never changes at runtime, so it is encoded, compressed and hashed once.
+INDEX_BODY = HTML_PAGE.encode("utf-8")
+INDEX_GZIP = gzip.compress(INDEX_BODY, compresslevel=9, mtime=0)
+INDEX_ETAG = '"' + hashlib.sha256(INDEX_BODY).hexdigest()[:32] + '"'
+INDEX_GZIP_ETAG = INDEX_ETAG[:-1] + '-gzip"'
+
 
 def sanitize_name(name: str) -> str:
     base = os.path.basename(name).strip()
@@ -486,8 +787,161 @@ def sanitize_name(name: str) -> str:
     return safe
 
 
+def parse_int(value, default: int, minimum: int, maximum: int, field: str) -> int:
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"invalid {field}") from exc
+    if number < minimum:
+        raise ValueError(f"invalid {field}")
+    return min(number, maximum)
+
+
+def parse_fields(value) -> str:
+    fields = value or "full"
+    if fields not in ("full", "meta", "preview"):
+        raise ValueError("invalid fields")
+    return fields
+
+
+def encode_cursor(entry: "NoteEntry") -> str:
+    return f"{entry.mtime_ns}:{entry.name}"
+
+
+def decode_cursor(value: str) -> tuple[int, str]:
+    mtime_ns, sep, name = str(value).partition(":")
+    if not sep or not mtime_ns.isdigit():
+        raise ValueError("invalid cursor")
+    return -int(mtime_ns), name
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def make_snippet(content: str, terms: list[str]) -> tuple[str, list[list[int]], list[list[int]]]:
+    if not terms:
+        return content[:SNIPPET_CHARS], [], []
+    pattern = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, terms)) + r")(?!\w)", re.IGNORECASE)
+    matches = []
+    for found in pattern.finditer(content):
+        matches.append([found.start(), found.end()])
+        if len(matches) >= MAX_MATCH_OFFSETS:
+            break
+    start = 0
+    if matches:
+        start = max(0, min(matches[0][0] - SNIPPET_CHARS // 4, len(content) - SNIPPET_CHARS))
+    end = start + SNIPPET_CHARS
+    highlights = [[a - start, b - start] for a, b in matches if a >= start and b <= end]
+    return content[start:end], highlights, matches
+
+
+def apply_text_ops(content: str, ops) -> str:
+    # Offsets and lengths count UTF-16 code units, as JavaScript string indices
+    # do, so the editor can send them without converting.
+    if not isinstance(ops, list) or not ops or len(ops) > PATCH_MAX_OPS:
+        raise ValueError(f"ops must be a list of 1 to {PATCH_MAX_OPS} operations")
+    units = bytearray(content.encode("utf-16-le", "surrogatepass"))
+    for op in ops:
+        kind = op.get("op") if isinstance(op, dict) else None
+        if kind == "append":
+            text = op.get("text")
+            if not isinstance(text, str):
+                raise ValueError("append needs a text string")
+            units += text.encode("utf-16-le", "surrogatepass")
+        elif kind == "splice":
+            length = len(units) // 2
+            offset = op.get("offset")
+            delete = op.get("delete", 0)
+            insert = op.get("insert", "")
+            if type(offset) is not int or not 0 <= offset <= length:
+                raise ValueError("splice offset out of range")
+            if type(delete) is not int or not 0 <= delete <= length - offset:
+                raise ValueError("splice delete out of range")
+            if not isinstance(insert, str):
+                raise ValueError("splice insert must be a string")
+            units[offset * 2:(offset + delete) * 2] = insert.encode("utf-16-le", "surrogatepass")
+        else:
+            raise ValueError("op must be splice or append")
+    try:
+        return units.decode("utf-16-le")
+    except UnicodeDecodeError:
+        raise ValueError("patch leaves a broken surrogate pair") from None
+
+
+def accepts_gzip(header: str | None) -> bool:
+    for part in (header or "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        name, _, value = params.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+# A single `bytes=` range as (start, stop). None means send the whole body:
+# no header, or several or malformed ranges, which a server may ignore.
+# (length, length) means no byte of the body was selected (416).
+def parse_range(header: str | None, length: int) -> tuple[int, int] | None:
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, sep, last = header[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            return (max(0, length - suffix), length) if suffix else (length, length)
+        start = int(first)
+        stop = int(last) + 1 if last else length
+    except ValueError:
+        return None
+    if start < 0 or (last and stop <= start):
+        return None
+    if start >= length:
+        return length, length
+    return start, min(stop, length)
+
+
+# "<expiry>.<hmac>" tokens that let an EventSource, which cannot send the
+# X-Password header, authenticate without putting the password in the URL.
+def events_token() -> str:
+    expires = str(int(time.time()) + EVENTS_TOKEN_SECONDS)
+    mac = hmac.new(EVENTS_TOKEN_KEY, expires.encode("ascii"), "sha256").hexdigest()
+    return f"{expires}.{mac}"
+
+
+def check_events_token(token: str) -> bool:
+    expires, _, mac = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(EVENTS_TOKEN_KEY, expires.encode("ascii"), "sha256").hexdigest()
+    return hmac.compare_digest(mac, expected)
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
 def read_json_body(handler: BaseHTTPRequestHandler) -> dict:
+    handler.body_consumed = True
     length = int(handler.headers.get("Content-Length", 0))
+    if length < 0:
+        raise ValueError("invalid Content-Length")
     if length == 0:
         return {}
     raw = handler.rfile.read(length)
@@ -497,202 +951,4098 @@ def read_json_body(handler: BaseHTTPRequestHandler) -> dict:
         raise ValueError("invalid json") from exc
 
 
-def send_json(handler: BaseHTTPRequestHandler, status: int, payload: dict) -> None:
+def send_json(handler: BaseHTTPRequestHandler, status: int, payload: dict, etag: str | None = None) -> None:
     body = json.dumps(payload).encode("utf-8")
+    gzipped = len(body) >= GZIP_MIN_BYTES and accepts_gzip(handler.headers.get("Accept-Encoding"))
+    if gzipped:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
     handler.send_response(status)
     handler.send_header("Content-Type", "application/json")
+    handler.send_header("Vary", "Accept-Encoding")
+    if gzipped:
+        handler.send_header("Content-Encoding", "gzip")
+    if etag:
+        handler.send_header("ETag", etag)
+        handler.send_header("Cache-Control", "no-cache")
     handler.send_header("Content-Length", str(len(body)))
     handler.end_headers()
     handler.wfile.write(body)
 
 
-def load_config(path: str | None) -> dict:
-    if not path:
+# Read-through cache of note texts and their encoded JSON under a byte budget,
+# least recently used out first. Keys carry the note's mtime and size, so a
+# changed note just misses. Entries are counted at their size in memory, which
+# for a str depends on its widest character. With `compress`, entries pushed
+# out of the hot half of the budget are kept zlib-compressed in the other half
+# until it is spent.
+class ContentCache:
+    def __init__(self, budget: int, compress: bool = False) -> None:
+        self.budget = budget
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._hot: OrderedDict[tuple, str | bytes] = OrderedDict()
+        self._cold: OrderedDict[tuple, tuple[bytes, bool]] = OrderedDict()
+        self._hot_bytes = 0
+        self._cold_bytes = 0
+        self.hits = 0
+        self.compressed_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple, load):
+        with self._lock:
+            value = self._hot.get(key)
+            if value is not None:
+                self._hot.move_to_end(key)
+                self.hits += 1
+                return value
+            packed = self._cold.pop(key, None)
+            if packed is None:
+                self.misses += 1
+            else:
+                self._cold_bytes -= sys.getsizeof(packed[0])
+                self.hits += 1
+                self.compressed_hits += 1
+        if packed is None:
+            value = load()
+        else:
+            data, is_text = packed
+            value = zlib.decompress(data)
+            value = str(value, "utf-8") if is_text else value
+        self.put(key, value)
+        return value
+
+    def peek(self, key: tuple):
+        with self._lock:
+            value = self._hot.get(key)
+            packed = self._cold.get(key)
+        if value is not None or packed is None:
+            return value
+        value = zlib.decompress(packed[0])
+        return str(value, "utf-8") if packed[1] else value
+
+    def put(self, key: tuple, value: str | bytes) -> None:
+        size = sys.getsizeof(value)
+        if size > self.budget:
+            return
+        with self._lock:
+            self._discard(key)
+            self._hot[key] = value
+            self._hot_bytes += size
+            hot_limit = self.budget // 2 if self.compress else self.budget
+            while self._hot_bytes > hot_limit:
+                old_key, old = self._hot.popitem(last=False)
+                self._hot_bytes -= sys.getsizeof(old)
+                if not self.compress:
+                    self.evictions += 1
+                    continue
+                is_text = isinstance(old, str)
+                data = zlib.compress(old.encode("utf-8") if is_text else old, 1)
+                self._cold[old_key] = (data, is_text)
+                self._cold_bytes += sys.getsizeof(data)
+            while self._cold and self._hot_bytes + self._cold_bytes > self.budget:
+                _, (data, _) = self._cold.popitem(last=False)
+                self._cold_bytes -= sys.getsizeof(data)
+                self.evictions += 1
+
+    def discard(self, key: tuple) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: tuple) -> None:
+        old = self._hot.pop(key, None)
+        if old is not None:
+            self._hot_bytes -= sys.getsizeof(old)
+        packed = self._cold.pop(key, None)
+        if packed is not None:
+            self._cold_bytes -= sys.getsizeof(packed[0])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_bytes": self.budget,
+                "bytes": self._hot_bytes + self._cold_bytes,
+                "entries": len(self._hot) + len(self._cold),
+                "compressed_entries": len(self._cold),
+                "hits": self.hits,
+                "compressed_hits": self.compressed_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+CONTENT_CACHE = ContentCache(DEFAULT_CACHE_MB * 1024 * 1024)
+
+
+class NoteEntry:
+    __slots__ = ("name", "size", "mtime_ns", "key", "fragments", "_source", "_version")
+
+    def __init__(self, name: str, size: int, mtime_ns: int, content: str | None,
+                 source: "NoteStore") -> None:
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.key = (name, mtime_ns, size)
+        # The text lives in CONTENT_CACHE; on a miss it is read back from the
+        # store.
+        self._source = source
+        if content is not None:
+            CONTENT_CACHE.put(self.key, content)
+        # Encoded JSON per `fields` mode, except "full", which holds the whole
+        # text and goes to CONTENT_CACHE. A write replaces the entry, so this is
+        # effectively keyed by (name, mtime).
+        self.fragments: dict[str, bytes] = {}
+        self._version: str | None = None
+
+    @property
+    def content(self) -> str:
+        try:
+            return self.text()
+        except (OSError, UnicodeDecodeError):
+            # Gone or rewritten since it was cataloged; the next rescan catches
+            # up. Nothing was cached, so a later read tries again.
+            return ""
+
+    # Like `content`, but raises when the note cannot be read, for callers
+    # that must not keep anything derived from a failed read.
+    def text(self) -> str:
+        return CONTENT_CACHE.get(self.key, self.load)
+
+    # For sweeps over many notes: a cached text is used, but one that has to be
+    # read is not cached, so the sweep does not push out the working set.
+    def peek_content(self) -> str:
+        content = CONTENT_CACHE.peek(self.key)
+        if content is not None:
+            return content
+        try:
+            return self.load()
+        except (OSError, UnicodeDecodeError):
+            return ""
+
+    def load(self) -> str:
+        return self._source.read(self.name)
+
+    @property
+    def modified(self) -> int:
+        return self.mtime_ns // 1_000_000_000
+
+    @property
+    def version(self) -> str:
+        # A content hash rather than the mtime: filesystem timestamps can be
+        # too coarse to tell two quick saves apart.
+        if self._version is None:
+            try:
+                content = self.text()
+            except (OSError, UnicodeDecodeError):
+                return hashlib.blake2b(b"", digest_size=8).hexdigest()
+            self._version = hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+        return self._version
+
+    def to_dict(self, fields: str = "full") -> dict:
+        if fields == "full":
+            return {"name": self.name, "content": self.content, "modified": self.modified}
+        item = {"name": self.name, "modified": self.modified, "size": self.size}
+        if fields == "preview":
+            item["preview"] = self.content[:PREVIEW_CHARS]
+            item["truncated"] = len(self.content) > PREVIEW_CHARS
+        return item
+
+    def fragment(self, fields: str = "full") -> bytes:
+        try:
+            if fields == "full":
+                return CONTENT_CACHE.get((*self.key, fields), lambda: self._encode(fields))
+            encoded = self.fragments.get(fields)
+            if encoded is None:
+                encoded = self._encode(fields)
+                self.fragments[fields] = encoded
+            return encoded
+        except (OSError, UnicodeDecodeError):
+            # Answered with an empty text, but not kept.
+            return json.dumps(self.to_dict(fields)).encode("utf-8")
+
+    def _encode(self, fields: str) -> bytes:
+        if fields in ("full", "preview"):
+            self.text()
+        return json.dumps(self.to_dict(fields)).encode("utf-8")
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# Posting lists from each lowercased trigram to the notes containing it. A query
+# only has to verify the notes present in every posting list of its trigrams.
+class TrigramIndex:
+    def __init__(self) -> None:
+        self._postings: dict[str, set[str]] = {}
+        self._docs: dict[str, frozenset[str]] = {}
+        # Notes restored from a snapshot keep their trigrams as positions in
+        # `_gram_names` until they are removed; arrays load faster than sets.
+        self._restored: dict[str, array] = {}
+        self._gram_names: list[str] = []
+
+    def add(self, name: str, text: str) -> None:
+        self.add_grams(name, frozenset(trigrams(text)))
+
+    def add_grams(self, name: str, grams: frozenset[str]) -> None:
+        self.remove(name)
+        self._docs[name] = grams
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(name)
+
+    def remove(self, name: str) -> None:
+        grams = self._docs.pop(name, None)
+        if grams is None:
+            grams = map(self._gram_names.__getitem__, self._restored.pop(name, ()))
+        for gram in grams:
+            names = self._postings.get(gram)
+            if names is None:
+                continue
+            names.discard(name)
+            if not names:
+                del self._postings[gram]
+
+    # Snapshots keep each note's trigrams, in `names` order, as positions in a
+    # shared gram list, and each gram's posting list as positions in `names`.
+    # Both directions are stored so loading needs no per-gram Python loop.
+    def dump(self, names: list[str]) -> tuple[list[str], array, array, array, array]:
+        ids: dict[str, int] = {}
+        counts, flat = array("I"), array("I")
+        for name in names:
+            grams = self._docs.get(name)
+            if grams is None:
+                grams = list(map(self._gram_names.__getitem__, self._restored.get(name, ())))
+            counts.append(len(grams))
+            flat.extend(ids.setdefault(gram, len(ids)) for gram in grams)
+        positions = {name: i for i, name in enumerate(names)}
+        sizes, postings = array("I"), array("I")
+        for gram in ids:
+            docs = self._postings[gram]
+            sizes.append(len(docs))
+            postings.extend(map(positions.__getitem__, docs))
+        return list(ids), counts, flat, sizes, postings
+
+    def load(self, names: list[str], state: tuple) -> None:
+        grams, counts, flat, sizes, postings = state
+        if len(counts) != len(names) or len(sizes) != len(grams) or sum(counts) != len(flat):
+            raise ValueError("trigram counts do not match the notes")
+        if flat and max(flat) >= len(grams):
+            raise ValueError("trigram id out of range")
+        self.__init__()
+        self._gram_names = grams
+        pos = 0
+        for name, count in zip(names, counts):
+            self._restored[name] = flat[pos:pos + count]
+            pos += count
+        pos = 0
+        for gram, size in zip(grams, sizes):
+            self._postings[gram] = set(map(names.__getitem__, postings[pos:pos + size]))
+            pos += size
+
+    def candidates(self, query: str) -> set[str] | None:
+        if len(query) < 3:
+            return None
+        lists = sorted((self._postings.get(g, ()) for g in trigrams(query)), key=len)
+        result = set(lists[0])
+        for names in lists[1:]:
+            if not result:
+                break
+            result &= names
+        return result
+
+
+# Term frequencies per note for BM25 ranking; name terms are kept apart so a
+# match in the title can be boosted.
+class TermIndex:
+    def __init__(self) -> None:
+        self._postings: dict[str, dict[str, int]] = {}
+        self._lengths: dict[str, int] = {}
+        self._name_terms: dict[str, frozenset[str]] = {}
+        self._doc_terms: dict[str, tuple[str, ...]] = {}
+        self._total_length = 0
+
+    def add(self, name: str, content: str) -> None:
+        self.add_counts(name, *self.count(name, content))
+
+    @staticmethod
+    def count(name: str, content: str) -> tuple[Counter, list[str]]:
+        name_terms = tokenize(name.removesuffix(".txt"))
+        counts = Counter(name_terms)
+        counts.update(tokenize(content))
+        return counts, name_terms
+
+    def add_counts(self, name: str, counts: Counter, name_terms: list[str]) -> None:
+        self.remove(name)
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[name] = tf
+        length = sum(counts.values())
+        self._lengths[name] = length
+        self._name_terms[name] = frozenset(name_terms)
+        self._doc_terms[name] = tuple(counts)
+        self._total_length += length
+
+    def remove(self, name: str) -> None:
+        length = self._lengths.pop(name, None)
+        if length is None:
+            return
+        self._total_length -= length
+        self._name_terms.pop(name, None)
+        for term in self._doc_terms.pop(name, ()):
+            docs = self._postings[term]
+            del docs[name]
+            if not docs:
+                del self._postings[term]
+
+    # Snapshots keep, in `names` order, each note's length, terms and name
+    # terms as positions in a shared term list, and each term's posting list
+    # as positions in `names` with the frequencies alongside, like
+    # TrigramIndex.dump().
+    def dump(self, names: list[str]) -> tuple:
+        ids: dict[str, int] = {}
+        lengths, counts, flat, name_counts, name_flat = (array("I") for _ in range(5))
+        for name in names:
+            lengths.append(self._lengths.get(name, 0))
+            terms = self._doc_terms.get(name, ())
+            counts.append(len(terms))
+            flat.extend(ids.setdefault(term, len(ids)) for term in terms)
+            name_terms = self._name_terms.get(name, ())
+            name_counts.append(len(name_terms))
+            name_flat.extend(ids.setdefault(term, len(ids)) for term in name_terms)
+        positions = {name: i for i, name in enumerate(names)}
+        sizes, postings, tfs = array("I"), array("I"), array("I")
+        for term in ids:
+            docs = self._postings.get(term, {})
+            sizes.append(len(docs))
+            postings.extend(map(positions.__getitem__, docs))
+            tfs.extend(docs.values())
+        return list(ids), lengths, counts, flat, name_counts, name_flat, sizes, postings, tfs
+
+    def load(self, names: list[str], state: tuple) -> None:
+        terms, lengths, counts, flat, name_counts, name_flat, sizes, postings, tfs = state
+        if not len(lengths) == len(counts) == len(name_counts) == len(names) or len(sizes) != len(terms):
+            raise ValueError("term counts do not match the notes")
+        self.__init__()
+        pos = name_pos = 0
+        for name, length, count, name_count in zip(names, lengths, counts, name_counts):
+            self._lengths[name] = length
+            self._doc_terms[name] = tuple(map(terms.__getitem__, flat[pos:pos + count]))
+            self._name_terms[name] = frozenset(map(terms.__getitem__, name_flat[name_pos:name_pos + name_count]))
+            pos += count
+            name_pos += name_count
+        self._total_length = sum(lengths)
+        pos = 0
+        for term, size in zip(terms, sizes):
+            if size:
+                self._postings[term] = dict(zip(map(names.__getitem__, postings[pos:pos + size]), tfs[pos:pos + size]))
+            pos += size
+
+    def rank(self, terms: list[str], k: int) -> tuple[int, list[tuple[float, str]]]:
+        count = len(self._lengths)
+        if not count or not terms:
+            return 0, []
+        avg_length = self._total_length / count or 1.0
+        scores: dict[str, float] = {}
+        for term in set(terms):
+            docs = self._postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            for name, tf in docs.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[name] / avg_length)
+                score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                if term in self._name_terms[name]:
+                    score += NAME_BOOST * idf
+                scores[name] = scores.get(name, 0.0) + score
+        top = heapq.nlargest(k, ((score, name) for name, score in scores.items()), key=lambda item: item[0])
+        return len(scores), top
+
+
+# Shared change feed for pre-forked workers. Every write appends a JSON line
+# `[seq, op, name, old_name, origin]` under an flock on a separate lock file, so
+# sequence numbers are global; other workers replay new lines on their next
+# poll. The journal is swapped for a fresh file once it outgrows
+# JOURNAL_MAX_BYTES; readers finish the old file before following the new one.
+class ChangeJournal:
+    def __init__(self, root: Path) -> None:
+        self.path = root / JOURNAL_NAME
+        self.last_seq = 0
+        self._origin = os.urandom(6).hex()
+        self._lock = threading.Lock()
+        self._lock_fd = os.open(root / (JOURNAL_NAME + ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        self._fd = -1
+        self._ino = 0
+        # End of the last complete line, and the length of what follows it.
+        self._offset = 0
+        self._tail = 0
+        self._open()
+        self._read()
+
+    @classmethod
+    def reset(cls, root: Path, base_seq: int) -> None:
+        tmp = root / (JOURNAL_NAME + ".tmp")
+        tmp.write_bytes(json.dumps({"base": base_seq}).encode("utf-8") + b"\n")
+        os.replace(tmp, root / JOURNAL_NAME)
+
+    def _open(self) -> None:
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        if self._fd >= 0:
+            os.close(self._fd)
+        self._fd = fd
+        self._ino = os.fstat(fd).st_ino
+        self._offset = 0
+        self._tail = 0
+
+    def _read(self) -> list[tuple]:
+        records = []
+        while True:
+            chunk = os.pread(self._fd, JOURNAL_READ_BYTES, self._offset)
+            end = chunk.rfind(b"\n") + 1
+            if not end and len(chunk) == JOURNAL_READ_BYTES:
+                # No record is this long; skip the garbage.
+                end = len(chunk)
+            if not end:
+                # A record still being written, or one torn by a crash.
+                self._tail = len(chunk)
+                return records
+            self._offset += end
+            for line in chunk[:end].splitlines():
+                try:
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        self.last_seq = max(self.last_seq, int(record["base"]))
+                        continue
+                    seq, op, name, old_name, origin = record
+                    seq = int(seq)
+                except (ValueError, TypeError, KeyError):
+                    continue
+                self.last_seq = seq
+                if origin != self._origin:
+                    records.append((seq, op, name, old_name))
+
+    def _poll(self) -> list[tuple]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return []
+        if st.st_ino == self._ino and st.st_size == self._offset:
+            return []
+        records = self._read()
+        if st.st_ino != self._ino:
+            self._open()
+            records += self._read()
+        return records
+
+    def poll(self) -> list[tuple]:
+        with self._lock:
+            return self._poll()
+
+    def append(self, op: str, name: str, old_name: str | None) -> tuple[int, list[tuple]]:
+        # Returns the new record's sequence and the other workers' records
+        # that precede it.
+        with self._lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                records = self._poll()
+                if self._offset >= JOURNAL_MAX_BYTES:
+                    self.reset(self.path.parent, self.last_seq)
+                    self._open()
+                    self._read()
+                seq = self.last_seq + 1
+                line = json.dumps([seq, op, name, old_name, self._origin]).encode("utf-8") + b"\n"
+                if self._tail:
+                    # Whoever wrote it is gone, as appends hold the flock;
+                    # end it so it is skipped as a line of its own.
+                    line = b"\n" + line
+                os.write(self._fd, line)
+                self._offset += self._tail + len(line)
+                self._tail = 0
+                self.last_seq = seq
+                return seq, records
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+
+def normalize_newlines(content: str) -> str:
+    return content.replace("\r\n", "\n").replace("\r", "\n")
+
+
+# Storage backends under the catalog. A store keeps whole notes by name and
+# hands out a cheap `version()` token that changes whenever anything was
+# written, so the catalog knows when to rescan. `search()` returns candidate
+# names for a lowercased substring query, or None when the store has no index
+# and the catalog should use its own.
+class NoteStore(ABC):
+    native_search = False
+
+    @abstractmethod
+    def version(self) -> int:
+        ...
+
+    @abstractmethod
+    def scan(self):
+        # Yields (name, size, mtime_ns) for every note.
+        ...
+
+    @abstractmethod
+    def stat(self, name: str) -> tuple[int, int] | None:
+        ...
+
+    @abstractmethod
+    def read(self, name: str) -> str:
+        ...
+
+    # A note's stored bytes as (file, offset, length, mtime_ns) so they can be
+    # sent straight from the file, or None when the store has no such file.
+    def open_raw(self, name: str):
+        return None
+
+    def exists(self, name: str) -> bool:
+        return self.stat(name) is not None
+
+    @abstractmethod
+    def write(self, name: str, content: str) -> None:
+        ...
+
+    # Writes a note from an iterable of byte chunks in two steps, so the slow
+    # part runs without locks: stage_stream() takes in the chunks, and the
+    # commit of what it returns puts the note in place. Stores that cannot
+    # write a note piecewise gather the body in memory.
+    def stage_stream(self, name: str, chunks) -> "StagedWrite":
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+        content = str(buffer, "utf-8")
+        del buffer
+        return StagedWrite(lambda: self.write(name, content))
+
+    def write_stream(self, name: str, chunks) -> None:
+        with self.stage_stream(name, chunks) as staged:
+            staged.commit()
+
+    @abstractmethod
+    def delete(self, name: str) -> None:
+        ...
+
+    @abstractmethod
+    def import_note(self, name: str, content: str, mtime_ns: int) -> None:
+        ...
+
+    def rename(self, name: str, new_name: str) -> None:
+        # Stores that cannot rename in place copy, then delete.
+        content = self.read(name)
+        self.import_note(new_name, content, self.stat(name)[1])
+        self.delete(name)
+
+    @contextmanager
+    def batch(self):
+        # Groups the writes made inside it for stores that can commit them
+        # together; the rest write through as usual.
+        yield
+
+    def search(self, query: str) -> set[str] | None:
+        return None
+
+    def stats(self) -> dict:
         return {}
-    cfg_path = Path(path)
-    if not cfg_path.is_file():
-        raise FileNotFoundError(f"config file not found: {cfg_path}")
-    with cfg_path.open("r", encoding="utf-8") as fh:
-        data = json.load(fh)
-    if not isinstance(data, dict):
-        raise ValueError("config file must contain a JSON object")
-    return data
 
 
-class Handler(BaseHTTPRequestHandler):
-  def _is_authorized(self) -> bool:
-    if not PASSWORD:
-      return True
-    provided = self.headers.get("X-Password", "")
-    return provided == PASSWORD
+# A note written but not yet in place. Leaving the `with` block without
+# commit() discards it; commit() takes over the cleanup even if it fails.
+class StagedWrite:
+    def __init__(self, commit, discard=None) -> None:
+        self._commit = commit
+        self._discard = discard
+        self.committed = False
 
-  def _require_auth(self) -> bool:
-    if self._is_authorized():
-      return True
-    send_json(self, 401, {"error": "unauthorized"})
-    return False
+    def commit(self) -> None:
+        self.committed = True
+        self._commit()
 
-  def log_message(self, format: str, *args) -> None:
-    try:
-      LOG_DIR.mkdir(exist_ok=True)
-      now = datetime.utcnow()
-      cutoff = now - timedelta(hours=LOG_RETENTION_HOURS)
-      for path in LOG_DIR.glob("*.log"):
-        try:
-          ts = datetime.fromisoformat(path.stem)
-          if ts < cutoff:
-            path.unlink(missing_ok=True)
-        except Exception:
-          continue
+    def __enter__(self) -> "StagedWrite":
+        return self
 
-      fname = now.isoformat(timespec="seconds").replace(":", "-") + ".log"
-      msg = (format % args) if args else format
-      msg = msg[:2000]
-      (LOG_DIR / fname).write_text(msg + "\n", encoding="utf-8")
-    except Exception:
-      return
+    def __exit__(self, *exc) -> None:
+        if not self.committed and self._discard is not None:
+            self.committed = True
+            self._discard()
 
-  def do_GET(self) -> None:  # noqa: N802
-    parsed = urlparse(self.path)
-    if parsed.path == "/":
-      self.serve_index()
-    elif parsed.path == "/list_files":
-      self.list_files()
-    elif parsed.path == "/search_files":
-      self.search_files()
-    else:
-      send_json(self, 404, {"error": "not found"})
 
-  def do_POST(self) -> None:  # noqa: N802
-    parsed = urlparse(self.path)
+def fsync_dir(path: Path) -> None:
+    # Makes renames and unlinks in `path` durable; Windows cannot open a
+    # directory for this and does not need it.
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
     try:
-      if parsed.path == "/create_file":
-        self.create_file()
-      elif parsed.path == "/update_file":
-        self.update_file()
-      elif parsed.path == "/delete_file":
-        self.delete_file()
-      elif parsed.path == "/search_files":
-        self.search_files()
-      else:
-        send_json(self, 404, {"error": "not found"})
-    except ValueError as exc:
-      send_json(self, 400, {"error": str(exc)})
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-  def serve_index(self) -> None:
-    body = HTML_PAGE.encode("utf-8")
-    self.send_response(200)
-    self.send_header("Content-Type", "text/html; charset=utf-8")
-    self.send_header("Content-Length", str(len(body)))
-    self.end_headers()
-    self.wfile.write(body)
 
-  def list_files(self) -> None:
-    if not self._require_auth():
-      return
-    files = []
-    paths = sorted(DATA_DIR.glob("*.txt"), key=lambda p: p.stat().st_mtime, reverse=True)
-    for path in paths:
-      content = path.read_text(encoding="utf-8")
-      files.append({"name": path.name, "content": content, "modified": int(path.stat().st_mtime)})
-    send_json(self, 200, {"files": files})
+# One pending step of a FileStore write: fsync and rename the temp file into
+# place (or, for a delete, nothing but the fsync of its directory).
+class _Commit:
+    __slots__ = ("fd", "tmp", "target", "directory", "done", "error")
 
-  def search_files(self) -> None:
-    if not self._require_auth():
-      return
-    if self.command == "GET":
-      query = urlparse(self.path).query or ""
-      q = query.replace("q=", "")
-    else:
-      payload = read_json_body(self)
-      q = payload.get("query", "")
-    q = str(q).strip().lower()
-    if not q:
-      self.list_files()
-      return
-    files = []
-    paths = sorted(DATA_DIR.glob("*.txt"), key=lambda p: p.stat().st_mtime, reverse=True)
-    for path in paths:
-      content = path.read_text(encoding="utf-8")
-      if q in path.name.lower() or q in content.lower():
-        files.append({"name": path.name, "content": content, "modified": int(path.stat().st_mtime)})
-    send_json(self, 200, {"files": files})
+    def __init__(self, fd: int, tmp: Path | None, target: Path | None, directory: Path) -> None:
+        self.fd = fd
+        self.tmp = tmp
+        self.target = target
+        self.directory = directory
+        self.done = threading.Event()
+        self.error: BaseException | None = None
 
-  def create_file(self) -> None:
-    if not self._require_auth():
-      return
-    payload = read_json_body(self)
-    name = sanitize_name(payload.get("name", ""))
-    content = payload.get("content", "")
-    target = DATA_DIR / name
-    if target.exists():
-      raise ValueError("file already exists")
-    target.write_text(str(content), encoding="utf-8")
-    send_json(self, 201, {"status": "created", "name": name})
 
-  def update_file(self) -> None:
-    if not self._require_auth():
-      return
-    payload = read_json_body(self)
-    name = sanitize_name(payload.get("name", ""))
-    content = payload.get("content", "")
-    target = DATA_DIR / name
-    if not target.exists():
-      raise ValueError("file not found")
-    target.write_text(str(content), encoding="utf-8")
-    send_json(self, 200, {"status": "updated", "name": name})
+def sweep_temp_files(directory: Path) -> int:
+    # Temp files a crash left between write and rename. A recent one may be a
+    # write still in flight in another process, so only stale ones go.
+    cutoff = time.time() - TEMP_SWEEP_AGE_SECONDS
+    removed = 0
+    for path in directory.glob(".*.tmp"):
+        if not TEMP_FILE_RE.fullmatch(path.name):
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    return removed
 
-  def delete_file(self) -> None:
-    if not self._require_auth():
-      return
-    payload = read_json_body(self)
-    name = sanitize_name(payload.get("name", ""))
-    target = DATA_DIR / name
-    if not target.exists():
-      raise ValueError("file not found")
-    target.unlink()
-    send_json(self, 200, {"status": "deleted", "name": name})
 
+# The original layout: one `<name>.txt` per note in a directory, versioned by
+# the directory mtime. Writes go to a dot-prefixed temp file that is renamed
+# over the note, so readers never see a torn note. `durability` decides what is
+# on disk when a write returns: `none` leaves it to the OS, `always` fsyncs the
+# file and the directory on every write, and `batch` hands writes to a committer
+# thread that gathers those arriving within GROUP_COMMIT_WINDOW_SECONDS and
+# settles them with one directory fsync.
+class FileStore(NoteStore):
+    def __init__(self, root: Path, durability: str = DEFAULT_DURABILITY) -> None:
+        self.root = root
+        self.swept_temp_files = sweep_temp_files(root) if root.is_dir() else 0
+        self.durability = durability
+        self.commits = 0
+        self.committed_writes = 0
+        self.max_batch = 0
+        self.fsync_seconds = 0.0
+        self.max_fsync_seconds = 0.0
+        self._pending: list[_Commit] = []
+        self._cond = threading.Condition()
+        self._committer_pid = 0
+        self._local = threading.local()
 
-def main() -> None:
-  parser = argparse.ArgumentParser(description="Minimal notes server")
-  parser.add_argument("--config", "-c", type=str, default=None, help="Path to JSON config file")
-  parser.add_argument("--port", "-p", type=int, default=None, help="Port to bind (default: 8000)")
-  parser.add_argument("--password", "-w", type=str, default=None, help="Password required via X-Password header")
-  parser.add_argument(
-    "--log-retention-hours",
-    type=int,
-    default=None,
-    help=f"Hours to keep rotated logs (default: {DEFAULT_LOG_RETENTION_HOURS})",
-  )
-  args = parser.parse_args()
+    def version(self) -> int:
+        try:
+            return self.root.stat().st_mtime_ns
+        except OSError:
+            return 0
 
-  config = load_config(args.config)
+    def path(self, name: str) -> Path:
+        return self.root / name
 
-  port = config.get("port") if isinstance(config.get("port"), int) else None
-  if args.port is not None:
-    port = args.port
-  if port is None:
-    port = DEFAULT_PORT
+    def scan(self):
+        for path in self.root.glob("*.txt"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            yield path.name, st.st_size, st.st_mtime_ns
 
-  password = config.get("password", "") if isinstance(config, dict) else ""
-  if args.password is not None:
-    password = args.password
+    def stat(self, name: str) -> tuple[int, int] | None:
+        try:
+            st = self.path(name).stat()
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
 
-  log_hours = config.get("log_retention_hours") if isinstance(config, dict) else None
-  if args.log_retention_hours is not None:
-    log_hours = args.log_retention_hours
-  if not isinstance(log_hours, int) or log_hours <= 0:
-    log_hours = DEFAULT_LOG_RETENTION_HOURS
+    def read(self, name: str) -> str:
+        return self.path(name).read_text(encoding="utf-8")
 
-  global PASSWORD, LOG_RETENTION_HOURS
-  PASSWORD = password or ""
-  LOG_RETENTION_HOURS = log_hours
+    def open_raw(self, name: str):
+        f = open(self.path(name), "rb")
+        st = os.fstat(f.fileno())
+        return f, 0, st.st_size, st.st_mtime_ns
 
-  host = "0.0.0.0"
-  with ThreadingHTTPServer((host, port), Handler) as httpd:
-    print(f"Serving on http://{host}:{port}")
-    httpd.serve_forever()
+    def write(self, name: str, content: str) -> None:
+        self.write_stream(name, (content.encode("utf-8"),))
+
+    def stage_stream(self, name: str, chunks) -> StagedWrite:
+        target = self._write_target(name)
+        tmp = target.parent / f".{name}.{os.urandom(4).hex()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view):]
+        except BaseException:
+            os.close(fd)
+            tmp.unlink()
+            raise
+
+        def discard() -> None:
+            os.close(fd)
+            tmp.unlink(missing_ok=True)
+
+        return StagedWrite(lambda: self._install(name, fd, tmp, target), discard)
+
+    def _write_target(self, name: str) -> Path:
+        return self.path(name)
+
+    def _install(self, name: str, fd: int, tmp: Path, target: Path) -> None:
+        try:
+            # The rename keeps the temp file's mtime, so this is the note's stat.
+            st = os.fstat(fd)
+        except BaseException:
+            os.close(fd)
+            tmp.unlink()
+            raise
+        # Tracked before the commit, so the fsync that settles the note also
+        # covers its manifest line; a failed commit writes a correction.
+        try:
+            self._track(name, (st.st_size, st.st_mtime_ns))
+        except BaseException:
+            os.close(fd)
+            tmp.unlink()
+            raise
+        deferred = getattr(self._local, "deferred", None)
+        try:
+            if self.durability == "none":
+                os.close(fd)
+                os.replace(tmp, target)
+            elif deferred is not None:
+                # The file is on disk before it replaces the note; only the
+                # directory fsyncs wait for the end of the batch.
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    os.close(fd)
+                    tmp.unlink(missing_ok=True)
+                    raise
+                os.close(fd)
+                os.replace(tmp, target)
+                deferred.append(_Commit(-1, None, None, target.parent))
+            else:
+                self._commit(_Commit(fd, tmp, target, target.parent))
+        except BaseException:
+            try:
+                st = os.stat(target)
+                self._track(name, (st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                self._track(name, None)
+            raise
+
+    def delete(self, name: str) -> None:
+        path = self.path(name)
+        path.unlink()
+        self._track(name, None)
+        self._settle(path.parent)
+
+    def rename(self, name: str, new_name: str) -> None:
+        source, target = self.path(name), self.path(new_name)
+        os.replace(source, target)
+        st = target.stat()
+        self._track(name, None)
+        self._track(new_name, (st.st_size, st.st_mtime_ns))
+        self._settle(source.parent, target.parent)
+
+    def _track(self, name: str, stat: tuple[int, int] | None) -> None:
+        # Called with a note's new (size, mtime_ns), or None once it is gone.
+        pass
+
+    def _settle(self, *directories: Path) -> None:
+        # Deletes and renames only need their directories fsynced.
+        if self.durability == "none":
+            return
+        deferred = getattr(self._local, "deferred", None)
+        for directory in set(directories):
+            if deferred is not None:
+                deferred.append(_Commit(-1, None, None, directory))
+            else:
+                self._commit(_Commit(-1, None, None, directory))
+
+    @contextmanager
+    def batch(self):
+        # Inside a batch every change is made right away, in order, each file
+        # fsynced before its rename, and the directories involved are fsynced
+        # once on the way out.
+        if self.durability == "none" or getattr(self._local, "deferred", None) is not None:
+            yield
+            return
+        self._local.deferred = []
+        try:
+            yield
+        finally:
+            deferred, self._local.deferred = self._local.deferred, None
+            if deferred:
+                self._sync(deferred)
+            for commit in deferred:
+                if commit.error is not None:
+                    raise commit.error
+
+    def import_note(self, name: str, content: str, mtime_ns: int) -> None:
+        self.write(name, content)
+        os.utime(self.path(name), ns=(mtime_ns, mtime_ns))
+        size, _ = self.stat(name)
+        self._track(name, (size, mtime_ns))
+
+    def stats(self) -> dict:
+        return {
+            "durability": self.durability,
+            "commits": self.commits,
+            "committed_writes": self.committed_writes,
+            "avg_batch": round(self.committed_writes / self.commits, 2) if self.commits else 0,
+            "max_batch": self.max_batch,
+            "avg_fsync_ms": round(self.fsync_seconds / self.commits * 1000, 3) if self.commits else 0,
+            "max_fsync_ms": round(self.max_fsync_seconds * 1000, 3),
+        }
+
+    def _commit(self, commit: _Commit) -> None:
+        if self.durability == "always":
+            self._sync([commit])
+        else:
+            with self._cond:
+                if self._committer_pid != os.getpid():
+                    # Started on first use, and again in a forked worker.
+                    self._committer_pid = os.getpid()
+                    threading.Thread(target=self._commit_loop, name="group-commit", daemon=True).start()
+                self._pending.append(commit)
+                self._cond.notify()
+            commit.done.wait()
+        if commit.error is not None:
+            raise commit.error
+
+    def _commit_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+            # Give writers arriving right behind the first one a chance to join.
+            time.sleep(GROUP_COMMIT_WINDOW_SECONDS)
+            with self._cond:
+                batch, self._pending = self._pending, []
+            self._sync(batch)
+
+    def _sync(self, batch: list[_Commit]) -> None:
+        start = time.perf_counter()
+        for commit in batch:
+            if commit.fd < 0:
+                continue
+            try:
+                os.fsync(commit.fd)
+                os.close(commit.fd)
+                if commit.tmp is not None:
+                    os.replace(commit.tmp, commit.target)
+            except OSError as exc:
+                commit.error = exc
+        try:
+            for directory in {commit.directory for commit in batch}:
+                fsync_dir(directory)
+            self._sync_extra()
+        except OSError as exc:
+            for commit in batch:
+                commit.error = commit.error or exc
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.commits += 1
+            self.committed_writes += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.fsync_seconds += elapsed
+            self.max_fsync_seconds = max(self.max_fsync_seconds, elapsed)
+        for commit in batch:
+            commit.done.set()
+
+    def _sync_extra(self) -> None:
+        pass
+
+
+# FileStore with a hashed fan-out, `data/ab/cd/<name>`, where `abcd` opens the
+# name's blake2b digest, so no directory holds more than a sliver of a large
+# corpus. A manifest, `data/.mini-keep-manifest`, lists every sharded note with
+# its size and mtime as JSON lines appended once each change is in place
+# (`[name, size, mtime_ns]`, or `[name]` once it is gone; the last line wins),
+# so scans and startup never walk the tree. Scans still stat each listed file
+# and append a correction when it was edited behind the server's back. Appends
+# and compactions, which rewrite the manifest once it holds more than twice the
+# live lines plus MANIFEST_SLACK_LINES, take an flock on a separate lock file;
+# lines from other processes, or their compacted manifest, are picked up on the
+# next version check. Notes still in the flat layout are served from there
+# until adopt() moves them into their shard. Deleting the manifest has it
+# rebuilt from a walk on the next start.
+class ShardedFileStore(FileStore):
+    def __init__(self, root: Path, durability: str = DEFAULT_DURABILITY) -> None:
+        super().__init__(root, durability)
+        self.manifest_path = root / MANIFEST_NAME
+        self._manifest_lock = threading.Lock()
+        self._manifest: dict[str, tuple[int, int]] = {}
+        self._manifest_fd = -1
+        self._ino = 0
+        self._lines = 0
+        self._lock_fd = os.open(root / (MANIFEST_NAME + ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        with self._manifest_lock, self._exclusive():
+            if self.manifest_path.exists():
+                self._open_manifest()
+                self._compact_if_due()
+            else:
+                walked = {}
+                for path in root.glob("[0-9a-f][0-9a-f]/[0-9a-f][0-9a-f]/*.txt"):
+                    st = path.stat()
+                    walked[path.name] = (st.st_size, st.st_mtime_ns)
+                self._manifest = walked
+                self._write_manifest()
+        self.flat = {path.name for path in root.glob("*.txt")}
+        # Shard directories are swept on first write rather than walked here.
+        self._swept: set[Path] = set()
+
+    @contextmanager
+    def _exclusive(self):
+        # Serializes appends and compactions across processes.
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # The methods below expect _manifest_lock to be held.
+    def _open_manifest(self) -> None:
+        fd = os.open(self.manifest_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        if self._manifest_fd >= 0:
+            os.close(self._manifest_fd)
+        self._manifest_fd = fd
+        self._ino = os.fstat(fd).st_ino
+        self._manifest = {}
+        self._lines = 0
+        self._offset = 0
+        self._partial = b""
+        self._read_manifest()
+
+    def _write_manifest(self) -> None:
+        tmp = self.root / (MANIFEST_NAME + ".tmp")
+        with open(tmp, "wb") as f:
+            for name, (size, mtime_ns) in self._manifest.items():
+                f.write(json.dumps([name, size, mtime_ns]).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+        self._open_manifest()
+
+    def _compact_if_due(self) -> None:
+        if self._lines > 2 * len(self._manifest) + MANIFEST_SLACK_LINES:
+            self._write_manifest()
+
+    def _read_manifest(self) -> None:
+        while True:
+            chunk = os.pread(self._manifest_fd, 1 << 20, self._offset)
+            if not chunk:
+                break
+            self._offset += len(chunk)
+            lines = (self._partial + chunk).split(b"\n")
+            self._partial = lines.pop()
+            for line in lines:
+                record = json.loads(line)
+                if len(record) == 3:
+                    self._manifest[record[0]] = (record[1], record[2])
+                else:
+                    self._manifest.pop(record[0], None)
+            self._lines += len(lines)
+        try:
+            replaced = os.stat(self.manifest_path).st_ino != self._ino
+        except FileNotFoundError:
+            replaced = False
+        if replaced:
+            # Another process compacted it; the new file holds every note.
+            self._open_manifest()
+
+    def _catch_up(self) -> None:
+        with self._manifest_lock:
+            self._read_manifest()
+
+    def _track(self, name: str, stat: tuple[int, int] | None) -> None:
+        record = [name] if stat is None else [name, *stat]
+        line = json.dumps(record).encode("utf-8") + b"\n"
+        with self._manifest_lock, self._exclusive():
+            # Nobody else appends now, so after catching up the line just
+            # written is the last one and need not be read back.
+            self._read_manifest()
+            os.write(self._manifest_fd, line)
+            self._offset += len(line)
+            self._lines += 1
+            if stat is None:
+                self._manifest.pop(name, None)
+            else:
+                self._manifest[name] = stat
+            self._compact_if_due()
+
+    def _sync_extra(self) -> None:
+        # Under the lock, as a compaction swaps the descriptor.
+        with self._manifest_lock:
+            os.fsync(self._manifest_fd)
+
+    def shard_path(self, name: str) -> Path:
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=2).hexdigest()
+        return self.root / digest[:2] / digest[2:] / name
+
+    def path(self, name: str) -> Path:
+        return self.root / name if name in self.flat else self.shard_path(name)
+
+    def version(self):
+        self._catch_up()
+        return self._offset, super().version()
+
+    def scan(self):
+        self._catch_up()
+        with self._manifest_lock:
+            entries = list(self._manifest.items())
+        for name, recorded in entries:
+            if name in self.flat:
+                continue
+            try:
+                st = self.shard_path(name).stat()
+            except FileNotFoundError:
+                self._track(name, None)
+                continue
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != recorded:
+                self._track(name, (st.st_size, st.st_mtime_ns))
+            yield name, st.st_size, st.st_mtime_ns
+        yield from super().scan()
+
+    def _write_target(self, name: str) -> Path:
+        target = self.shard_path(name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.parent not in self._swept:
+            self.swept_temp_files += sweep_temp_files(target.parent)
+            self._swept.add(target.parent)
+        return target
+
+    def _install(self, name: str, fd: int, tmp: Path, target: Path) -> None:
+        # A write replaces a flat note's content anyway, so the flat copy is
+        # just dropped once the sharded one is in place.
+        super()._install(name, fd, tmp, target)
+        if name in self.flat:
+            self.flat.discard(name)
+            (self.root / name).unlink(missing_ok=True)
+            self._settle(self.root)
+
+    def delete(self, name: str) -> None:
+        super().delete(name)
+        self.flat.discard(name)
+
+    def rename(self, name: str, new_name: str) -> None:
+        self.shard_path(new_name).parent.mkdir(parents=True, exist_ok=True)
+        super().rename(name, new_name)
+        self.flat.discard(name)
+
+    def adopt(self, name: str) -> bool:
+        # Moves a flat note into its shard. It is linked there before it leaves
+        # the flat set, so a concurrent read finds it at one path or the other.
+        if name not in self.flat:
+            return False
+        source, target = self.root / name, self.shard_path(name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            target.unlink(missing_ok=True)
+            os.link(source, target)
+        except FileNotFoundError:
+            self.flat.discard(name)
+            return False
+        st = target.stat()
+        self._track(name, (st.st_size, st.st_mtime_ns))
+        self.flat.discard(name)
+        source.unlink()
+        self._settle(self.root, target.parent)
+        return True
+
+    def stats(self) -> dict:
+        return {**super().stats(), "layout": "sharded", "flat_notes": len(self.flat)}
+
+
+def migrate_layout(store: ShardedFileStore) -> int:
+    # Safe while serving: each move holds the note's write lock.
+    moved = 0
+    for name in sorted(store.flat):
+        with CATALOG.write_locks([name]):
+            moved += store.adopt(name)
+    return moved
+
+
+# Notes as rows of one SQLite database in WAL mode, so readers never wait on a
+# writer. Each thread gets its own connection. Triggers keep a trigram FTS5
+# table in step with the notes and bump a version counter that other processes
+# see as well.
+class SqliteStore(NoteStore):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS notes (
+            name TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        INSERT OR IGNORE INTO meta VALUES ('version', 0);
+        CREATE TRIGGER IF NOT EXISTS notes_version_ai AFTER INSERT ON notes BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'version';
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_version_au AFTER UPDATE ON notes BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'version';
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_version_ad AFTER DELETE ON notes BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'version';
+        END;
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            name, content, content='notes', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, name, content) VALUES (new.rowid, new.name, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content) VALUES ('delete', old.rowid, old.name, old.content);
+            INSERT INTO notes_fts(rowid, name, content) VALUES (new.rowid, new.name, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, name, content) VALUES ('delete', old.rowid, old.name, old.content);
+        END;
+    """
+
+    def __init__(self, path: Path) -> None:
+        if sqlite3 is None:
+            raise RuntimeError("--storage sqlite needs Python's sqlite3 module")
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        try:
+            conn.executescript(self.FTS_SCHEMA)
+            self.native_search = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5 or the trigram tokenizer (< 3.34).
+            self.native_search = False
+
+    def _conn(self):
+        # Connections are per thread and per process: a forked worker must not
+        # reuse the parent's handle.
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def version(self) -> int:
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def scan(self):
+        yield from self._conn().execute("SELECT name, size, mtime_ns FROM notes").fetchall()
+
+    def stat(self, name: str) -> tuple[int, int] | None:
+        return self._conn().execute("SELECT size, mtime_ns FROM notes WHERE name = ?", (name,)).fetchone()
+
+    def read(self, name: str) -> str:
+        row = self._conn().execute("SELECT content FROM notes WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(name)
+        return row[0]
+
+    def write(self, name: str, content: str) -> None:
+        self.import_note(name, normalize_newlines(content), time.time_ns())
+
+    def delete(self, name: str) -> None:
+        if self._conn().execute("DELETE FROM notes WHERE name = ?", (name,)).rowcount == 0:
+            raise FileNotFoundError(name)
+
+    def import_note(self, name: str, content: str, mtime_ns: int) -> None:
+        self._conn().execute(
+            "INSERT INTO notes (name, content, size, mtime_ns) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET content = excluded.content, "
+            "size = excluded.size, mtime_ns = excluded.mtime_ns",
+            (name, content, len(content.encode("utf-8")), mtime_ns),
+        )
+
+    def rename(self, name: str, new_name: str) -> None:
+        if self._conn().execute("UPDATE notes SET name = ? WHERE name = ?", (new_name, name)).rowcount == 0:
+            raise FileNotFoundError(name)
+
+    @contextmanager
+    def batch(self):
+        conn = self._conn()
+        if conn.in_transaction:
+            yield
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        finally:
+            # What was applied stays applied, as it would have without a batch.
+            conn.execute("COMMIT")
+
+    def search(self, query: str) -> set[str] | None:
+        if not self.native_search or len(query) < 3:
+            return None
+        phrase = '"' + query.replace('"', '""') + '"'
+        rows = self._conn().execute(
+            "SELECT notes.name FROM notes_fts JOIN notes ON notes.rowid = notes_fts.rowid "
+            "WHERE notes_fts MATCH ?",
+            (phrase,),
+        )
+        return {row[0] for row in rows}
+
+
+# Notes as records in append-only segment files, `segment-<id>.log`. A record is
+# a RECORD_HEADER (crc32 of the rest, op, name length, value length, mtime_ns),
+# the name and the UTF-8 content; a delete appends a tombstone. An in-memory
+# hash index maps each name to where its latest value lives, so a write is one
+# append and a read one pread. On open every segment is replayed in order and a
+# torn tail left by a crash is cut off. Once the live records in a sealed
+# segment fall below LOGSTORE_COMPACT_RATIO of its size, a background thread
+# copies them to the active segment and removes the file; it reads the records
+# without the store lock and takes it per LOGSTORE_COMPACT_SLICE_BYTES only to
+# append the copies of notes that were not rewritten meanwhile. `durability` works as
+# for FileStore: `always` fsyncs the segment before a write returns, and `batch`
+# first waits GROUP_COMMIT_WINDOW_SECONDS; either way one fsync covers every
+# append made before it, so writers queued behind it return without their own.
+# The index lives in one process, so this store does not support --processes.
+class LogStore(NoteStore):
+    PUT = 1
+    DELETE = 2
+
+    def __init__(self, root: Path, durability: str = DEFAULT_DURABILITY) -> None:
+        self.root = root
+        self.durability = durability
+        root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        # Reads in flight per segment; compaction waits for them before closing it.
+        self._pins: Counter = Counter()
+        self._unpinned = threading.Condition(self._lock)
+        self._local = threading.local()
+        # name -> (segment, value offset, value length, mtime_ns, record length)
+        self._index: dict[str, tuple[int, int, int, int, int]] = {}
+        # name -> (segment, record length) of tombstones older segments may need
+        self._tombstones: dict[str, tuple[int, int]] = {}
+        self._fds: dict[int, int] = {}
+        self._sizes: dict[int, int] = {}
+        self._live: dict[int, int] = {}
+        self._writes = 0
+        self._synced = 0
+        # Segments appended to, and whether one was created, since the last fsync.
+        self._dirty: set[int] = set()
+        self._created = False
+        self.commits = 0
+        self.committed_writes = 0
+        self.max_batch = 0
+        self.fsync_seconds = 0.0
+        self.max_fsync_seconds = 0.0
+        self.truncated_bytes = 0
+        self.compactions = 0
+        segments = sorted(int(p.stem.split("-")[1]) for p in root.glob("segment-*.log"))
+        for seg in segments:
+            self._open_segment(seg)
+            self._replay_segment(seg, last=seg == segments[-1])
+        self._active = segments[-1] if segments else 0
+        if not segments:
+            self._open_segment(0)
+            self._created = True
+        self._stop = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, name="logstore-compactor", daemon=True)
+        self._compactor.start()
+
+    def _path(self, seg: int) -> Path:
+        return self.root / f"segment-{seg:08d}.log"
+
+    def _open_segment(self, seg: int) -> None:
+        self._fds[seg] = os.open(self._path(seg), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        self._sizes[seg] = 0
+        self._live[seg] = 0
+
+    def _replay_segment(self, seg: int, last: bool) -> None:
+        data = self._path(seg).read_bytes()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, op, name_len, value_len, mtime_ns = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + name_len + value_len
+            if end > len(data) or zlib.crc32(data[offset + 4:end]) != crc:
+                break
+            name = data[start:start + name_len].decode("utf-8")
+            self._apply(seg, op, name, start + name_len, value_len, mtime_ns, end - offset)
+            offset = end
+        if offset < len(data):
+            self.truncated_bytes += len(data) - offset
+            if last:
+                # A write cut short by a crash; later appends go after the last good record.
+                os.ftruncate(self._fds[seg], offset)
+        self._sizes[seg] = offset if last else len(data)
+
+    def _apply(self, seg: int, op: int, name: str, value_offset: int, value_len: int, mtime_ns: int,
+               record_len: int) -> None:
+        old = self._index.pop(name, None)
+        if old is not None:
+            self._live[old[0]] -= old[4]
+        tomb = self._tombstones.pop(name, None)
+        if tomb is not None:
+            self._live[tomb[0]] -= tomb[1]
+        if op == self.PUT:
+            self._index[name] = (seg, value_offset, value_len, mtime_ns, record_len)
+        else:
+            self._tombstones[name] = (seg, record_len)
+        self._live[seg] += record_len
+
+    def _append(self, op: int, name: str, value: bytes, mtime_ns: int) -> None:
+        if self._sizes[self._active] >= LOGSTORE_SEGMENT_MAX_BYTES:
+            self._open_segment(self._active + 1)
+            self._active += 1
+            self._created = True
+        name_bytes = name.encode("utf-8")
+        record = bytearray(RECORD_HEADER.size)
+        RECORD_HEADER.pack_into(record, 0, 0, op, len(name_bytes), len(value), mtime_ns)
+        record += name_bytes
+        record += value
+        struct.pack_into("<I", record, 0, zlib.crc32(memoryview(record)[4:]))
+        seg = self._active
+        offset = self._sizes[seg]
+        view = memoryview(record)
+        while view:
+            view = view[os.write(self._fds[seg], view):]
+        self._sizes[seg] += len(record)
+        self._dirty.add(seg)
+        self._apply(seg, op, name, offset + RECORD_HEADER.size + len(name_bytes), len(value), mtime_ns, len(record))
+
+    def version(self) -> int:
+        return self._writes
+
+    def scan(self):
+        with self._lock:
+            return [(name, entry[2], entry[3]) for name, entry in self._index.items()]
+
+    def stat(self, name: str) -> tuple[int, int] | None:
+        entry = self._index.get(name)
+        return (entry[2], entry[3]) if entry else None
+
+    def read(self, name: str) -> str:
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None:
+                raise FileNotFoundError(name)
+            seg, value_offset, value_len = entry[:3]
+            fd = self._fds[seg]
+            self._pins[seg] += 1
+        try:
+            data = os.pread(fd, value_len, value_offset)
+        finally:
+            with self._lock:
+                self._pins[seg] -= 1
+                if not self._pins[seg]:
+                    self._unpinned.notify_all()
+        return data.decode("utf-8")
+
+    def open_raw(self, name: str):
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None:
+                raise FileNotFoundError(name)
+            seg, value_offset, value_len, mtime_ns = entry[:4]
+            # A descriptor of its own: compaction may close and unlink the
+            # segment while the note is still being sent.
+            return open(self._path(seg), "rb"), value_offset, value_len, mtime_ns
+
+    def write(self, name: str, content: str) -> None:
+        self.import_note(name, normalize_newlines(content), time.time_ns())
+
+    def delete(self, name: str) -> None:
+        with self._lock:
+            if name not in self._index:
+                raise FileNotFoundError(name)
+            self._append(self.DELETE, name, b"", 0)
+            self._writes += 1
+            seq = self._writes
+        self._settle(seq)
+
+    def import_note(self, name: str, content: str, mtime_ns: int) -> None:
+        with self._lock:
+            self._append(self.PUT, name, content.encode("utf-8"), mtime_ns)
+            self._writes += 1
+            seq = self._writes
+        self._settle(seq)
+
+    def _settle(self, seq: int) -> None:
+        if self.durability == "none":
+            return
+        deferred = getattr(self._local, "deferred", None)
+        if deferred is not None:
+            self._local.deferred = seq
+            return
+        if self.durability == "batch":
+            # Give writers arriving right behind this one a chance to join.
+            time.sleep(GROUP_COMMIT_WINDOW_SECONDS)
+        self._sync(seq)
+
+    def _sync(self, seq: int) -> None:
+        # Makes every write up to `seq` durable, unless a sync that finished
+        # while this one waited for the lock already did.
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            start = time.perf_counter()
+            with self._lock:
+                upto = self._writes
+                segs, self._dirty = self._dirty, set()
+                created, self._created = self._created, False
+                # Duplicates, so compaction may close a segment meanwhile.
+                fds = [os.dup(self._fds[seg]) for seg in segs]
+            try:
+                for fd in fds:
+                    os.fsync(fd)
+                if created:
+                    fsync_dir(self.root)
+            except OSError:
+                with self._lock:
+                    self._dirty |= {seg for seg in segs if seg in self._fds}
+                    self._created = self._created or created
+                raise
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            elapsed = time.perf_counter() - start
+            self.commits += 1
+            self.committed_writes += upto - self._synced
+            self.max_batch = max(self.max_batch, upto - self._synced)
+            self.fsync_seconds += elapsed
+            self.max_fsync_seconds = max(self.max_fsync_seconds, elapsed)
+            self._synced = upto
+
+    @contextmanager
+    def batch(self):
+        # The writes inside it are settled by one fsync on the way out.
+        if self.durability == "none" or getattr(self._local, "deferred", None) is not None:
+            yield
+            return
+        self._local.deferred = 0
+        try:
+            yield
+        finally:
+            seq, self._local.deferred = self._local.deferred, None
+            if seq:
+                self._sync(seq)
+
+    def stats(self) -> dict:
+        return {
+            "durability": self.durability,
+            "commits": self.commits,
+            "committed_writes": self.committed_writes,
+            "avg_batch": round(self.committed_writes / self.commits, 2) if self.commits else 0,
+            "max_batch": self.max_batch,
+            "avg_fsync_ms": round(self.fsync_seconds / self.commits * 1000, 3) if self.commits else 0,
+            "max_fsync_ms": round(self.max_fsync_seconds * 1000, 3),
+            "segments": len(self._fds),
+            "garbage_ratio": round(self.garbage_ratio(), 3),
+            "compactions": self.compactions,
+            "truncated_bytes": self.truncated_bytes,
+        }
+
+    def garbage_ratio(self) -> float:
+        with self._lock:
+            total = sum(self._sizes.values())
+            return 1 - sum(self._live.values()) / total if total else 0.0
+
+    def compact(self) -> int:
+        # Rewrites sealed segments, oldest first, that are mostly superseded
+        # records; returns how many were removed.
+        with self._compact_lock:
+            with self._lock:
+                victims = [seg for seg in sorted(self._fds)
+                           if seg != self._active and self._live[seg] < self._sizes[seg] * LOGSTORE_COMPACT_RATIO]
+            for seg in victims:
+                self._compact_segment(seg)
+        return len(victims)
+
+    def _compact_segment(self, seg: int) -> None:
+        # Only compaction closes a segment, so its descriptor stays valid here.
+        with self._lock:
+            fd = self._fds[seg]
+            first = self._active
+            live = [(name, entry) for name, entry in self._index.items() if entry[0] == seg]
+            tombs = [(name, tomb) for name, tomb in self._tombstones.items() if tomb[0] == seg]
+            # A tombstone only matters while an older segment may still hold a put.
+            older = any(other < seg for other in self._fds)
+        start = 0
+        while start < len(live):
+            end, size = start, 0
+            while end < len(live) and (end == start or size < LOGSTORE_COMPACT_SLICE_BYTES):
+                size += live[end][1][2]
+                end += 1
+            values = [os.pread(fd, entry[2], entry[1]) for _, entry in live[start:end]]
+            with self._lock:
+                for (name, entry), value in zip(live[start:end], values):
+                    # A note written or deleted meanwhile has moved on.
+                    if self._index.get(name) is entry:
+                        self._append(self.PUT, name, value, entry[3])
+            start = end
+        with self._lock:
+            for name, tomb in tombs:
+                if self._tombstones.get(name) is not tomb:
+                    continue
+                if older:
+                    self._append(self.DELETE, name, b"", 0)
+                else:
+                    del self._tombstones[name]
+            copies = [os.dup(self._fds[target]) for target in range(first, self._active + 1)]
+        # The copies must be on disk before the originals go away.
+        try:
+            for copy in copies:
+                os.fsync(copy)
+        finally:
+            for copy in copies:
+                os.close(copy)
+        with self._lock:
+            self._unpinned.wait_for(lambda: not self._pins[seg])
+            os.close(fd)
+            self._path(seg).unlink()
+            del self._fds[seg], self._sizes[seg], self._live[seg], self._pins[seg]
+            self._dirty.discard(seg)
+            self.compactions += 1
+
+    def _compact_loop(self) -> None:
+        while not self._stop.wait(LOGSTORE_COMPACT_SECONDS):
+            try:
+                self.compact()
+            except OSError:
+                traceback.print_exc()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._compactor.join()
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+
+
+# Opt-in write-back layer over another store. Saves are acknowledged once they
+# are in memory, and repeated saves of a note replace each other until the next
+# flush: every WRITE_BACK_SECONDS, as soon as WRITE_BACK_MAX_BYTES are pending,
+# and on shutdown. Reads, stats and scans see the pending content, so the
+# catalog never goes back to an older version on disk. Deletes go straight
+# through, after any flush in progress.
+class WriteBackStore(NoteStore):
+    def __init__(self, inner: NoteStore) -> None:
+        self.inner = inner
+        self.native_search = inner.native_search
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        # name -> (content, size, mtime_ns)
+        self._pending: dict[str, tuple[str, int, int]] = {}
+        self._pending_bytes = 0
+        self._writes = 0
+        self.buffered_writes = 0
+        self.flushed_writes = 0
+        self.flushes = 0
+        self._flusher_pid = 0
+
+    def version(self):
+        return self.inner.version(), self._writes
+
+    def scan(self):
+        with self._lock:
+            pending = {name: (size, mtime_ns) for name, (_, size, mtime_ns) in self._pending.items()}
+        for name, size, mtime_ns in self.inner.scan():
+            if name not in pending:
+                yield name, size, mtime_ns
+        for name, (size, mtime_ns) in pending.items():
+            yield name, size, mtime_ns
+
+    def stat(self, name: str) -> tuple[int, int] | None:
+        pending = self._pending.get(name)
+        if pending is not None:
+            return pending[1], pending[2]
+        return self.inner.stat(name)
+
+    def read(self, name: str) -> str:
+        pending = self._pending.get(name)
+        if pending is not None:
+            return pending[0]
+        return self.inner.read(name)
+
+    def open_raw(self, name: str):
+        if name in self._pending:
+            return None
+        return self.inner.open_raw(name)
+
+    def write(self, name: str, content: str) -> None:
+        self.import_note(name, normalize_newlines(content), time.time_ns())
+
+    def import_note(self, name: str, content: str, mtime_ns: int) -> None:
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._flush_loop, name="write-back", daemon=True).start()
+            old = self._pending.get(name)
+            if old is not None:
+                self._pending_bytes -= old[1]
+            self._pending[name] = (content, size, mtime_ns)
+            self._pending_bytes += size
+            self._writes += 1
+            self.buffered_writes += 1
+            if self._pending_bytes >= WRITE_BACK_MAX_BYTES:
+                self._wake.set()
+
+    def stage_stream(self, name: str, chunks) -> StagedWrite:
+        # Streamed notes are too big to buffer, so they are staged in the inner
+        # store with no lock held. The commit supersedes any pending save; the
+        # flush lock keeps the flusher from writing that save over it.
+        staged = self.inner.stage_stream(name, chunks)
+
+        def commit() -> None:
+            with self._flush_lock:
+                with self._lock:
+                    pending = self._pending.pop(name, None)
+                    if pending is not None:
+                        self._pending_bytes -= pending[1]
+                        self._writes += 1
+                staged.commit()
+
+        return StagedWrite(commit, staged.__exit__)
+
+    def delete(self, name: str) -> None:
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending.pop(name, None)
+                if pending is not None:
+                    self._pending_bytes -= pending[1]
+                    self._writes += 1
+            if self.inner.stat(name) is not None or pending is None:
+                self.inner.delete(name)
+
+    def rename(self, name: str, new_name: str) -> None:
+        with self._flush_lock:
+            on_disk = self.inner.stat(name) is not None
+            if on_disk:
+                self.inner.rename(name, new_name)
+            with self._lock:
+                pending = self._pending.pop(name, None)
+                if pending is None and not on_disk:
+                    raise FileNotFoundError(name)
+                if pending is not None:
+                    self._pending[new_name] = pending
+                self._writes += 1
+
+    def batch(self):
+        return self.inner.batch()
+
+    def search(self, query: str) -> set[str] | None:
+        names = self.inner.search(query)
+        if names is None:
+            return None
+        # The inner index has not seen pending content yet; the catalog
+        # verifies every candidate against what is buffered.
+        with self._lock:
+            return names | set(self._pending)
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._pending.items())
+            for name, pending in batch:
+                self.inner.import_note(name, pending[0], pending[2])
+                with self._lock:
+                    # A newer save that arrived meanwhile stays pending.
+                    if self._pending.get(name) is pending:
+                        del self._pending[name]
+                        self._pending_bytes -= pending[1]
+            if batch:
+                self.flushes += 1
+                self.flushed_writes += len(batch)
+            return len(batch)
+
+    def stats(self) -> dict:
+        return {
+            **self.inner.stats(),
+            "write_back": {
+                "pending": len(self._pending),
+                "pending_bytes": self._pending_bytes,
+                "buffered_writes": self.buffered_writes,
+                "flushed_writes": self.flushed_writes,
+                "flushes": self.flushes,
+            },
+        }
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._wake.wait(WRITE_BACK_SECONDS)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+_STORES: dict[tuple, NoteStore] = {}
+
+
+def current_store() -> NoteStore:
+    # Keyed on the settings so tests that point DATA_DIR elsewhere get a fresh
+    # store, and the catalog notices the switch.
+    key = (STORAGE, DATA_DIR, SQLITE_PATH, DURABILITY, LAYOUT, WRITE_BACK)
+    store = _STORES.get(key)
+    if store is None:
+        if STORAGE == "sqlite":
+            store = SqliteStore(SQLITE_PATH or DATA_DIR / SQLITE_NAME)
+        elif STORAGE == "log":
+            store = LogStore(DATA_DIR / LOGSTORE_NAME, DURABILITY)
+        elif LAYOUT == "sharded":
+            store = ShardedFileStore(DATA_DIR, DURABILITY)
+        else:
+            store = FileStore(DATA_DIR, DURABILITY)
+        if WRITE_BACK:
+            store = WriteBackStore(store)
+        _STORES[key] = store
+    return store
+
+
+def migrate_notes(source: NoteStore, target: NoteStore) -> int:
+    count = 0
+    for name, _, mtime_ns in list(source.scan()):
+        try:
+            content = source.read(name)
+        except (OSError, UnicodeDecodeError):
+            continue
+        target.import_note(name, content, mtime_ns)
+        count += 1
+    return count
+
+
+def _store_identity(store: NoteStore) -> str:
+    store = getattr(store, "inner", store)
+    return f"{type(store).__name__}:{getattr(store, 'root', None) or getattr(store, 'path', '')}"
+
+
+# In-memory view of the current store kept sorted newest first. The write
+# endpoints update it in place; edits made behind the API's back are caught by a
+# store version check (the directory mtime for FileStore) on each access plus a
+# stat-only rescan every CATALOG_RESCAN_SECONDS.
+class NoteCatalog:
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._store: NoteStore | None = None
+        self._entries: dict[str, NoteEntry] = {}
+        self._order: list[tuple[int, str]] = []
+        self._index = TrigramIndex()
+        self._terms = TermIndex()
+        self._version = 0
+        self._last_scan = 0.0
+        # Sequence numbers start at the boot time in microseconds so they keep
+        # increasing across restarts and a stale client cursor forces a reset.
+        self._seq = time.time_ns() // 1000
+        self._changes: deque[tuple[int, str, str, str | None]] = deque(maxlen=CHANGE_LOG_LIMIT)
+        self._listeners: list = []
+        self._write_locks = [threading.Lock() for _ in range(WRITE_LOCK_STRIPES)]
+        self.journal: ChangeJournal | None = None
+        self.follow = False
+        # Cleared while warm_up() loads the catalog; GET /ready reports it.
+        self.ready = threading.Event()
+        self.ready.set()
+
+    def current_seq(self) -> int:
+        self.refresh()
+        return self._seq
+
+    # A follower never rescans the store: changes made behind the server's
+    # back reach it through the journal, recorded once by the process that
+    # does rescan (the pre-fork parent), instead of once per worker.
+    def attach_journal(self, journal: ChangeJournal, follow: bool = False) -> None:
+        with self._lock:
+            self.follow = follow
+            self.refresh()
+            self.journal = journal
+            self._changes.clear()
+            self._seq = journal.last_seq
+
+    def refresh(self, force: bool = False) -> None:
+        with self._lock:
+            if self._reset_if_moved():
+                force = True
+            if self.journal is not None and self._replay(self.journal.poll()):
+                # Other workers' writes moved the store version as well.
+                self._touch_store()
+            if self.follow and not force:
+                return
+            version = self._store.version()
+            stale = time.monotonic() - self._last_scan >= CATALOG_RESCAN_SECONDS
+            if force or stale or version != self._version:
+                if not force and not self.ready.is_set():
+                    # warm_up() rescans once it has caught up.
+                    return
+                self._rescan()
+                self._version = version
+
+    def _reset_if_moved(self) -> bool:
+        store = current_store()
+        if store is self._store:
+            return False
+        self._store = store
+        self._entries = {}
+        self._order = []
+        self._index = TrigramIndex()
+        self._terms = TermIndex()
+        self._changes.clear()
+        self._seq += 1
+        self._last_scan = 0.0
+        return True
+
+    def _rescan(self) -> None:
+        seen = set()
+        for name, size, mtime_ns in self._store.scan():
+            seen.add(name)
+            current = self._entries.get(name)
+            if current and current.mtime_ns == mtime_ns and current.size == size:
+                continue
+            try:
+                content = self._store.read(name)
+            except (OSError, UnicodeDecodeError):
+                continue
+            self._put(NoteEntry(name, size, mtime_ns, content, self._store))
+            self._record("update" if current else "create", name)
+        for name in [n for n in self._entries if n not in seen]:
+            self._drop(name)
+            self._record("delete", name)
+        self._last_scan = time.monotonic()
+
+    # Splits a note into what the search indexes take, so callers can do the
+    # costly part before taking the lock.
+    @staticmethod
+    def _analyze(store: "NoteStore", name: str, content: str) -> tuple:
+        grams = None
+        if not store.native_search:
+            # The separator keeps trigrams from spanning name and content.
+            grams = frozenset(trigrams(name.lower() + "\0" + content.lower()))
+        return grams, TermIndex.count(name, content)
+
+    def _put(self, entry: NoteEntry, analyzed: tuple | None = None) -> None:
+        self._drop(entry.name)
+        self._entries[entry.name] = entry
+        bisect.insort(self._order, (-entry.mtime_ns, entry.name))
+        grams, counts = analyzed or self._analyze(self._store, entry.name, entry.content)
+        if grams is not None:
+            self._index.add_grams(entry.name, grams)
+        self._terms.add_counts(entry.name, *counts)
+
+    def _drop(self, name: str) -> None:
+        old = self._entries.pop(name, None)
+        if old is None:
+            return
+        CONTENT_CACHE.discard(old.key)
+        CONTENT_CACHE.discard((*old.key, "full"))
+        self._index.remove(name)
+        self._terms.remove(name)
+        key = (-old.mtime_ns, name)
+        idx = bisect.bisect_left(self._order, key)
+        if idx < len(self._order) and self._order[idx] == key:
+            del self._order[idx]
+
+    def _record(self, op: str, name: str, old_name: str | None = None) -> None:
+        if self.journal is None:
+            self._log(self._seq + 1, op, name, old_name)
+            return
+        seq, records = self.journal.append(op, name, old_name)
+        self._replay(records)
+        self._log(seq, op, name, old_name)
+
+    def _replay(self, records: list[tuple]) -> bool:
+        for seq, op, name, old_name in records:
+            if old_name:
+                self._drop(old_name)
+            self._load(name)
+            self._log(seq, op, name, old_name)
+        return bool(records)
+
+    def _load(self, name: str) -> None:
+        st = self._store.stat(name)
+        try:
+            content = self._store.read(name) if st else None
+        except (OSError, UnicodeDecodeError):
+            content = None
+        if content is None:
+            self._drop(name)
+            return
+        self._put(NoteEntry(name, st[0], st[1], content, self._store))
+
+    def _log(self, seq: int, op: str, name: str, old_name: str | None) -> None:
+        self._seq = seq
+        self._changes.append((seq, op, name, old_name))
+        self._changed.notify_all()
+        for listener in self._listeners:
+            listener()
+
+    def _touch_store(self) -> None:
+        self._version = self._store.version()
+
+    # A snapshot is the catalog's metadata and search index state; the note
+    # texts stay in the store. It holds SNAPSHOT_HEADER (magic, format version,
+    # length of the JSON that follows), a JSON document with the store identity,
+    # the (name, size, mtime_ns) rows in catalog order, the index vocabularies
+    # and the lengths of the id arrays, then those arrays as little-endian
+    # uint32. Loading it leaves the rescan to re-read only notes whose size or
+    # mtime no longer match.
+    def warm_up(self, path: Path) -> None:
+        try:
+            self.load_snapshot(path)
+            self._catch_up()
+            self.refresh(force=True)
+        finally:
+            self.ready.set()
+
+    # Reads and indexes the notes the snapshot lacks in batches, holding the
+    # lock only to apply each one, so requests are served meanwhile. Notes a
+    # write replaced in the meantime are left to the rescan that follows.
+    def _catch_up(self) -> None:
+        with self._lock:
+            self._reset_if_moved()
+            store = self._store
+            known = dict(self._entries)
+        batch = []
+        for name, size, mtime_ns in store.scan():
+            current = known.get(name)
+            if current and current.mtime_ns == mtime_ns and current.size == size:
+                continue
+            try:
+                content = store.read(name)
+            except (OSError, UnicodeDecodeError):
+                continue
+            batch.append((NoteEntry(name, size, mtime_ns, content, store), self._analyze(store, name, content)))
+            if len(batch) >= WARM_UP_BATCH:
+                self._apply(store, known, batch)
+                batch = []
+        self._apply(store, known, batch)
+
+    def _apply(self, store: "NoteStore", known: dict, batch: list) -> None:
+        with self._lock:
+            if store is not self._store:
+                return
+            for entry, analyzed in batch:
+                current = self._entries.get(entry.name)
+                if current is not known.get(entry.name):
+                    continue
+                self._put(entry, analyzed)
+                known[entry.name] = entry
+                self._record("update" if current else "create", entry.name)
+
+    def load_snapshot(self, path: Path) -> int:
+        # The file is mapped, so the id arrays are filled straight from the
+        # page cache without reading the whole snapshot into memory first.
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return 0
+        with self._lock:
+            self._reset_if_moved()
+            store = self._store
+        with mapped, memoryview(mapped) as data:
+            try:
+                magic, version, length = SNAPSHOT_HEADER.unpack_from(data)
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    raise ValueError("not a snapshot of this version")
+                pos = SNAPSHOT_HEADER.size
+                doc = json.loads(mapped[pos:pos + length])
+                pos += length
+                if doc["store"] != _store_identity(store):
+                    return 0
+                if (doc["grams"] is None) != store.native_search:
+                    raise ValueError("search index does not match the store")
+                arrays = []
+                for count in doc["arrays"]:
+                    ids = array("I")
+                    ids.frombytes(data[pos:pos + 4 * count])
+                    if len(ids) != count:
+                        raise ValueError("truncated snapshot")
+                    if sys.byteorder == "big":
+                        ids.byteswap()
+                    arrays.append(ids)
+                    pos += 4 * count
+            except (ValueError, TypeError, KeyError, IndexError, struct.error) as exc:
+                print(f"Ignoring snapshot {path}: {exc}", flush=True)
+                return 0
+        try:
+            entries = {
+                name: NoteEntry(name, size, mtime_ns, None, store)
+                for name, size, mtime_ns in doc["entries"]
+            }
+            names = list(entries)
+            index = TrigramIndex()
+            if doc["grams"] is not None:
+                index.load(names, (doc["grams"], *arrays[:4]))
+                arrays = arrays[4:]
+            terms = TermIndex()
+            terms.load(names, (doc["terms"], *arrays))
+        except (ValueError, TypeError, KeyError, IndexError) as exc:
+            print(f"Ignoring snapshot {path}: {exc}", flush=True)
+            return 0
+        with self._lock:
+            if store is not self._store:
+                return 0
+            self._entries = entries
+            self._order = sorted((-entry.mtime_ns, entry.name) for entry in entries.values())
+            self._index = index
+            self._terms = terms
+        return len(entries)
+
+    def save_snapshot(self, path: Path) -> int:
+        # The id arrays are built under the lock; encoding and writing them
+        # happen after releasing it.
+        with self._lock:
+            self.refresh()
+            store = self._store
+            entries = [self._entries[name] for _, name in self._order]
+            names = [entry.name for entry in entries]
+            grams = None if store.native_search else self._index.dump(names)
+            terms = self._terms.dump(names)
+        arrays = [*(grams[1:] if grams else ()), *terms[1:]]
+        header = json.dumps({
+            "store": _store_identity(store),
+            "entries": [(entry.name, entry.size, entry.mtime_ns) for entry in entries],
+            "grams": grams[0] if grams else None,
+            "terms": terms[0],
+            "arrays": [len(ids) for ids in arrays],
+        }).encode("utf-8")
+        tmp = path.with_name(f".{path.name}.{os.urandom(4).hex()}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+                f.write(header)
+                for ids in arrays:
+                    if sys.byteorder == "big":
+                        ids.byteswap()
+                    f.write(ids.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+            raise
+        return len(entries)
+
+    def entries(self) -> list[NoteEntry]:
+        self.refresh()
+        with self._lock:
+            return [self._entries[name] for _, name in self._order]
+
+    def get(self, name: str) -> NoteEntry | None:
+        self.refresh()
+        with self._lock:
+            return self._entries.get(name)
+
+    def page(self, after: tuple[int, str] | None, limit: int) -> tuple[list[NoteEntry], int, int]:
+        self.refresh()
+        with self._lock:
+            start = bisect.bisect_right(self._order, after) if after else 0
+            names = [name for _, name in self._order[start:start + limit]]
+            return [self._entries[name] for name in names], len(self._order), self._seq
+
+    # Held across fork() so a child never starts with the lock taken mid-update.
+    @contextmanager
+    def held(self):
+        with self._lock:
+            yield
+
+    def add_listener(self, callback) -> None:
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback) -> None:
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def wait_for_change(self, seq: int, timeout: float) -> None:
+        with self._lock:
+            self._changed.wait_for(lambda: self._seq > seq, timeout)
+
+    def changes_since(self, since: int) -> tuple[int, int, list[tuple] | None]:
+        # Returns the current sequence, the note count and the latest change per
+        # note after `since`, or None when the log no longer reaches back that far.
+        self.refresh()
+        with self._lock:
+            floor = self._changes[0][0] - 1 if self._changes else self._seq
+            if since < floor or since > self._seq:
+                return self._seq, len(self._order), None
+            latest: dict[str, tuple[int, str, str | None]] = {}
+            for seq, op, name, old_name in reversed(self._changes):
+                if seq <= since:
+                    break
+                latest.setdefault(name, (seq, op, old_name))
+            changes = []
+            for name, (seq, op, old_name) in latest.items():
+                changes.append((seq, op, name, self._entries.get(name), old_name))
+            changes.sort(key=lambda change: change[0])
+            return self._seq, len(self._order), changes
+
+    def search(self, query: str) -> list[NoteEntry]:
+        q = query.lower()
+        self.refresh()
+        with self._lock:
+            if self._store.native_search:
+                names = self._store.search(q)
+            else:
+                names = self._index.candidates(q)
+            if names is None:
+                pool = [self._entries[name] for _, name in self._order]
+            else:
+                # A native index may already hold rows the next refresh picks up.
+                found = (self._entries[n] for n in names if n in self._entries)
+                pool = sorted(found, key=lambda e: (-e.mtime_ns, e.name))
+        if names is None:
+            # Every note is checked, so the sweep stays out of the cache.
+            return [e for e in pool if q in e.name.lower() or q in e.peek_content().lower()]
+        return [e for e in pool if q in e.name.lower() or q in e.content.lower()]
+
+    def rank(self, query: str, limit: int, offset: int) -> tuple[int, list[tuple[NoteEntry, float]]]:
+        self.refresh()
+        with self._lock:
+            total, top = self._terms.rank(tokenize(query), offset + limit)
+            hits = [(self._entries[name], score) for score, name in top[offset:]]
+        return total, hits
+
+    # Serializes the check-then-write of the write endpoints per note. Notes
+    # hash onto WRITE_LOCK_STRIPES locks, taken in index order so callers that
+    # need several notes cannot deadlock; writes to different notes still run
+    # (and group-commit) concurrently.
+    @contextmanager
+    def write_locks(self, names):
+        stripes = sorted({hash(name) % WRITE_LOCK_STRIPES for name in names})
+        for stripe in stripes:
+            self._write_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._write_locks[stripe].release()
+
+    # The write endpoints skip the version check: their own write bumped the
+    # store version, and _touch_store() records the new value.
+    def record_write(self, name: str, content: str) -> NoteEntry:
+        with self._lock:
+            if self._reset_if_moved():
+                self.refresh(force=True)
+            size, mtime_ns = self._store.stat(name)
+            # Match what read_text() would hand back for the bytes just written.
+            content = normalize_newlines(content)
+            op = "update" if name in self._entries else "create"
+            entry = NoteEntry(name, size, mtime_ns, content, self._store)
+            self._put(entry)
+            self._record(op, name)
+            self._touch_store()
+            return entry
+
+    def record_rename(self, name: str, new_name: str) -> NoteEntry | None:
+        with self._lock:
+            if self._reset_if_moved():
+                self.refresh(force=True)
+            self._drop(name)
+            self._load(new_name)
+            self._record("rename", new_name, name)
+            self._touch_store()
+            return self._entries.get(new_name)
+
+    # For notes written without their text in memory: it is read back from
+    # the store and analyzed before taking the lock, which a large upload
+    # would otherwise hold for seconds. Callers hold the note's write lock.
+    def record_upload(self, name: str) -> NoteEntry | None:
+        store = current_store()
+        st = store.stat(name)
+        try:
+            content = store.read(name) if st else None
+        except (OSError, UnicodeDecodeError):
+            content = None
+        analyzed = self._analyze(store, name, content) if content is not None else None
+        with self._lock:
+            if self._reset_if_moved():
+                self.refresh(force=True)
+            op = "update" if name in self._entries else "create"
+            if analyzed is not None and store is self._store:
+                self._put(NoteEntry(name, st[0], st[1], content, store), analyzed)
+            else:
+                self._load(name)
+            self._record(op, name)
+            self._touch_store()
+            return self._entries.get(name)
+
+    def record_delete(self, name: str) -> None:
+        with self._lock:
+            if self._reset_if_moved():
+                self.refresh(force=True)
+            if name in self._entries:
+                self._drop(name)
+                self._record("delete", name)
+            self._touch_store()
+
+
+CATALOG = NoteCatalog()
+
+
+# Encoded event batches by (cursor, catalog seq). Subscribers that have seen
+# the same changes share one frame per change instead of each re-encoding it.
+_EVENT_FRAMES: OrderedDict = OrderedDict()
+_EVENT_FRAMES_LOCK = threading.Lock()
+
+
+def event_batch(seq: int) -> tuple[int, bytes]:
+    # Picks up outside changes first, so a cached frame is never stale.
+    CATALOG.refresh()
+    key = (id(CATALOG), seq, CATALOG.current_seq())
+    with _EVENT_FRAMES_LOCK:
+        frame = _EVENT_FRAMES.get(key)
+        if frame is not None:
+            _EVENT_FRAMES.move_to_end(key)
+            return frame
+    frame = _encode_events(seq)
+    with _EVENT_FRAMES_LOCK:
+        _EVENT_FRAMES[(id(CATALOG), seq, frame[0])] = frame
+        while len(_EVENT_FRAMES) > EVENT_FRAME_CACHE_ENTRIES:
+            _EVENT_FRAMES.popitem(last=False)
+    return frame
+
+
+def _encode_events(seq: int) -> tuple[int, bytes]:
+    current, total, changes = CATALOG.changes_since(seq)
+    if changes is None:
+        events = [f"id: {current}\nevent: reset\ndata: {{}}\n\n"]
+    else:
+        events = []
+        for change in changes:
+            data = json.dumps({**change_dict(change, "preview"), "total": total})
+            events.append(f"id: {change[0]}\nevent: change\ndata: {data}\n\n")
+    return current, "".join(events).encode("utf-8")
+
+
+def change_dict(change: tuple, fields: str) -> dict:
+    seq, op, name, entry, old_name = change
+    if entry is None:
+        item = {"name": name, "op": "delete", "seq": seq}
+    else:
+        item = {**entry.to_dict(fields), "op": op, "seq": seq}
+    if old_name:
+        item["old_name"] = old_name
+    return item
+
+
+# Request lines are queued by the handlers and appended in batches by a single
+# background thread. Each hour gets its own segment, named after its start;
+# a segment that outgrows LOG_SEGMENT_MAX_BYTES is continued in a new file
+# named after the moment of rotation. Retention runs on a timer in the same
+# thread, so the request path never touches the disk.
+class LogWriter:
+    def __init__(self) -> None:
+        self._queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_LIMIT)
+        self._start_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._fh = None
+        self._dir: Path | None = None
+        self._hour: datetime | None = None
+        self._size = 0
+        self._last_cleanup = float("-inf")
+        self.dropped = 0
+
+    def write(self, line: str) -> None:
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self._thread = None
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="mini-keep-log", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self) -> None:
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=LOG_FLUSH_SECONDS))
+                while len(batch) < 1000:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = [line for line in batch if line is not None]
+            running = len(lines) == len(batch)
+            try:
+                if lines:
+                    self._append(lines)
+                if not running and self._fh is not None:
+                    self._fh.close()
+                    self._fh = None
+                if time.monotonic() - self._last_cleanup >= LOG_CLEANUP_SECONDS:
+                    self._cleanup()
+            except Exception:
+                pass
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _append(self, lines: list[str]) -> None:
+        now = datetime.utcnow()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        root = LOG_DIR
+        if self._fh is None or root != self._dir or hour != self._hour:
+            self._open(root, hour, hour)
+        elif self._size >= LOG_SEGMENT_MAX_BYTES:
+            self._open(root, hour, now)
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        self._fh.write(data)
+        self._fh.flush()
+        self._size += len(data)
+
+    def _open(self, root: Path, hour: datetime, stamp: datetime) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        root.mkdir(exist_ok=True)
+        self._fh = (root / (stamp.strftime(LOG_NAME_FORMAT) + ".log")).open("ab")
+        self._dir = root
+        self._hour = hour
+        self._size = self._fh.tell()
+
+    def _cleanup(self) -> None:
+        self._last_cleanup = time.monotonic()
+        root = LOG_DIR
+        cutoff = datetime.utcnow() - timedelta(hours=LOG_RETENTION_HOURS)
+        for path in root.glob("*.log"):
+            try:
+                if datetime.strptime(path.stem, LOG_NAME_FORMAT) < cutoff:
+                    path.unlink(missing_ok=True)
+            except (ValueError, OSError):
+                continue
+
+
+LOGGER = LogWriter()
+
+
+# Streams `{...head, "files": [...]}` one note at a time, so memory does not grow
+# with the corpus. HTTP/1.1 clients get chunked transfer encoding; HTTP/1.0
+# clients get a body delimited by closing the connection.
+def send_json_stream(handler: BaseHTTPRequestHandler, status: int, head: dict, items,
+                     etag: str | None = None) -> None:
+    chunked = handler.request_version == "HTTP/1.1"
+    compressor = None
+    if accepts_gzip(handler.headers.get("Accept-Encoding")):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Vary", "Accept-Encoding")
+    if compressor:
+        handler.send_header("Content-Encoding", "gzip")
+    if etag:
+        handler.send_header("ETag", etag)
+        handler.send_header("Cache-Control", "no-cache")
+    if chunked:
+        handler.send_header("Transfer-Encoding", "chunked")
+    else:
+        handler.send_header("Connection", "close")
+    handler.end_headers()
+
+    def write(data: bytes) -> None:
+        if data:
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+
+    def emit(data: bytes) -> None:
+        write(compressor.compress(data) if compressor else data)
+
+    prefix = json.dumps(head)[:-1]
+    buffer = bytearray((prefix + (", " if head else "") + '"files": [').encode("utf-8"))
+    for i, item in enumerate(items):
+        if i:
+            buffer += b", "
+        buffer += item
+        if len(buffer) >= STREAM_CHUNK_BYTES:
+            emit(bytes(buffer))
+            buffer.clear()
+    buffer += b"]}"
+    emit(bytes(buffer))
+    if compressor:
+        write(compressor.flush())
+    if chunked:
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+def load_config(path: str | None) -> dict:
+    if not path:
+        return {}
+    cfg_path = Path(path)
+    if not cfg_path.is_file():
+        raise FileNotFoundError(f"config file not found: {cfg_path}")
+    with cfg_path.open("r", encoding="utf-8") as fh:
+        data = json.load(fh)
+    if not isinstance(data, dict):
+        raise ValueError("config file must contain a JSON object")
+    return data
+
+
+# Closing a socket with unread data in it makes Linux answer with a RST, which
+# can wipe out a response the client has not read yet. The write side is shut
+# first so the client sees the response end, then whatever it still sends is
+# read and dropped for a while before the caller closes.
+def linger(sock: socket.socket) -> None:
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        deadline = time.monotonic() + LINGER_SECONDS
+        while (left := deadline - time.monotonic()) > 0:
+            sock.settimeout(min(left, LINGER_IDLE_SECONDS))
+            if not sock.recv(UPLOAD_CHUNK_BYTES):
+                break
+    except OSError:
+        pass
+
+
+class _Subscriber:
+    __slots__ = ("handler", "seq", "last_write", "lock", "closed", "pending")
+
+    def __init__(self, handler, seq: int) -> None:
+        self.handler = handler
+        self.seq = seq
+        # Last time bytes went out, or the current backlog began.
+        self.last_write = time.monotonic()
+        self.lock = threading.Lock()
+        self.closed = False
+        # Encoded events the socket has not taken yet.
+        self.pending = bytearray()
+
+
+# Fixed pool of worker threads fed from a bounded queue of connections with a
+# request to read. Workers never wait on a client: between requests an idle
+# keep-alive connection is handed to a selector thread, which queues it again
+# once the next request arrives or closes it after `timeout`, and /events
+# subscribers are fed by one broadcaster thread with non-blocking sends; one
+# whose backlog passes SSE_MAX_PENDING_BYTES or makes no progress for
+# SSE_SEND_TIMEOUT_SECONDS is dropped rather than holding up the rest. When the queue is full the
+# connection is answered with 503 and drained by the selector thread instead of
+# growing another thread.
+class PooledHTTPServer(HTTPServer):
+    retry_after_seconds = 1
+
+    def __init__(self, server_address, handler_class, workers: int = DEFAULT_WORKERS,
+                 backlog: int = DEFAULT_BACKLOG, bind_and_activate: bool = True) -> None:
+        self.request_queue_size = backlog
+        self.workers = workers
+        self.backlog = backlog
+        self.busy_workers = 0
+        self.shed_connections = 0
+        self._pending: queue.Queue = queue.Queue(maxsize=backlog)
+        self._stats_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        # (socket, client_address, handler or None, deadline) waiting to be
+        # registered with the selector; handler None means drain and close.
+        self._parking: list[tuple] = []
+        self._subscribers: set[_Subscriber] = set()
+        self._broadcaster: threading.Thread | None = None
+        self.idle_connections = 0
+        self._closed = False
+        super().__init__(server_address, handler_class, bind_and_activate)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=f"mini-keep-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._watch, name="mini-keep-selector", daemon=True).start()
+
+    def process_request(self, request, client_address) -> None:
+        self._enqueue(request, client_address, None)
+
+    def _enqueue(self, request, client_address, handler) -> None:
+        try:
+            self._pending.put_nowait((request, client_address, handler))
+        except queue.Full:
+            with self._stats_lock:
+                self.shed_connections += 1
+            if handler is not None:
+                self._release(handler)
+            self._reject(request)
+
+    def _reject(self, request) -> None:
+        body = json.dumps({"error": "server busy"}).encode("utf-8")
+        head = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Retry-After: {self.retry_after_seconds}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            request.setblocking(False)
+            request.send(head.encode("ascii") + body)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.shutdown_request(request)
+            return
+        # The request is still unread; see linger().
+        self._park(request, None, None, LINGER_SECONDS)
+
+    def _work(self) -> None:
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            request, client_address, handler = item
+            with self._stats_lock:
+                self.busy_workers += 1
+            kept = False
+            try:
+                if handler is None:
+                    handler = self._open(request, client_address)
+                kept = self._serve(handler)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if not kept:
+                    if handler is not None:
+                        self._release(handler)
+                    self.shutdown_request(request)
+                with self._stats_lock:
+                    self.busy_workers -= 1
+
+    def _open(self, request, client_address):
+        # BaseRequestHandler.__init__ would serve the connection to the end.
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = self
+        handler.setup()
+        handler.detach_events = True
+        return handler
+
+    # Serves the requests already sent, then hands the connection on. Returns
+    # whether it is still open.
+    def _serve(self, handler) -> bool:
+        while True:
+            handler.close_connection = True
+            handler.handle_one_request()
+            if handler.event_cursor is not None:
+                self._subscribe(handler)
+                return True
+            if handler.close_connection:
+                return False
+            if not self._buffered(handler):
+                break
+        self._park(handler.request, handler.client_address, handler, handler.timeout)
+        return True
+
+    def _buffered(self, handler) -> bool:
+        # A pipelined request may already sit in the read buffer, where the
+        # selector would never see it.
+        handler.request.settimeout(0.0)
+        try:
+            return bool(handler.rfile.peek(1))
+        except OSError:
+            return True
+        finally:
+            handler.request.settimeout(handler.timeout)
+
+    def _release(self, handler) -> None:
+        try:
+            handler.finish()
+        except OSError:
+            pass
+
+    def _park(self, request, client_address, handler, seconds: float) -> None:
+        with self._stats_lock:
+            self._parking.append((request, client_address, handler, time.monotonic() + seconds))
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _watch(self) -> None:
+        while not self._closed:
+            for key, _ in self._selector.select(timeout=1.0):
+                if key.fileobj is self._wake_r:
+                    try:
+                        self._wake_r.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                request, client_address, handler, _ = key.data
+                if handler is None:
+                    try:
+                        if request.recv(UPLOAD_CHUNK_BYTES):
+                            continue
+                    except OSError:
+                        pass
+                    self._selector.unregister(request)
+                    self._discard(request, handler)
+                    continue
+                self._selector.unregister(request)
+                self._enqueue(request, client_address, handler)
+            with self._stats_lock:
+                parking, self._parking = self._parking, []
+            for item in parking:
+                try:
+                    self._selector.register(item[0], selectors.EVENT_READ, item)
+                except (ValueError, OSError):
+                    self._discard(item[0], item[2])
+            now = time.monotonic()
+            idle = 0
+            for key in list(self._selector.get_map().values()):
+                if key.fileobj is self._wake_r:
+                    continue
+                if key.data[3] <= now:
+                    self._selector.unregister(key.fileobj)
+                    self._discard(key.fileobj, key.data[2])
+                elif key.data[2] is not None:
+                    idle += 1
+            self.idle_connections = idle
+        for key in list(self._selector.get_map().values()):
+            if key.fileobj is not self._wake_r:
+                self._discard(key.fileobj, key.data[2])
+        self._selector.close()
+
+    def _discard(self, request, handler) -> None:
+        if handler is None:
+            request.close()
+            return
+        self._release(handler)
+        self.shutdown_request(request)
+
+    def _subscribe(self, handler) -> None:
+        subscriber = _Subscriber(handler, handler.event_cursor)
+        handler.request.setblocking(False)
+        with self._stats_lock:
+            self._subscribers.add(subscriber)
+            if self._broadcaster is None:
+                self._broadcaster = threading.Thread(target=self._broadcast, name="mini-keep-events", daemon=True)
+                self._broadcaster.start()
+        # Catches up on what happened before the broadcaster could see it.
+        self._push(subscriber)
+
+    # Runs while there are subscribers.
+    def _broadcast(self) -> None:
+        seq = CATALOG.current_seq()
+        backlog = False
+        while True:
+            # Comes back soon while some socket still has bytes to take.
+            CATALOG.wait_for_change(seq, SSE_FLUSH_SECONDS if backlog else SSE_HEARTBEAT_SECONDS)
+            seq = CATALOG.current_seq()
+            with self._stats_lock:
+                subscribers = list(self._subscribers)
+                if self._closed or not subscribers:
+                    self._broadcaster = None
+                    return
+            backlog = False
+            for subscriber in subscribers:
+                backlog = self._push(subscriber) or backlog
+
+    # Queues what the subscriber has not seen and sends what the socket takes
+    # without blocking. Returns whether bytes are left over.
+    def _push(self, subscriber: _Subscriber) -> bool:
+        with subscriber.lock:
+            if subscriber.closed:
+                return False
+            now = time.monotonic()
+            subscriber.seq, payload = event_batch(subscriber.seq)
+            if not payload and not subscriber.pending and now - subscriber.last_write >= SSE_HEARTBEAT_SECONDS:
+                payload = b": ping\n\n"
+            if payload and not subscriber.pending:
+                # A new backlog starts the clock on its progress.
+                subscriber.last_write = now
+            subscriber.pending += payload
+            try:
+                while subscriber.pending:
+                    sent = subscriber.handler.request.send(subscriber.pending)
+                    del subscriber.pending[:sent]
+                    subscriber.last_write = now
+            except BlockingIOError:
+                pass
+            except OSError:
+                subscriber.closed = True
+            if subscriber.pending and (len(subscriber.pending) > SSE_MAX_PENDING_BYTES
+                                       or now - subscriber.last_write >= SSE_SEND_TIMEOUT_SECONDS):
+                # Fell behind; it reconnects with Last-Event-ID and catches up.
+                subscriber.closed = True
+            if not subscriber.closed:
+                return bool(subscriber.pending)
+        self._unsubscribe(subscriber)
+        return False
+
+    def _unsubscribe(self, subscriber: _Subscriber) -> None:
+        with self._stats_lock:
+            self._subscribers.discard(subscriber)
+        subscriber.closed = True
+        self._release(subscriber.handler)
+        self.shutdown_request(subscriber.handler.request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self._closed = True
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                if item[2] is not None:
+                    self._release(item[2])
+                self.shutdown_request(item[0])
+        for _ in self._threads:
+            self._pending.put(None)
+        with self._stats_lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            with subscriber.lock:
+                subscriber.closed = True
+            self._unsubscribe(subscriber)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            subscribers = len(self._subscribers)
+        return {
+            "engine": "pool",
+            "workers": self.workers,
+            "busy_workers": self.busy_workers,
+            "queue_depth": self._pending.qsize(),
+            "queue_limit": self.backlog,
+            "shed_connections": self.shed_connections,
+            "idle_connections": self.idle_connections,
+            "event_subscribers": subscribers,
+        }
+
+
+class _LoopWriter(io.RawIOBase):
+    # File-like wfile for handlers running in an executor thread: writes are
+    # buffered and handed to the event loop's transport on flush.
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter) -> None:
+        super().__init__()
+        self._loop = loop
+        self._writer = writer
+        self._buffer = bytearray()
+        self.sent = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= 64 * 1024:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self.sent = True
+        asyncio.run_coroutine_threadsafe(self._send(data), self._loop).result()
+
+    async def _send(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def discard(self) -> None:
+        self._buffer.clear()
+
+    def sendfile(self, file, offset: int, count: int) -> None:
+        self.flush()
+        self.sent = True
+        asyncio.run_coroutine_threadsafe(self._sendfile(file, offset, count), self._loop).result()
+
+    async def _sendfile(self, file, offset: int, count: int) -> None:
+        await self._writer.drain()
+        await self._loop.sendfile(self._writer.transport, file, offset, count)
+
+
+class _LoopReader:
+    # rfile for streamed request bodies: the head the loop already parsed,
+    # then the body pulled from the connection as the handler reads it.
+    def __init__(self, loop: asyncio.AbstractEventLoop, reader: asyncio.StreamReader, head: bytes,
+                 length: int) -> None:
+        self._loop = loop
+        self._reader = reader
+        self._head = io.BytesIO(head)
+        self.remaining = length
+
+    def readline(self, limit: int = -1) -> bytes:
+        return self._head.readline(limit)
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b""
+        data = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self._reader.read(size), KEEPALIVE_TIMEOUT_SECONDS), self._loop
+        ).result()
+        self.remaining -= len(data)
+        return data
+
+
+# Event-loop engine for many mostly idle connections. The loop parses request
+# framing and waits on idle keep-alive sockets and /events subscribers; each
+# request is then run through the regular Handler on an executor thread, so
+# route logic and blocking file I/O stay off the loop.
+class AsyncioHTTPServer:
+    def __init__(self, server_address, handler_class, workers: int = DEFAULT_WORKERS,
+                 backlog: int = DEFAULT_BACKLOG, sock: socket.socket | None = None) -> None:
+        self.RequestHandlerClass = handler_class
+        self.workers = workers
+        self.socket = sock or socket.create_server(server_address, backlog=backlog)
+        self.server_address = self.socket.getsockname()[:2]
+        self.open_connections = 0
+        self.active_requests = 0
+        self.event_subscribers = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="mini-keep-async")
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop: asyncio.Event | None = None
+        self._changed: asyncio.Event | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._running = threading.Event()
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.server_close()
+
+    def serve_forever(self) -> None:
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._running.clear()
+            self._stopped.set()
+
+    def shutdown(self) -> None:
+        if self._running.wait(timeout=5) and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._stopped.wait()
+
+    def server_close(self) -> None:
+        self.socket.close()
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "engine": "asyncio",
+            "workers": self.workers,
+            "open_connections": self.open_connections,
+            "active_requests": self.active_requests,
+            "event_subscribers": self.event_subscribers,
+        }
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._changed = asyncio.Event()
+        CATALOG.add_listener(self._notify)
+        server = await asyncio.start_server(self._client, sock=self.socket)
+        self._running.set()
+        try:
+            await self._stop.wait()
+        finally:
+            CATALOG.remove_listener(self._notify)
+            server.close()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _notify(self) -> None:
+        # Called from whichever thread recorded the change.
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.open_connections += 1
+        peer = writer.get_extra_info("peername")
+        state = {"requests": 0}
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT_SECONDS)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                    break
+                head, length, expect = self._frame(head)
+                # PUT bodies are streamed to the handler; others are read here
+                # unless over the limit, which the handler answers with 413.
+                stream = _LoopReader(self._loop, reader, head, length) if head.startswith(b"PUT ") else None
+                body = b""
+                oversize = length > (MAX_UPLOAD_BYTES if stream else MAX_BODY_BYTES)
+                if length > 0 and not oversize:
+                    if expect:
+                        # Read before the handler runs, so answer now.
+                        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    if stream is None:
+                        body = await asyncio.wait_for(
+                            reader.readexactly(length), self.RequestHandlerClass.timeout
+                        )
+                self.active_requests += 1
+                try:
+                    handler = await self._loop.run_in_executor(
+                        self._executor, self._dispatch, head + body, writer, peer, state, stream
+                    )
+                finally:
+                    self.active_requests -= 1
+                if handler.event_cursor is not None:
+                    await self._events(handler.event_cursor, reader, writer)
+                    break
+                if oversize or (stream is not None and stream.remaining):
+                    await self._linger(reader, writer)
+                    break
+                if handler.close_connection:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.open_connections -= 1
+            self._tasks.discard(task)
+            writer.close()
+
+    # The asyncio side of linger().
+    async def _linger(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+            deadline = self._loop.time() + LINGER_SECONDS
+            while (left := deadline - self._loop.time()) > 0:
+                if not await asyncio.wait_for(reader.read(UPLOAD_CHUNK_BYTES), min(left, LINGER_IDLE_SECONDS)):
+                    break
+        except (asyncio.TimeoutError, OSError):
+            pass
+
+    def _frame(self, head: bytes) -> tuple[bytes, int, bool]:
+        length = 0
+        expect = False
+        lines = head.split(b"\r\n")
+        kept = []
+        for line in lines:
+            key, _, value = line.partition(b":")
+            key = key.strip().lower()
+            if key == b"content-length":
+                try:
+                    length = int(value.strip())
+                except ValueError:
+                    length = 0
+            elif key == b"expect" and value.strip().lower() == b"100-continue":
+                expect = True
+                continue
+            kept.append(line)
+        return b"\r\n".join(kept), length, expect
+
+    def _dispatch(self, raw: bytes, writer: asyncio.StreamWriter, peer, state: dict,
+                  stream: _LoopReader | None = None):
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = peer
+        handler.request = handler.connection = None
+        handler.rfile = stream or io.BufferedReader(io.BytesIO(raw))
+        handler.wfile = _LoopWriter(self._loop, writer)
+        handler.requests_handled = state["requests"]
+        handler.body_consumed = True
+        handler.detach_events = True
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+            handler.wfile.flush()
+        except Exception:
+            self.handle_error(None, peer)
+            handler.close_connection = True
+            handler.event_cursor = None
+            if not handler.wfile.sent:
+                # Nothing went out yet, so the client can still get an answer.
+                handler.wfile.discard()
+                handler._headers_buffer = []
+                try:
+                    send_json(handler, 500, {"error": "internal server error"})
+                    handler.wfile.flush()
+                except Exception:
+                    pass
+        state["requests"] = handler.requests_handled
+        return handler
+
+    def handle_error(self, request, client_address) -> None:
+        # The report socketserver prints for a handler that raised.
+        print("-" * 40, file=sys.stderr)
+        print("Exception occurred during processing of request from", client_address, file=sys.stderr)
+        traceback.print_exc()
+        print("-" * 40, file=sys.stderr)
+
+    async def _events(self, seq: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.event_subscribers += 1
+        hangup = asyncio.ensure_future(reader.read())
+        last_write = time.monotonic()
+        try:
+            while True:
+                changed = self._changed
+                seq, payload = await self._loop.run_in_executor(self._executor, event_batch, seq)
+                if not payload and time.monotonic() - last_write >= SSE_HEARTBEAT_SECONDS:
+                    payload = b": ping\n\n"
+                if payload:
+                    writer.write(payload)
+                    # A client that stops reading is dropped; it reconnects
+                    # with Last-Event-ID.
+                    await asyncio.wait_for(writer.drain(), SSE_SEND_TIMEOUT_SECONDS)
+                    last_write = time.monotonic()
+                waiter = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait(
+                    {waiter, hangup}, timeout=SSE_HEARTBEAT_SECONDS, return_when=asyncio.FIRST_COMPLETED
+                )
+                waiter.cancel()
+                if hangup in done:
+                    return
+        finally:
+            hangup.cancel()
+            self.event_subscribers -= 1
+
+
+def make_server(address: tuple[str, int], engine: str = DEFAULT_ENGINE, workers: int = DEFAULT_WORKERS,
+                backlog: int = DEFAULT_BACKLOG, sock: socket.socket | None = None):
+    # `sock` is an already listening socket, e.g. one inherited from --processes.
+    if engine == "asyncio":
+        return AsyncioHTTPServer(address, Handler, workers=workers, backlog=backlog, sock=sock)
+    if engine == "pool":
+        httpd = PooledHTTPServer(address, Handler, workers=workers, backlog=backlog, bind_and_activate=False)
+    else:
+        httpd = ThreadingHTTPServer(address, Handler, bind_and_activate=False)
+    httpd.request_queue_size = backlog
+    try:
+        if sock is None:
+            httpd.server_bind()
+            httpd.server_activate()
+        else:
+            httpd.socket.close()
+            httpd.socket = sock
+            httpd.server_address = sock.getsockname()[:2]
+    except Exception:
+        httpd.server_close()
+        raise
+    return httpd
+
+
+def server_stats(httpd) -> dict:
+    if hasattr(httpd, "stats"):
+        return httpd.stats()
+    return {"engine": "threading", "threads": threading.active_count()}
+
+
+class Handler(BaseHTTPRequestHandler):
+  # Persistent connections: idle sockets time out after `timeout` seconds and
+  # each connection is closed after KEEPALIVE_MAX_REQUESTS responses.
+  protocol_version = "HTTP/1.1"
+  timeout = KEEPALIVE_TIMEOUT_SECONDS
+  # Headers and body go out in separate writes; with Nagle enabled the body of
+  # every keep-alive response waits on the client's delayed ACK.
+  disable_nagle_algorithm = True
+
+  def setup(self) -> None:
+    super().setup()
+    self.requests_handled = 0
+    self.body_consumed = True
+    self.body_left_unread = False
+
+  def finish(self) -> None:
+    super().finish()
+    if self.body_left_unread:
+      linger(self.connection)
+
+  def send_response(self, code: int, message: str | None = None) -> None:
+    super().send_response(code, message)
+    self.requests_handled += 1
+    if self.close_connection or self.requests_handled >= KEEPALIVE_MAX_REQUESTS:
+      self.send_header("Connection", "close")
+
+  # Bodies over the limit are refused before any of them is read; the unread
+  # rest makes the connection unusable, so it is closed.
+  def reject_large_body(self) -> bool:
+    limit = MAX_UPLOAD_BYTES if self.command == "PUT" else MAX_BODY_BYTES
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+    except ValueError:
+      return False
+    if length <= limit:
+      return False
+    self.body_consumed = True
+    self.body_left_unread = self.close_connection = True
+    send_json(self, 413, {"error": f"body is over the {limit} byte limit"})
+    return True
+
+  def handle_expect_100(self) -> bool:
+    if self.reject_large_body():
+      return False
+    return super().handle_expect_100()
+
+  def discard_body(self) -> None:
+    # An unread body would be parsed as the next request on this connection.
+    if self.body_consumed:
+      return
+    self.body_consumed = True
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+    except ValueError:
+      length = -1
+    if length < 0 or length > KEEPALIVE_DRAIN_LIMIT:
+      self.body_left_unread = self.close_connection = True
+    elif length:
+      self.rfile.read(length)
+
+  def _is_authorized(self, allow_token: bool = False) -> bool:
+    if not PASSWORD:
+      return True
+    provided = self.headers.get("X-Password", "")
+    if not provided and allow_token:
+      # EventSource cannot send custom headers; it presents a token from
+      # POST /events_token instead.
+      return check_events_token(self.query_params().get("token", ""))
+    return hmac.compare_digest(provided.encode("utf-8"), PASSWORD.encode("utf-8"))
+
+  def _require_auth(self, allow_token: bool = False) -> bool:
+    if self._is_authorized(allow_token):
+      return True
+    send_json(self, 401, {"error": "unauthorized"})
+    return False
+
+  def log_request(self, code="-", size="-") -> None:
+    # Query strings can carry tokens; the path is enough for the log.
+    method, _, rest = self.requestline.partition(" ")
+    target, _, version = rest.partition(" ")
+    line = " ".join(part for part in (method, target.partition("?")[0], version) if part)
+    self.log_message('"%s" %s %s', line, str(code), str(size))
+
+  def log_message(self, format: str, *args) -> None:
+    msg = (format % args) if args else format
+    stamp = datetime.utcnow().isoformat(timespec="seconds")
+    LOGGER.write(f"{stamp} {msg[:2000]}")
+
+  def do_GET(self) -> None:  # noqa: N802
+    parsed = urlparse(self.path)
+    try:
+      if parsed.path == "/":
+        self.serve_index()
+      elif parsed.path == "/ready":
+        self.ready()
+      elif parsed.path == "/list_files":
+        self.list_files()
+      elif parsed.path == "/get_file":
+        self.get_file()
+      elif parsed.path == "/events":
+        self.stream_events()
+      elif parsed.path == "/stats":
+        self.stats()
+      elif parsed.path == "/search_files":
+        self.search_files()
+      elif parsed.path.startswith("/raw/"):
+        self.raw_file(parsed.path[len("/raw/"):])
+      else:
+        send_json(self, 404, {"error": "not found"})
+    except ValueError as exc:
+      send_json(self, 400, {"error": str(exc)})
+
+  def do_HEAD(self) -> None:  # noqa: N802
+    parsed = urlparse(self.path)
+    if parsed.path.startswith("/raw/"):
+      self.raw_file(parsed.path[len("/raw/"):])
+    else:
+      self.send_raw_error(404, "not found")
+
+  def do_POST(self) -> None:  # noqa: N802
+    parsed = urlparse(self.path)
+    self.body_consumed = False
+    try:
+      if self.reject_large_body():
+        return
+      if parsed.path == "/create_file":
+        self.create_file()
+      elif parsed.path == "/update_file":
+        self.update_file()
+      elif parsed.path == "/patch_file":
+        self.patch_file()
+      elif parsed.path == "/batch":
+        self.batch()
+      elif parsed.path == "/events_token":
+        self.events_token()
+      elif parsed.path == "/delete_file":
+        self.delete_file()
+      elif parsed.path == "/search_files":
+        self.search_files()
+      else:
+        send_json(self, 404, {"error": "not found"})
+    except ValueError as exc:
+      send_json(self, 400, {"error": str(exc)})
+    except OSError as exc:
+      full = exc.errno in (errno.ENOSPC, errno.EDQUOT)
+      send_json(self, 507 if full else 500, {"error": "could not store the note"})
+    finally:
+      self.discard_body()
+
+  def do_PUT(self) -> None:  # noqa: N802
+    parsed = urlparse(self.path)
+    self.body_consumed = False
+    try:
+      if self.reject_large_body():
+        return
+      if parsed.path.startswith("/raw/"):
+        self.put_raw_file(parsed.path[len("/raw/"):])
+      else:
+        send_json(self, 404, {"error": "not found"})
+    except ValueError as exc:
+      send_json(self, 400, {"error": str(exc)})
+    except OSError as exc:
+      full = exc.errno in (errno.ENOSPC, errno.EDQUOT)
+      send_json(self, 507 if full else 500, {"error": "could not store the note"})
+    finally:
+      self.discard_body()
+
+  def serve_index(self) -> None:
+    gzipped = accepts_gzip(self.headers.get("Accept-Encoding"))
+    body, etag = (INDEX_GZIP, INDEX_GZIP_ETAG) if gzipped else (INDEX_BODY, INDEX_ETAG)
+    status = 304 if etag_matches(self.headers.get("If-None-Match"), etag) else 200
+    self.send_response(status)
+    self.send_header("ETag", etag)
+    self.send_header("Cache-Control", "no-cache")
+    self.send_header("Vary", "Accept-Encoding")
+    if status == 304:
+      self.end_headers()
+      return
+    self.send_header("Content-Type", "text/html; charset=utf-8")
+    if gzipped:
+      self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def query_params(self) -> dict:
+    return {key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+
+  # GET responses built only from the catalog are tagged with its change
+  # sequence (bumped by every write, including ones detected on disk) and the
+  # request target, so a revalidation is answered without building the body.
+  def catalog_etag(self) -> str | None:
+    if self.command != "GET":
+      return None
+    target = zlib.crc32(self.path.encode("utf-8"))
+    return f'W/"{CATALOG.current_seq():x}-{target:08x}"'
+
+  def send_not_modified(self, etag: str | None) -> bool:
+    if not etag or not etag_matches(self.headers.get("If-None-Match"), etag):
+      return False
+    self.send_response(304)
+    self.send_header("ETag", etag)
+    self.send_header("Cache-Control", "no-cache")
+    self.send_header("Vary", "Accept-Encoding")
+    self.end_headers()
+    return True
+
+  def list_files(self, params: dict | None = None) -> None:
+    if not self._require_auth():
+      return
+    etag = self.catalog_etag()
+    if self.send_not_modified(etag):
+      return
+    if params is None:
+      params = self.query_params()
+    fields = parse_fields(params.get("fields"))
+    if params.get("since") is not None:
+      self.list_changes(params, fields, etag)
+      return
+    if params.get("limit") is None and params.get("cursor") is None:
+      entries = CATALOG.entries()
+      send_json_stream(self, 200, {}, (entry.fragment(fields) for entry in entries), etag)
+      return
+    limit = parse_int(params.get("limit"), LIST_MAX_LIMIT, 1, LIST_MAX_LIMIT, "limit")
+    after = decode_cursor(params["cursor"]) if params.get("cursor") else None
+    entries, total, seq = CATALOG.page(after, limit)
+    next_cursor = encode_cursor(entries[-1]) if len(entries) == limit else None
+    head = {"total": total, "next_cursor": next_cursor, "seq": seq}
+    send_json_stream(self, 200, head, (entry.fragment(fields) for entry in entries), etag)
+
+  def list_changes(self, params: dict, fields: str, etag: str | None = None) -> None:
+    since = parse_int(params.get("since"), 0, 0, 2**63, "since")
+    seq, total, changes = CATALOG.changes_since(since)
+    if changes is None:
+      send_json(self, 200, {"seq": seq, "total": total, "reset": True, "changes": []}, etag)
+      return
+    send_json(self, 200, {
+      "seq": seq,
+      "total": total,
+      "reset": False,
+      "changes": [change_dict(change, fields) for change in changes],
+    }, etag)
+
+  # Open like "/" so load balancers can probe it without the password.
+  def ready(self) -> None:
+    ready = CATALOG.ready.is_set()
+    send_json(self, 200 if ready else 503, {"ready": ready})
+
+  def stats(self) -> None:
+    if not self._require_auth():
+      return
+    send_json(self, 200, {
+      "server": server_stats(self.server),
+      "catalog": {"notes": len(CATALOG.entries()), "seq": CATALOG.current_seq()},
+      "storage": {"backend": STORAGE, **current_store().stats()},
+      "cache": CONTENT_CACHE.stats(),
+      "log": {"dropped": LOGGER.dropped},
+    })
+
+  # The note's stored bytes, not JSON. Stores that keep notes in files hand
+  # over the file and the bytes go out with sendfile(2); validators come from
+  # the file's own mtime and size, and a single Range is honoured.
+  def raw_file(self, raw_name: str) -> None:
+    if not self._is_authorized():
+      self.send_raw_error(401, "unauthorized")
+      return
+    try:
+      name = sanitize_name(unquote(raw_name))
+      opened = current_store().open_raw(name)
+    except ValueError as exc:
+      self.send_raw_error(400, str(exc))
+      return
+    except OSError:
+      self.send_raw_error(404, "file not found")
+      return
+    data = None
+    if opened is None:
+      entry = CATALOG.get(name)
+      if entry is None:
+        self.send_raw_error(404, "file not found")
+        return
+      data = entry.content.encode("utf-8")
+      opened = None, 0, len(data), entry.mtime_ns
+    f, offset, length, mtime_ns = opened
+    try:
+      etag = f'"{mtime_ns:x}-{length:x}"'
+      modified = self.date_time_string(mtime_ns // 1_000_000_000)
+      if self.raw_not_modified(etag, mtime_ns):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", modified)
+        self.end_headers()
+        return
+      span = None
+      if_range = self.headers.get("If-Range")
+      if if_range is None or if_range.strip() in (etag, modified):
+        span = parse_range(self.headers.get("Range"), length)
+      if span == (length, length):
+        self.send_response(416)
+        self.send_header("Content-Range", f"bytes */{length}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+      start, stop = span or (0, length)
+      self.send_response(206 if span else 200)
+      self.send_header("Content-Type", "text/plain; charset=utf-8")
+      self.send_header("Content-Length", str(stop - start))
+      if span:
+        self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{length}")
+      self.send_header("Accept-Ranges", "bytes")
+      self.send_header("ETag", etag)
+      self.send_header("Last-Modified", modified)
+      self.send_header("Cache-Control", "no-cache")
+      self.end_headers()
+      if self.command == "HEAD" or stop == start:
+        return
+      if f is None:
+        self.wfile.write(data[start:stop])
+      elif self.connection is not None:
+        self.wfile.flush()
+        self.connection.sendfile(f, offset + start, stop - start)
+      else:
+        self.wfile.sendfile(f, offset + start, stop - start)
+    finally:
+      if f is not None:
+        f.close()
+
+  # Creates or replaces a note with the request body, which goes to the store
+  # in UPLOAD_CHUNK_BYTES pieces (for files, into a temp file renamed over the
+  # note), so an import of any size holds one chunk in memory.
+  def put_raw_file(self, raw_name: str) -> None:
+    if not self._require_auth():
+      return
+    name = sanitize_name(unquote(raw_name))
+    try:
+      length = int(self.headers["Content-Length"])
+    except (TypeError, ValueError):
+      length = -1
+    if length < 0:
+      send_json(self, 411, {"error": "Content-Length is required"})
+      return
+    store = current_store()
+    self.body_consumed = True
+    try:
+      # The body is staged before taking the note's lock, so a slow upload
+      # does not hold up other writers of the same stripe.
+      staged = store.stage_stream(name, self.body_chunks(length))
+    except (ValueError, OSError):
+      # Part of the body may still be unread.
+      self.body_left_unread = self.close_connection = True
+      raise
+    with staged, CATALOG.write_locks([name]):
+      existed = store.exists(name)
+      staged.commit()
+      entry = CATALOG.record_upload(name)
+    if entry is None:
+      raise ValueError("stored note could not be read back")
+    send_json(self, 200 if existed else 201, {
+      "status": "updated" if existed else "created",
+      "name": name,
+      "size": entry.size,
+      "version": entry.version,
+    })
+
+  def body_chunks(self, length: int):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+      while length > 0:
+        chunk = self.rfile.read(min(length, UPLOAD_CHUNK_BYTES))
+        if not chunk:
+          raise ValueError("body ended before Content-Length")
+        length -= len(chunk)
+        decoder.decode(chunk)
+        yield chunk
+      decoder.decode(b"", final=True)
+    except UnicodeDecodeError as exc:
+      raise ValueError("body is not valid UTF-8") from exc
+
+  def raw_not_modified(self, etag: str, mtime_ns: int) -> bool:
+    if "If-None-Match" in self.headers:
+      return etag_matches(self.headers.get("If-None-Match"), etag)
+    try:
+      since = parsedate_to_datetime(self.headers.get("If-Modified-Since", ""))
+    except (TypeError, ValueError):
+      return False
+    return since.timestamp() >= mtime_ns // 1_000_000_000
+
+  def send_raw_error(self, code: int, message: str) -> None:
+    # Responses to HEAD carry no body.
+    if self.command != "HEAD":
+      send_json(self, code, {"error": message})
+      return
+    self.send_response(code)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+  def get_file(self) -> None:
+    if not self._require_auth():
+      return
+    etag = self.catalog_etag()
+    if self.send_not_modified(etag):
+      return
+    name = sanitize_name(self.query_params().get("name", ""))
+    entry = CATALOG.get(name)
+    if entry is None:
+      send_json(self, 404, {"error": "file not found"})
+      return
+    send_json(self, 200, {**entry.to_dict(), "version": entry.version}, etag)
+
+  # Every subscriber blocks on the catalog's change condition and reads the
+  # shared change log from its own cursor, so idle streams cost no polling.
+  # Engines that wait asynchronously set `detach_events`; the handler then only
+  # sends the response head and leaves the cursor in `event_cursor`.
+  detach_events = False
+  event_cursor: int | None = None
+
+  def events_token(self) -> None:
+    if not self._require_auth():
+      return
+    send_json(self, 200, {"token": events_token(), "expires_in": EVENTS_TOKEN_SECONDS})
+
+  def stream_events(self) -> None:
+    if not self._require_auth(allow_token=True):
+      return
+    last_id = self.headers.get("Last-Event-ID") or self.query_params().get("since")
+    seq = parse_int(last_id, CATALOG.current_seq(), 0, 2**63, "since")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/event-stream")
+    self.send_header("Cache-Control", "no-cache")
+    self.send_header("Connection", "close")
+    self.end_headers()
+    try:
+      self.wfile.write(f"retry: {SSE_RETRY_MS}\n\n".encode("utf-8"))
+      self.wfile.flush()
+      if self.detach_events:
+        self.event_cursor = seq
+        return
+      last_write = time.monotonic()
+      while True:
+        seq, payload = event_batch(seq)
+        if not payload and time.monotonic() - last_write >= SSE_HEARTBEAT_SECONDS:
+          payload = b": ping\n\n"
+        if payload:
+          self.wfile.write(payload)
+          self.wfile.flush()
+          last_write = time.monotonic()
+        CATALOG.wait_for_change(seq, SSE_HEARTBEAT_SECONDS)
+    except (BrokenPipeError, ConnectionResetError, OSError):
+      self.close_connection = True
+
+  def search_files(self) -> None:
+    if not self._require_auth():
+      return
+    etag = self.catalog_etag()
+    if self.send_not_modified(etag):
+      return
+    if self.command == "GET":
+      params = self.query_params()
+      q = params.get("q", "")
+    else:
+      params = read_json_body(self)
+      q = params.get("query", "")
+    q = str(q).strip().lower()
+    if params.get("mode") == "ranked":
+      self.ranked_search(q, params, etag)
+      return
+    if not q:
+      self.list_files(params)
+      return
+    fields = parse_fields(params.get("fields"))
+    entries = CATALOG.search(q)
+    send_json_stream(self, 200, {}, (entry.fragment(fields) for entry in entries), etag)
+
+  def ranked_search(self, q: str, params: dict, etag: str | None = None) -> None:
+    limit = parse_int(params.get("limit"), SEARCH_DEFAULT_LIMIT, 1, SEARCH_MAX_LIMIT, "limit")
+    offset = parse_int(params.get("offset"), 0, 0, 1_000_000, "offset")
+    terms = tokenize(q)
+    total, hits = CATALOG.rank(q, limit, offset)
+    files = []
+    for entry, score in hits:
+      snippet, highlights, matches = make_snippet(entry.content, terms)
+      files.append({
+        "name": entry.name,
+        "modified": entry.modified,
+        "score": round(score, 4),
+        "snippet": snippet,
+        "highlights": highlights,
+        "matches": matches,
+      })
+    send_json(self, 200, {"files": files, "total": total, "limit": limit, "offset": offset}, etag)
+
+  def create_file(self) -> None:
+    if not self._require_auth():
+      return
+    payload = read_json_body(self)
+    name = sanitize_name(payload.get("name", ""))
+    content = payload.get("content", "")
+    store = current_store()
+    with CATALOG.write_locks([name]):
+      if store.exists(name):
+        raise ValueError("file already exists")
+      store.write(name, str(content))
+      entry = CATALOG.record_write(name, str(content))
+    send_json(self, 201, {"status": "created", "name": name, "version": entry.version})
+
+  def update_file(self) -> None:
+    if not self._require_auth():
+      return
+    payload = read_json_body(self)
+    name = sanitize_name(payload.get("name", ""))
+    content = payload.get("content", "")
+    store = current_store()
+    with CATALOG.write_locks([name]):
+      if not store.exists(name):
+        raise ValueError("file not found")
+      store.write(name, str(content))
+      entry = CATALOG.record_write(name, str(content))
+    send_json(self, 200, {"status": "updated", "name": name, "version": entry.version})
+
+  # Applies splice/append operations to the note as of `base_version` (the
+  # `version` from get_file or the last save); 409 if it has changed since.
+  def patch_file(self) -> None:
+    if not self._require_auth():
+      return
+    payload = read_json_body(self)
+    name = sanitize_name(payload.get("name", ""))
+    base_version = payload.get("base_version")
+    if not isinstance(base_version, str):
+      raise ValueError("base_version is required")
+    with CATALOG.write_locks([name]):
+      entry = CATALOG.get(name)
+      if entry is None:
+        raise ValueError("file not found")
+      if entry.version != base_version:
+        send_json(self, 409, {"error": "version conflict", "name": name, "version": entry.version})
+        return
+      content = normalize_newlines(apply_text_ops(entry.content, payload.get("ops")))
+      current_store().write(name, content)
+      entry = CATALOG.record_write(name, content)
+    send_json(self, 200, {"status": "patched", "name": name, "version": entry.version})
+
+  def delete_file(self) -> None:
+    if not self._require_auth():
+      return
+    payload = read_json_body(self)
+    name = sanitize_name(payload.get("name", ""))
+    store = current_store()
+    with CATALOG.write_locks([name]):
+      if not store.exists(name):
+        raise ValueError("file not found")
+      store.delete(name)
+      CATALOG.record_delete(name)
+    send_json(self, 200, {"status": "deleted", "name": name})
+
+  # Applies an ordered list of create/update/delete/rename operations with one
+  # auth check and one body parse. Every op is validated against the state the
+  # earlier ones leave behind before anything is written, with all the notes
+  # involved locked, so an invalid batch fails whole with a 400. A storage
+  # error part way keeps the ops before it, as separate requests would, and
+  # the answer lists them.
+  def batch(self) -> None:
+    if not self._require_auth():
+      return
+    ops = read_json_body(self).get("ops")
+    if not isinstance(ops, list) or not ops or len(ops) > BATCH_MAX_OPS:
+      raise ValueError(f"ops must be a list of 1 to {BATCH_MAX_OPS} operations")
+    plan = []
+    for i, op in enumerate(ops):
+      kind = op.get("op") if isinstance(op, dict) else None
+      if kind not in BATCH_OPS:
+        raise ValueError(f"op {i}: op must be one of {', '.join(BATCH_OPS)}")
+      try:
+        name = sanitize_name(op.get("name", ""))
+        arg = sanitize_name(op.get("new_name", "")) if kind == "rename" else str(op.get("content", ""))
+      except ValueError as exc:
+        raise ValueError(f"op {i}: {exc}") from None
+      plan.append((kind, name, arg))
+    names = {name for _, name, _ in plan} | {arg for kind, _, arg in plan if kind == "rename"}
+    store = current_store()
+    results = []
+    with CATALOG.write_locks(names):
+      exists = {name: store.exists(name) for name in names}
+      for i, (kind, name, arg) in enumerate(plan):
+        if kind == "create" and exists[name]:
+          raise ValueError(f"op {i}: file already exists")
+        if kind != "create" and not exists[name]:
+          raise ValueError(f"op {i}: file not found")
+        if kind == "rename" and exists[arg]:
+          raise ValueError(f"op {i}: {arg} already exists")
+        exists[name] = kind in ("create", "update")
+        if kind == "rename":
+          exists[arg] = True
+      try:
+        with store.batch():
+          for kind, name, arg in plan:
+            if kind == "delete":
+              store.delete(name)
+              CATALOG.record_delete(name)
+              results.append({"op": kind, "name": name})
+            elif kind == "rename":
+              store.rename(name, arg)
+              entry = CATALOG.record_rename(name, arg)
+              results.append({"op": kind, "name": arg, "old_name": name, "version": entry.version})
+            else:
+              store.write(name, arg)
+              entry = CATALOG.record_write(name, arg)
+              results.append({"op": kind, "name": name, "version": entry.version})
+      except OSError as exc:
+        full = exc.errno in (errno.ENOSPC, errno.EDQUOT)
+        if len(results) < len(plan):
+          error = f"op {len(results)}: could not store the note; the ops before it were applied"
+        else:
+          error = "all ops were applied but could not be synced to disk"
+        send_json(self, 507 if full else 500, {"status": "partial", "error": error, "results": results})
+        return
+    send_json(self, 200, {"status": "ok", "results": results})
+
+
+def save_snapshot(path: Path) -> None:
+    try:
+        CATALOG.save_snapshot(path)
+    except OSError as exc:
+        print(f"Could not write snapshot {path}: {exc}", flush=True)
+
+
+def snapshot_periodically(path: Path) -> None:
+    CATALOG.ready.wait()
+    saved = CATALOG.current_seq()
+    while True:
+        time.sleep(SNAPSHOT_SECONDS)
+        seq = CATALOG.current_seq()
+        if seq != saved:
+            save_snapshot(path)
+            saved = seq
+
+
+# One thread per process follows the journal and wakes the event streams
+# waiting on the catalog, instead of every stream polling it. In the pre-fork
+# parent it is also what notices changes made behind the server's back.
+def poll_journal() -> None:
+    while True:
+        time.sleep(JOURNAL_POLL_SECONDS)
+        try:
+            CATALOG.refresh()
+        except OSError as exc:
+            print(f"Could not follow the change journal: {exc}", flush=True)
+
+
+# Pre-fork mode: the parent binds once, forks `processes` workers that serve
+# the inherited socket, and restarts any worker that exits until it is told to
+# stop. Workers keep their in-memory catalogs in step through a ChangeJournal;
+# the parent alone rescans the store and records outside changes there.
+def serve_prefork(address: tuple[str, int], engine: str, workers: int, backlog: int, processes: int) -> None:
+    sock = socket.create_server(address, backlog=backlog)
+    # Idle workers must not block in accept() after another one won the race.
+    sock.setblocking(False)
+    ChangeJournal.reset(DATA_DIR, CATALOG.current_seq())
+    CATALOG.attach_journal(ChangeJournal(DATA_DIR))
+    threading.Thread(target=poll_journal, name="journal", daemon=True).start()
+    children: dict[int, float] = {}
+    stopping = False
+
+    def spawn() -> None:
+        with CATALOG.held():
+            pid = os.fork()
+        if pid:
+            children[pid] = time.monotonic()
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            CATALOG.attach_journal(ChangeJournal(DATA_DIR), follow=True)
+            threading.Thread(target=poll_journal, name="journal", daemon=True).start()
+            with make_server(address, engine, workers, backlog, sock=sock) as httpd:
+                try:
+                    httpd.serve_forever()
+                except KeyboardInterrupt:
+                    pass
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            LOGGER.close()
+            os._exit(code)
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(processes):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(f"worker {pid} exited with status {status}; restarting", flush=True)
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        spawn()
+    sock.close()
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Minimal notes server")
+  parser.add_argument("--config", "-c", type=str, default=None, help="Path to JSON config file")
+  parser.add_argument("--port", "-p", type=int, default=None, help="Port to bind (default: 8000)")
+  parser.add_argument("--password", "-w", type=str, default=None, help="Password required via X-Password header")
+  parser.add_argument(
+    "--log-retention-hours",
+    type=int,
+    default=None,
+    help=f"Hours to keep rotated logs (default: {DEFAULT_LOG_RETENTION_HOURS})",
+  )
+  parser.add_argument(
+    "--engine",
+    choices=ENGINES,
+    default=None,
+    help=f"Server engine: a thread per connection, a fixed worker pool or an asyncio loop (default: {DEFAULT_ENGINE})",
+  )
+  parser.add_argument(
+    "--workers",
+    type=int,
+    default=None,
+    help=f"Worker threads for the pool and asyncio engines (default: {DEFAULT_WORKERS})",
+  )
+  parser.add_argument(
+    "--backlog",
+    type=int,
+    default=None,
+    help=f"Listen backlog, and accepted connections the pool engine queues before answering 503 (default: {DEFAULT_BACKLOG})",
+  )
+  parser.add_argument(
+    "--processes",
+    type=int,
+    default=None,
+    help=f"Pre-forked worker processes sharing the listening socket (default: {DEFAULT_PROCESSES})",
+  )
+  parser.add_argument(
+    "--storage",
+    choices=STORAGES,
+    default=None,
+    help=f"Note storage: a .txt file per note in data/, one SQLite database or an append-only segment log (default: {DEFAULT_STORAGE})",
+  )
+  parser.add_argument(
+    "--sqlite-path",
+    type=str,
+    default=None,
+    help=f"SQLite database for --storage sqlite (default: data/{SQLITE_NAME})",
+  )
+  parser.add_argument(
+    "--layout",
+    choices=LAYOUTS,
+    default=None,
+    help=f"Where files storage puts notes: all in data/, or fanned out as data/ab/cd/<name> with a manifest (default: {DEFAULT_LAYOUT})",
+  )
+  parser.add_argument(
+    "--durability",
+    choices=DURABILITY_MODES,
+    default=None,
+    help=f"When a write to files or log storage is on disk: left to the OS, group-committed with other writes, or fsynced every time (default: {DEFAULT_DURABILITY})",
+  )
+  parser.add_argument(
+    "--write-back",
+    action="store_true",
+    default=None,
+    help=f"Acknowledge saves from memory and write them out every {WRITE_BACK_SECONDS:g}s, coalescing repeated saves",
+  )
+  parser.add_argument(
+    "--cache-mb",
+    type=int,
+    default=None,
+    help=f"Memory for cached note texts in MB; 0 reads every note from storage (default: {DEFAULT_CACHE_MB})",
+  )
+  parser.add_argument(
+    "--cache-compress",
+    action="store_true",
+    default=None,
+    help="Keep the colder half of the note cache zlib-compressed so more notes fit",
+  )
+  parser.add_argument(
+    "--max-body-mb",
+    type=int,
+    default=None,
+    help=f"Largest JSON request body in MB; bigger ones get 413 (default: {DEFAULT_MAX_BODY_MB})",
+  )
+  parser.add_argument(
+    "--max-upload-mb",
+    type=int,
+    default=None,
+    help=f"Largest PUT /raw/ upload in MB; bigger ones get 413 (default: {DEFAULT_MAX_UPLOAD_MB})",
+  )
+  parser.add_argument(
+    "--migrate",
+    action="store_true",
+    help="Copy the notes in data/*.txt into the configured storage, or move them into the sharded layout, and exit",
+  )
+  args = parser.parse_args()
+
+  config = load_config(args.config)
+
+  port = config.get("port") if isinstance(config.get("port"), int) else None
+  if args.port is not None:
+    port = args.port
+  if port is None:
+    port = DEFAULT_PORT
+
+  password = config.get("password", "") if isinstance(config, dict) else ""
+  if args.password is not None:
+    password = args.password
+
+  log_hours = config.get("log_retention_hours") if isinstance(config, dict) else None
+  if args.log_retention_hours is not None:
+    log_hours = args.log_retention_hours
+  if not isinstance(log_hours, int) or log_hours <= 0:
+    log_hours = DEFAULT_LOG_RETENTION_HOURS
+
+  engine = config.get("engine") if isinstance(config, dict) else None
+  if args.engine is not None:
+    engine = args.engine
+  if engine not in ENGINES:
+    engine = DEFAULT_ENGINE
+
+  workers = config.get("workers") if isinstance(config, dict) else None
+  if args.workers is not None:
+    workers = args.workers
+  if not isinstance(workers, int) or workers <= 0:
+    workers = DEFAULT_WORKERS
+
+  backlog = config.get("backlog") if isinstance(config, dict) else None
+  if args.backlog is not None:
+    backlog = args.backlog
+  if not isinstance(backlog, int) or backlog <= 0:
+    backlog = DEFAULT_BACKLOG
+
+  processes = config.get("processes") if isinstance(config, dict) else None
+  if args.processes is not None:
+    processes = args.processes
+  if not isinstance(processes, int) or processes <= 0:
+    processes = DEFAULT_PROCESSES
+  if processes > 1 and (not hasattr(os, "fork") or fcntl is None):
+    parser.error("--processes needs os.fork() and fcntl (POSIX only)")
+
+  storage = config.get("storage") if isinstance(config, dict) else None
+  if args.storage is not None:
+    storage = args.storage
+  if storage not in STORAGES:
+    storage = DEFAULT_STORAGE
+  if storage == "sqlite" and sqlite3 is None:
+    parser.error("--storage sqlite needs Python's sqlite3 module")
+  if storage == "log" and processes > 1:
+    parser.error("--storage log keeps its index in one process; it cannot be used with --processes")
+
+  sqlite_path = config.get("sqlite_path") if isinstance(config, dict) else None
+  if args.sqlite_path is not None:
+    sqlite_path = args.sqlite_path
+  if not isinstance(sqlite_path, str) or not sqlite_path:
+    sqlite_path = None
+
+  layout = config.get("layout") if isinstance(config, dict) else None
+  if args.layout is not None:
+    layout = args.layout
+  if layout not in LAYOUTS:
+    layout = DEFAULT_LAYOUT
+
+  durability = config.get("durability") if isinstance(config, dict) else None
+  if args.durability is not None:
+    durability = args.durability
+  if durability not in DURABILITY_MODES:
+    durability = DEFAULT_DURABILITY
+
+  write_back = config.get("write_back") if isinstance(config, dict) else None
+  if args.write_back is not None:
+    write_back = args.write_back
+  write_back = write_back is True
+  if write_back and processes > 1:
+    parser.error("--write-back buffers saves in one process; it cannot be used with --processes")
+
+  cache_mb = config.get("cache_mb") if isinstance(config, dict) else None
+  if args.cache_mb is not None:
+    cache_mb = args.cache_mb
+  if not isinstance(cache_mb, int) or cache_mb < 0:
+    cache_mb = DEFAULT_CACHE_MB
+
+  cache_compress = config.get("cache_compress") if isinstance(config, dict) else None
+  if args.cache_compress is not None:
+    cache_compress = args.cache_compress
+  cache_compress = cache_compress is True
+
+  max_body_mb = config.get("max_body_mb") if isinstance(config, dict) else None
+  if args.max_body_mb is not None:
+    max_body_mb = args.max_body_mb
+  if not isinstance(max_body_mb, int) or max_body_mb <= 0:
+    max_body_mb = DEFAULT_MAX_BODY_MB
+
+  max_upload_mb = config.get("max_upload_mb") if isinstance(config, dict) else None
+  if args.max_upload_mb is not None:
+    max_upload_mb = args.max_upload_mb
+  if not isinstance(max_upload_mb, int) or max_upload_mb <= 0:
+    max_upload_mb = DEFAULT_MAX_UPLOAD_MB
+
+  global PASSWORD, LOG_RETENTION_HOURS, STORAGE, SQLITE_PATH, DURABILITY, LAYOUT, WRITE_BACK, CONTENT_CACHE
+  global MAX_BODY_BYTES, MAX_UPLOAD_BYTES
+  MAX_BODY_BYTES = max_body_mb * 1024 * 1024
+  MAX_UPLOAD_BYTES = max_upload_mb * 1024 * 1024
+  CONTENT_CACHE = ContentCache(cache_mb * 1024 * 1024, cache_compress)
+  PASSWORD = password or ""
+  LOG_RETENTION_HOURS = log_hours
+  STORAGE = storage
+  DURABILITY = durability
+  LAYOUT = layout
+  SQLITE_PATH = Path(sqlite_path) if sqlite_path else None
+
+  if args.migrate:
+    if storage == "files" and layout == "sharded":
+      count = migrate_layout(current_store())
+      print(f"Moved {count} notes into the sharded layout")
+      return
+    if storage == "files":
+      parser.error("--migrate copies data/*.txt into another --storage or --layout sharded")
+    count = migrate_notes(FileStore(DATA_DIR), current_store())
+    print(f"Migrated {count} notes into {storage} storage")
+    return
+
+  WRITE_BACK = write_back
+  # Flat notes left over from before --layout sharded move while the server
+  # runs; pre-forked workers would not see the flat set shrink, so there the
+  # move happens before they start.
+  store = current_store()
+  sharded = store.inner if isinstance(store, WriteBackStore) else store
+  if isinstance(sharded, ShardedFileStore) and sharded.flat:
+    if processes > 1:
+      print(f"Moved {migrate_layout(sharded)} notes into the sharded layout", flush=True)
+    else:
+      threading.Thread(target=migrate_layout, args=(sharded,), name="layout-migration", daemon=True).start()
+
+  host = "0.0.0.0"
+  snapshot = DATA_DIR / SNAPSHOT_NAME
+  if processes > 1:
+    # Workers fork from a warm catalog. Their writes reach the parent's copy
+    # through the journal.
+    CATALOG.warm_up(snapshot)
+    print(f"Serving on http://{host}:{port} ({engine} engine, {processes} processes)", flush=True)
+    serve_prefork((host, port), engine, workers, backlog, processes)
+    save_snapshot(snapshot)
+    return
+  # Requests see the catalog as loaded so far until warm-up finishes; /ready
+  # says when it has.
+  CATALOG.ready.clear()
+  threading.Thread(target=CATALOG.warm_up, args=(snapshot,), name="warm-up", daemon=True).start()
+  threading.Thread(target=snapshot_periodically, args=(snapshot,), name="snapshot", daemon=True).start()
+  # SIGTERM unwinds like Ctrl-C so buffered saves are flushed before exit.
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+  with make_server((host, port), engine, workers, backlog) as httpd:
+    print(f"Serving on http://{host}:{port} ({engine} engine)")
+    try:
+      httpd.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      store = current_store()
+      if isinstance(store, WriteBackStore):
+        store.flush()
+      if CATALOG.ready.is_set():
+        save_snapshot(snapshot)
 
 
 if __name__ == "__main__":
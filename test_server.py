@@ -1,6 +1,17 @@
+import contextlib
+import errno
+import gzip
+import hashlib
+import io
 import json
+import os
+import random
+import socket
+import string
+import sys
 import threading
 import tempfile
+import time
 import unittest
 from http.client import HTTPConnection
 from http.server import ThreadingHTTPServer
@@ -10,6 +21,8 @@ import server
 
 
 class NotesServerTests(unittest.TestCase):
+    engine = "threading"
+
     def setUp(self) -> None:
         self.data_dir = tempfile.TemporaryDirectory()
         self.log_dir = tempfile.TemporaryDirectory()
@@ -17,7 +30,7 @@ class NotesServerTests(unittest.TestCase):
         server.LOG_DIR = Path(self.log_dir.name)
         server.DATA_DIR.mkdir(exist_ok=True)
         server.LOG_DIR.mkdir(exist_ok=True)
-        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.Handler)
+        self.httpd = server.make_server(("127.0.0.1", 0), engine=self.engine)
         self.port = self.httpd.server_address[1]
         self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
         self.thread.start()
@@ -26,6 +39,7 @@ class NotesServerTests(unittest.TestCase):
         self.httpd.shutdown()
         self.httpd.server_close()
         self.thread.join(timeout=2)
+        server.LOGGER.flush()
         self.data_dir.cleanup()
         self.log_dir.cleanup()
 
@@ -47,6 +61,78 @@ class NotesServerTests(unittest.TestCase):
         conn.close()
         return resp.status, json.loads(body)
 
+    def test_index_is_gzipped_and_revalidated(self) -> None:
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/", headers={"Accept-Encoding": "br, gzip;q=0.8"})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.decompress(resp.read()).decode("utf-8"), server.HTML_PAGE)
+        etag = resp.getheader("ETag")
+
+        conn.request("GET", "/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        resp = conn.getresponse()
+        self.assertEqual((resp.status, resp.read()), (304, b""))
+
+        conn.request("GET", "/", headers={"Accept-Encoding": "gzip;q=0", "If-None-Match": etag})
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertIsNone(resp.getheader("Content-Encoding"))
+        self.assertEqual(resp.read(), server.HTML_PAGE.encode("utf-8"))
+        conn.close()
+
+    def test_list_files_revalidates_and_compresses(self) -> None:
+        self.api_post("/create_file", {"name": "big", "content": "lorem ipsum " * 500})
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/list_files", headers={"Accept-Encoding": "gzip"})
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader("Content-Encoding"), "gzip")
+        body = json.loads(gzip.decompress(resp.read()))
+        self.assertEqual(body["files"][0]["name"], "big.txt")
+        etag = resp.getheader("ETag")
+
+        conn.request("GET", "/list_files", headers={"If-None-Match": etag})
+        resp = conn.getresponse()
+        self.assertEqual((resp.status, resp.read()), (304, b""))
+        conn.request("GET", "/list_files?fields=meta", headers={"If-None-Match": etag})
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertIsNone(resp.getheader("Content-Encoding"))
+        resp.read()
+        conn.close()
+
+        self.api_post("/update_file", {"name": "big.txt", "content": "short"})
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/list_files", headers={"If-None-Match": etag})
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(resp.read())["files"][0]["content"], "short")
+        self.assertNotEqual(resp.getheader("ETag"), etag)
+        conn.close()
+
+    def test_list_files_is_streamed(self) -> None:
+        for i in range(3):
+            self.api_post("/create_file", {"name": f"s{i}", "content": "é" * 30000})
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/list_files?limit=2")
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader("Transfer-Encoding"), "chunked")
+        body = json.loads(resp.read())
+        self.assertEqual([len(item["content"]) for item in body["files"]], [30000, 30000])
+        self.assertEqual(body["total"], 3)
+        conn.close()
+
+        entry = server.CATALOG.get("s0.txt")
+        self.assertIs(entry.fragment("meta"), entry.fragment("meta"))
+
+        with socket.create_connection(("127.0.0.1", self.port), timeout=5) as sock:
+            sock.sendall(b"GET /list_files?fields=meta HTTP/1.0\r\n\r\n")
+            raw = b""
+            while chunk := sock.recv(65536):
+                raw += chunk
+        head, _, payload = raw.partition(b"\r\n\r\n")
+        self.assertNotIn(b"chunked", head)
+        self.assertEqual(len(json.loads(payload)["files"]), 3)
+
     def test_create_and_list_files(self) -> None:
         status, body = self.api_post("/create_file", {"name": "note1", "content": "hello"})
         self.assertEqual(status, 201)
@@ -58,6 +144,107 @@ class NotesServerTests(unittest.TestCase):
         self.assertEqual(body["files"][0]["name"], "note1.txt")
         self.assertEqual(body["files"][0]["content"], "hello")
 
+    def test_paginated_listing_and_get_file(self) -> None:
+        for i in range(5):
+            self.api_post("/create_file", {"name": f"page{i}", "content": "x" * 400})
+            os.utime(server.DATA_DIR / f"page{i}.txt", ns=(i * 10**9, i * 10**9))
+        server.CATALOG.refresh(force=True)
+
+        status, body = self.api_get("/list_files?limit=2&fields=meta")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["total"], 5)
+        self.assertEqual([item["name"] for item in body["files"]], ["page4.txt", "page3.txt"])
+        self.assertNotIn("content", body["files"][0])
+
+        names = [item["name"] for item in body["files"]]
+        while body["next_cursor"]:
+            cursor = body["next_cursor"]
+            status, body = self.api_get(f"/list_files?limit=2&fields=preview&cursor={cursor}")
+            names += [item["name"] for item in body["files"]]
+        self.assertEqual(names, [f"page{i}.txt" for i in range(4, -1, -1)])
+        self.assertEqual(len(body["files"][0]["preview"]), server.PREVIEW_CHARS)
+        self.assertTrue(body["files"][0]["truncated"])
+
+        status, body = self.api_get("/get_file?name=page1")
+        self.assertEqual(status, 200)
+        self.assertEqual(body["content"], "x" * 400)
+        status, body = self.api_get("/get_file?name=missing")
+        self.assertEqual(status, 404)
+
+    def test_since_returns_only_changes_with_tombstones(self) -> None:
+        self.api_post("/create_file", {"name": "keep", "content": "a"})
+        self.api_post("/create_file", {"name": "gone", "content": "b"})
+        status, body = self.api_get("/list_files?limit=10")
+        seq = body["seq"]
+
+        self.api_post("/update_file", {"name": "keep.txt", "content": "a2"})
+        self.api_post("/delete_file", {"name": "gone"})
+        self.api_post("/create_file", {"name": "new", "content": "c"})
+
+        status, body = self.api_get(f"/list_files?since={seq}")
+        self.assertEqual(status, 200)
+        self.assertFalse(body["reset"])
+        self.assertEqual(body["total"], 2)
+        changes = [(c["op"], c["name"], c.get("content")) for c in body["changes"]]
+        self.assertEqual(changes, [("update", "keep.txt", "a2"), ("delete", "gone.txt", None), ("create", "new.txt", "c")])
+
+        status, body = self.api_get(f"/list_files?since={body['seq']}")
+        self.assertEqual(body["changes"], [])
+        status, body = self.api_get("/list_files?since=1")
+        self.assertTrue(body["reset"])
+
+    def test_events_stream_pushes_changes(self) -> None:
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/events")
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.getheader("Content-Type"), "text/event-stream")
+        self.assertEqual(resp.readline(), b"retry: 3000\n")
+
+        self.api_post("/create_file", {"name": "pushed", "content": "hi"})
+        lines = []
+        while not lines or lines[-1] != b"\n" or not any(l.startswith(b"data:") for l in lines):
+            lines.append(resp.readline())
+        conn.close()
+        self.assertIn(b"event: change\n", lines)
+        data = json.loads(next(l for l in lines if l.startswith(b"data:"))[5:])
+        self.assertEqual((data["op"], data["name"], data["preview"]), ("create", "pushed.txt", "hi"))
+
+        # Subscribers at the same cursor share one encoded frame.
+        seq = data["seq"] - 1
+        first = server.event_batch(seq)
+        self.assertIs(server.event_batch(seq), first)
+        self.api_post("/update_file", {"name": "pushed.txt", "content": "changed"})
+        self.assertIsNot(server.event_batch(seq), first)
+        self.assertIn(b"changed", server.event_batch(seq)[1])
+
+    def test_events_authenticate_with_a_token_kept_out_of_logs(self) -> None:
+        server.PASSWORD = "s3cret-pw"
+        try:
+            def events(query: str) -> int:
+                conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+                conn.request("GET", "/events?" + query)
+                status = conn.getresponse().status
+                conn.close()
+                return status
+
+            self.assertEqual(events("password=s3cret-pw"), 401)
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            conn.request("POST", "/events_token", body=b"{}", headers={"X-Password": "s3cret-pw"})
+            token = json.loads(conn.getresponse().read())["token"]
+            conn.close()
+            self.assertEqual(events("since=0&token=" + token), 200)
+            self.assertEqual(events("token=" + token.replace(".", ".0")), 401)
+            expired = str(int(time.time()) - 1)
+            self.assertFalse(server.check_events_token(expired + token[token.index("."):]))
+        finally:
+            server.PASSWORD = ""
+        server.LOGGER.flush()
+        logged = "".join(p.read_text(encoding="utf-8") for p in server.LOG_DIR.glob("*.log"))
+        self.assertIn('"GET /events HTTP/1.1" 200', logged)
+        self.assertNotIn("s3cret-pw", logged)
+        self.assertNotIn(token.partition(".")[2], logged)
+
     def test_search_files_by_name_and_content(self) -> None:
         self.api_post("/create_file", {"name": "alpha", "content": "first"})
         self.api_post("/create_file", {"name": "beta", "content": "second target"})
@@ -72,6 +259,39 @@ class NotesServerTests(unittest.TestCase):
         names = sorted(item["name"] for item in body["files"])
         self.assertEqual(names, ["beta.txt"])
 
+    def test_search_substrings_follow_updates(self) -> None:
+        self.api_post("/create_file", {"name": "Runbook", "content": "Restart the QUEUE worker"})
+
+        for query in ("ue", "queue wor", "RUNB", "k.t"):
+            status, body = self.api_post("/search_files", {"query": query})
+            self.assertEqual(status, 200)
+            self.assertEqual([item["name"] for item in body["files"]], ["Runbook.txt"], query)
+
+        self.api_post("/update_file", {"name": "Runbook.txt", "content": "nothing here"})
+        status, body = self.api_post("/search_files", {"query": "queue"})
+        self.assertEqual(body["files"], [])
+
+    def test_ranked_search_returns_top_hits_with_snippets(self) -> None:
+        self.api_post("/create_file", {"name": "deploy", "content": "how to roll back"})
+        self.api_post("/create_file", {"name": "misc", "content": "deploy once, then deploy again"})
+        self.api_post("/create_file", {"name": "other", "content": "unrelated"})
+
+        status, body = self.api_post("/search_files", {"query": "Deploy", "mode": "ranked", "limit": 1})
+        self.assertEqual(status, 200)
+        self.assertEqual(body["total"], 2)
+        self.assertEqual([item["name"] for item in body["files"]], ["deploy.txt"])
+        self.assertNotIn("content", body["files"][0])
+
+        status, body = self.api_get("/search_files?q=deploy&mode=ranked&limit=1&offset=1")
+        hit = body["files"][0]
+        self.assertEqual(hit["name"], "misc.txt")
+        self.assertEqual(hit["matches"], [[0, 6], [18, 24]])
+        start, end = hit["highlights"][0]
+        self.assertEqual(hit["snippet"][start:end], "deploy")
+
+        status, body = self.api_get("/search_files?q=x&mode=ranked&limit=zero")
+        self.assertEqual(status, 400)
+
     def test_update_file(self) -> None:
         self.api_post("/create_file", {"name": "note2", "content": "old"})
 
@@ -83,6 +303,207 @@ class NotesServerTests(unittest.TestCase):
         self.assertEqual(status, 200)
         self.assertEqual(body["files"][0]["content"], "new")
 
+    def test_patch_file_applies_ops_and_rejects_stale_versions(self) -> None:
+        status, body = self.api_post("/create_file", {"name": "runbook", "content": "step 😀 one\nstep two"})
+        version = body["version"]
+        self.assertEqual(self.api_get("/get_file?name=runbook")[1]["version"], version)
+
+        ops = [
+            {"op": "splice", "offset": 8, "delete": 3, "insert": "ONE"},
+            {"op": "append", "text": "\nstep three"},
+        ]
+        status, body = self.api_post("/patch_file", {"name": "runbook.txt", "base_version": version, "ops": ops})
+        self.assertEqual(status, 200)
+        self.assertEqual(body["status"], "patched")
+        self.assertNotEqual(body["version"], version)
+        self.assertEqual(self.api_get("/get_file?name=runbook")[1]["content"], "step 😀 ONE\nstep two\nstep three")
+
+        status, body = self.api_post("/patch_file", {"name": "runbook.txt", "base_version": version, "ops": ops})
+        self.assertEqual(status, 409)
+        current = self.api_get("/get_file?name=runbook")[1]["version"]
+        self.assertEqual(body["version"], current)
+
+        # The last one splits the surrogate pair of the emoji.
+        for bad in ([], [{"op": "splice", "offset": 999, "delete": 0}], [{"op": "splice", "offset": 6, "delete": 0, "insert": "x"}]):
+            status, body = self.api_post("/patch_file", {"name": "runbook", "base_version": current, "ops": bad})
+            self.assertEqual(status, 400, bad)
+        status, body = self.api_post("/patch_file", {"name": "missing", "base_version": "0", "ops": ops})
+        self.assertEqual(status, 400)
+
+    def test_batch_applies_ops_in_order_or_not_at_all(self) -> None:
+        self.api_post("/create_file", {"name": "old", "content": "keep me"})
+        status, body = self.api_get("/list_files?limit=10")
+        seq = body["seq"]
+        ops = [
+            {"op": "create", "name": "a", "content": "first"},
+            {"op": "create", "name": "b", "content": "second"},
+            {"op": "update", "name": "a.txt", "content": "first, edited"},
+            {"op": "rename", "name": "old", "new_name": "new"},
+            {"op": "delete", "name": "b"},
+        ]
+        status, body = self.api_post("/batch", {"ops": ops})
+        self.assertEqual(status, 200)
+        self.assertEqual([(r["op"], r["name"]) for r in body["results"]], [
+            ("create", "a.txt"), ("create", "b.txt"), ("update", "a.txt"), ("rename", "new.txt"), ("delete", "b.txt"),
+        ])
+        self.assertEqual(body["results"][3]["old_name"], "old.txt")
+        self.assertEqual(sorted(p.name for p in server.DATA_DIR.glob("*.txt")), ["a.txt", "new.txt"])
+        self.assertEqual(self.api_get("/get_file?name=new")[1]["content"], "keep me")
+        self.assertEqual(self.api_get("/get_file?name=a")[1]["content"], "first, edited")
+
+        status, body = self.api_get(f"/list_files?since={seq}")
+        changes = {item["name"]: item for item in body["changes"]}
+        self.assertEqual(changes["new.txt"]["op"], "rename")
+        self.assertEqual(changes["new.txt"]["old_name"], "old.txt")
+
+        status, body = self.api_post("/batch", {"ops": [
+            {"op": "create", "name": "c", "content": "never written"},
+            {"op": "rename", "name": "a", "new_name": "new"},
+        ]})
+        self.assertEqual(status, 400)
+        self.assertEqual(body["error"], "op 1: new.txt already exists")
+        self.assertFalse((server.DATA_DIR / "c.txt").exists())
+        status, body = self.api_post("/batch", {"ops": [{"op": "move", "name": "a"}]})
+        self.assertEqual(status, 400)
+
+        # A storage failure part way is reported with the ops already applied.
+        store = server.current_store()
+
+        def full_disk(name, new_name):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        store.rename = full_disk
+        try:
+            status, body = self.api_post("/batch", {"ops": [
+                {"op": "create", "name": "d", "content": "kept"},
+                {"op": "rename", "name": "a", "new_name": "e"},
+            ]})
+        finally:
+            del store.rename
+        self.assertEqual((status, body["status"]), (507, "partial"))
+        self.assertTrue(body["error"].startswith("op 1:"))
+        self.assertEqual([r["name"] for r in body["results"]], ["d.txt"])
+        self.assertEqual(self.api_get("/get_file?name=d")[1]["content"], "kept")
+
+    def test_raw_file_serves_ranges_and_validators(self) -> None:
+        body = "0123456789" * 1000 + "\r\nend"
+        self.api_post("/create_file", {"name": "big", "content": "x"})
+        (server.DATA_DIR / "big.txt").write_bytes(body.encode("utf-8"))
+
+        def raw(method: str, headers: dict | None = None):
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            conn.request(method, "/raw/big.txt", headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+            conn.close()
+            return resp, data
+
+        resp, data = raw("GET")
+        self.assertEqual((resp.status, data), (200, body.encode("utf-8")))
+        etag = resp.getheader("ETag")
+        self.assertEqual(resp.getheader("Accept-Ranges"), "bytes")
+        resp, data = raw("GET", {"Range": "bytes=5-14"})
+        self.assertEqual((resp.status, data), (206, b"5678901234"))
+        self.assertEqual(resp.getheader("Content-Range"), f"bytes 5-14/{len(body)}")
+        resp, data = raw("GET", {"Range": "bytes=-3"})
+        self.assertEqual(data, b"end")
+        resp, data = raw("GET", {"Range": f"bytes={len(body)}-"})
+        self.assertEqual(resp.status, 416)
+        resp, data = raw("GET", {"Range": "bytes=0-1", "If-Range": '"stale"'})
+        self.assertEqual(resp.status, 200)
+        resp, data = raw("GET", {"If-None-Match": etag})
+        self.assertEqual((resp.status, data), (304, b""))
+        resp, data = raw("GET", {"If-Modified-Since": resp.getheader("Last-Modified")})
+        self.assertEqual(resp.status, 304)
+        resp, data = raw("HEAD")
+        self.assertEqual((resp.status, data), (200, b""))
+        self.assertEqual(resp.getheader("Content-Length"), str(len(body)))
+        resp, data = raw("HEAD", {"Range": "bytes=0-0"})
+        self.assertEqual((resp.status, resp.getheader("Content-Length")), (206, "1"))
+        status, _ = self.api_get("/raw/missing.txt")
+        self.assertEqual(status, 404)
+
+        server.STORAGE = "log"
+        try:
+            self.api_post("/create_file", {"name": "logged", "content": "stored in a segment"})
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            conn.request("GET", "/raw/logged.txt", headers={"Range": "bytes=10-"})
+            resp = conn.getresponse()
+            self.assertEqual((resp.status, resp.read()), (206, b"a segment"))
+            conn.close()
+        finally:
+            server.STORAGE = server.DEFAULT_STORAGE
+
+    def test_put_raw_streams_and_body_limits_answer_413(self) -> None:
+        def request(method: str, path: str, body: bytes, headers: dict | None = None):
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+            conn.close()
+            return resp, json.loads(data) if data else None
+
+        chunk_bytes = server.UPLOAD_CHUNK_BYTES
+        server.UPLOAD_CHUNK_BYTES = 7
+        try:
+            body = "línea uno\r\n".encode("utf-8") * 50
+            resp, payload = request("PUT", "/raw/imported", body)
+            self.assertEqual((resp.status, payload["status"]), (201, "created"))
+            resp, payload = request("PUT", "/raw/imported.txt", body + b"tail")
+            self.assertEqual((resp.status, payload["status"], payload["size"]), (200, "updated", len(body) + 4))
+            resp, payload = request("PUT", "/raw/imported.txt", b"ok" + b"\xff" * 20)
+            self.assertEqual(resp.status, 400)
+        finally:
+            server.UPLOAD_CHUNK_BYTES = chunk_bytes
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/raw/imported.txt")
+        self.assertEqual(conn.getresponse().read(), body + b"tail")
+        conn.close()
+        status, note = self.api_get("/get_file?name=imported.txt")
+        self.assertEqual(note["content"], "línea uno\n" * 50 + "tail")
+        self.assertEqual([p.name for p in server.DATA_DIR.glob(".*.tmp")], [])
+
+        # Storage failures are answered, not dropped with the connection.
+        store = server.current_store()
+        for code, status in ((errno.ENOSPC, 507), (errno.EIO, 500)):
+            def failing(name, chunks, code=code):
+                raise OSError(code, os.strerror(code))
+
+            store.stage_stream = failing
+            try:
+                resp, payload = request("PUT", "/raw/imported.txt", b"lost")
+            finally:
+                del store.stage_stream
+            self.assertEqual((resp.status, payload["error"]), (status, "could not store the note"))
+        self.assertEqual(self.api_get("/get_file?name=imported.txt")[1]["content"], "línea uno\n" * 50 + "tail")
+
+        limits = server.MAX_BODY_BYTES, server.MAX_UPLOAD_BYTES
+        server.MAX_BODY_BYTES, server.MAX_UPLOAD_BYTES = 100, 200
+        try:
+            payload = json.dumps({"name": "huge", "content": "x" * 200}).encode("utf-8")
+            resp, error = request("POST", "/create_file", payload, {"Content-Type": "application/json"})
+            self.assertEqual((resp.status, resp.getheader("Connection")), (413, "close"))
+            self.assertIn("limit", error["error"])
+            resp, _ = request("PUT", "/raw/huge", b"x" * 201)
+            self.assertEqual(resp.status, 413)
+            resp, _ = request("PUT", "/raw/small", b"x" * 150)
+            self.assertEqual(resp.status, 201)
+
+            # A body bigger than the socket buffers is still being sent when
+            # the 413 goes out; the server must not reset the connection.
+            with socket.create_connection(("127.0.0.1", self.port), timeout=5) as sock:
+                body = b"x" * (8 * 1024 * 1024)
+                sock.sendall(f"PUT /raw/huge HTTP/1.1\r\nHost: x\r\nContent-Length: {len(body)}\r\n\r\n".encode())
+                sock.sendall(body)
+                response = b""
+                while chunk := sock.recv(65536):
+                    response += chunk
+            self.assertTrue(response.startswith(b"HTTP/1.1 413 "))
+        finally:
+            server.MAX_BODY_BYTES, server.MAX_UPLOAD_BYTES = limits
+        status, _ = self.api_get("/get_file?name=huge.txt")
+        self.assertEqual(status, 404)
+
     def test_delete_file(self) -> None:
         self.api_post("/create_file", {"name": "note3", "content": "to delete"})
 
@@ -94,6 +515,668 @@ class NotesServerTests(unittest.TestCase):
         self.assertEqual(status, 200)
         self.assertEqual(body["files"], [])
 
+    def test_list_picks_up_external_changes(self) -> None:
+        self.api_post("/create_file", {"name": "api", "content": "via api"})
+        (server.DATA_DIR / "outside.txt").write_text("dropped in", encoding="utf-8")
+
+        status, body = self.api_get("/list_files")
+        self.assertEqual(status, 200)
+        names = sorted(item["name"] for item in body["files"])
+        self.assertEqual(names, ["api.txt", "outside.txt"])
+
+        (server.DATA_DIR / "outside.txt").unlink()
+        status, body = self.api_get("/list_files")
+        self.assertEqual([item["name"] for item in body["files"]], ["api.txt"])
+
+    def test_sqlite_storage_serves_the_same_api(self) -> None:
+        (server.DATA_DIR / "legacy.txt").write_text("migrated body", encoding="utf-8")
+        os.utime(server.DATA_DIR / "legacy.txt", ns=(10**18, 10**18))
+        server.STORAGE = "sqlite"
+        try:
+            store = server.current_store()
+            self.assertEqual(server.migrate_notes(server.FileStore(server.DATA_DIR), store), 1)
+            (server.DATA_DIR / "legacy.txt").unlink()
+
+            self.api_post("/create_file", {"name": "fresh", "content": "Line one\r\nline TWO"})
+            status, body = self.api_get("/list_files")
+            self.assertEqual(status, 200)
+            self.assertEqual(body["files"], [
+                {"name": "fresh.txt", "content": "Line one\nline TWO", "modified": body["files"][0]["modified"]},
+                {"name": "legacy.txt", "content": "migrated body", "modified": 10**9},
+            ])
+
+            for query, expected in (("two", ["fresh.txt"]), ("e", ["fresh.txt", "legacy.txt"]), ("gacy.t", ["legacy.txt"])):
+                status, body = self.api_get(f"/search_files?q={query}")
+                self.assertEqual([item["name"] for item in body["files"]], expected, query)
+
+            status, body = self.api_post("/create_file", {"name": "fresh", "content": "again"})
+            self.assertEqual(status, 400)
+            self.api_post("/update_file", {"name": "fresh.txt", "content": "rewritten"})
+            self.assertEqual(self.api_get("/search_files?q=two")[1]["files"], [])
+            status, body = self.api_post("/delete_file", {"name": "legacy"})
+            self.assertEqual(status, 200)
+            self.assertEqual([item["name"] for item in self.api_get("/list_files")[1]["files"]], ["fresh.txt"])
+            self.assertEqual(self.api_get("/stats")[1]["storage"]["backend"], "sqlite")
+            self.assertEqual(list(server.DATA_DIR.glob("*.txt")), [])
+        finally:
+            server.STORAGE = server.DEFAULT_STORAGE
+
+    def test_file_store_group_commits_atomic_writes(self) -> None:
+        store = server.FileStore(server.DATA_DIR, "batch")
+        barrier = threading.Barrier(8)
+
+        def save(i: int) -> None:
+            barrier.wait()
+            store.write(f"g{i}.txt", f"group {i}")
+
+        threads = [threading.Thread(target=save, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        store.delete("g0.txt")
+
+        self.assertEqual(sorted(p.name for p in server.DATA_DIR.iterdir()), [f"g{i}.txt" for i in range(1, 8)])
+        self.assertEqual(store.read("g7.txt"), "group 7")
+        stats = store.stats()
+        self.assertEqual(stats["committed_writes"], 9)
+        self.assertLess(stats["commits"], 9)
+        self.assertGreater(stats["max_batch"], 1)
+
+        self.api_post("/create_file", {"name": "durable", "content": "saved"})
+        status, body = self.api_get("/stats")
+        self.assertEqual(body["storage"]["durability"], "batch")
+        self.assertEqual(body["storage"]["committed_writes"], 1)
+
+    def test_file_store_sweeps_stale_temp_files(self) -> None:
+        stale = server.DATA_DIR / ".crashed.txt.0badc0de.tmp"
+        fresh = server.DATA_DIR / ".inflight.txt.1234abcd.tmp"
+        other = server.DATA_DIR / ".not-ours.tmp"
+        for path in (stale, fresh, other):
+            path.write_bytes(b"partial")
+        old = time.time() - 2 * server.TEMP_SWEEP_AGE_SECONDS
+        os.utime(stale, (old, old))
+        os.utime(other, (old, old))
+        store = server.FileStore(server.DATA_DIR)
+        self.assertEqual(store.swept_temp_files, 1)
+        self.assertFalse(stale.exists())
+        self.assertTrue(fresh.exists())
+        self.assertTrue(other.exists())
+
+        sharded = server.ShardedFileStore(server.DATA_DIR)
+        shard_tmp = sharded.shard_path("note.txt").parent / ".note.txt.deadbeef.tmp"
+        shard_tmp.parent.mkdir(parents=True, exist_ok=True)
+        shard_tmp.write_bytes(b"partial")
+        os.utime(shard_tmp, (old, old))
+        sharded.write("note.txt", "whole")
+        self.assertFalse(shard_tmp.exists())
+        self.assertEqual(sharded.read("note.txt"), "whole")
+
+    def test_write_back_coalesces_autosaves(self) -> None:
+        self.api_post("/create_file", {"name": "draft", "content": "v0"})
+        server.WRITE_BACK = True
+        try:
+            store = server.current_store()
+            for i in range(1, 30):
+                self.api_post("/update_file", {"name": "draft.txt", "content": f"v{i}"})
+            self.api_post("/create_file", {"name": "scratch", "content": "never flushed"})
+            self.api_post("/delete_file", {"name": "scratch"})
+
+            self.assertEqual((server.DATA_DIR / "draft.txt").read_text(encoding="utf-8"), "v0")
+            server.CATALOG.refresh(force=True)
+            self.assertEqual(self.api_get("/get_file?name=draft")[1]["content"], "v29")
+            self.assertEqual(self.api_get("/search_files?q=v29")[1]["files"][0]["name"], "draft.txt")
+
+            self.assertEqual(store.flush(), 1)
+            self.assertEqual((server.DATA_DIR / "draft.txt").read_text(encoding="utf-8"), "v29")
+            self.assertFalse((server.DATA_DIR / "scratch.txt").exists())
+            stats = self.api_get("/stats")[1]["storage"]
+            self.assertEqual(stats["write_back"]["buffered_writes"], 30)
+            self.assertEqual(stats["write_back"]["flushed_writes"], 1)
+            self.assertEqual(stats["committed_writes"], 1)
+            server.CATALOG.refresh(force=True)
+            self.assertEqual(self.api_get("/get_file?name=draft")[1]["content"], "v29")
+        finally:
+            server.WRITE_BACK = False
+
+    def test_sharded_layout_migrates_online_and_keeps_a_manifest(self) -> None:
+        for i in range(3):
+            self.api_post("/create_file", {"name": f"flat{i}", "content": f"flat {i}"})
+        server.LAYOUT = "sharded"
+        try:
+            store = server.current_store()
+            self.assertEqual(store.flat, {"flat0.txt", "flat1.txt", "flat2.txt"})
+            self.api_post("/update_file", {"name": "flat0.txt", "content": "moved by a save"})
+            self.api_post("/create_file", {"name": "fresh", "content": "born sharded"})
+            for name in ("flat2.txt", "uploaded.txt"):
+                conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+                conn.request("PUT", f"/raw/{name}", body=b"put sharded")
+                self.assertIn(conn.getresponse().status, (200, 201))
+                conn.close()
+            self.assertEqual(store.shard_path("flat2.txt").read_bytes(), b"put sharded")
+            self.assertEqual(len(self.api_get("/list_files")[1]["files"]), 5)
+
+            self.assertEqual(server.migrate_layout(store), 1)
+            self.assertEqual(list(server.DATA_DIR.glob("*.txt")), [])
+            path = store.shard_path("fresh.txt")
+            self.assertEqual(path.relative_to(server.DATA_DIR).parts[2], "fresh.txt")
+            self.assertEqual(path.read_text(encoding="utf-8"), "born sharded")
+            self.assertEqual(self.api_get("/get_file?name=flat0")[1]["content"], "moved by a save")
+            self.api_post("/batch", {"ops": [{"op": "rename", "name": "flat1", "new_name": "renamed"}]})
+            self.api_post("/delete_file", {"name": "flat2"})
+
+            # A file the manifest does not list stays invisible: no walk at startup.
+            store.shard_path("stray.txt").parent.mkdir(parents=True, exist_ok=True)
+            store.shard_path("stray.txt").write_text("not listed", encoding="utf-8")
+            reopened = server.ShardedFileStore(server.DATA_DIR)
+            names = sorted(name for name, _, _ in reopened.scan())
+            self.assertEqual(names, ["flat0.txt", "fresh.txt", "renamed.txt", "uploaded.txt"])
+            self.assertEqual(reopened.read("renamed.txt"), "flat 1")
+
+            # An edit inside a shard directory is seen by the next scan and
+            # written back to the manifest.
+            store.shard_path("fresh.txt").write_text("edited behind the server", encoding="utf-8")
+            os.utime(store.shard_path("fresh.txt"), ns=(10**18, 10**18))
+            self.assertIn(("fresh.txt", 24, 10**18), list(store.scan()))
+            self.assertEqual(server.ShardedFileStore(server.DATA_DIR)._manifest["fresh.txt"], (24, 10**18))
+
+            # The manifest is compacted as it grows, not only at startup.
+            slack = server.MANIFEST_SLACK_LINES
+            server.MANIFEST_SLACK_LINES = 5
+            try:
+                for i in range(20):
+                    store.write("fresh.txt", f"rewrite {i}")
+                self.assertLessEqual(store._lines, 2 * len(store._manifest) + 5)
+                self.assertLessEqual(len(server.DATA_DIR.joinpath(server.MANIFEST_NAME).read_bytes().splitlines()), 13)
+                self.assertEqual(reopened.read("fresh.txt"), "rewrite 19")
+                reopened._catch_up()
+                self.assertEqual(reopened._manifest, store._manifest)
+            finally:
+                server.MANIFEST_SLACK_LINES = slack
+
+            server.DATA_DIR.joinpath(server.MANIFEST_NAME).unlink()
+            rebuilt = server.ShardedFileStore(server.DATA_DIR)
+            self.assertEqual(sorted(name for name, _, _ in rebuilt.scan()), sorted(names + ["stray.txt"]))
+        finally:
+            server.LAYOUT = server.DEFAULT_LAYOUT
+
+    def test_sharded_manifest_line_is_fsynced_with_the_note(self) -> None:
+        for durability in ("always", "batch"):
+            store = server.ShardedFileStore(server.DATA_DIR, durability)
+            calls = []
+            real_write, real_fsync = os.write, os.fsync
+
+            def write(fd, data):
+                if fd == store._manifest_fd:
+                    calls.append("write")
+                return real_write(fd, data)
+
+            def fsync(fd):
+                if fd == store._manifest_fd:
+                    calls.append("fsync")
+                return real_fsync(fd)
+
+            os.write, os.fsync = write, fsync
+            try:
+                store.write(f"{durability}.txt", "acknowledged")
+            finally:
+                os.write, os.fsync = real_write, real_fsync
+            self.assertEqual(calls, ["write", "fsync"])
+
+    def test_log_store_replays_and_compacts(self) -> None:
+        root = server.DATA_DIR / server.LOGSTORE_NAME
+        segment_max = server.LOGSTORE_SEGMENT_MAX_BYTES
+        server.LOGSTORE_SEGMENT_MAX_BYTES = 200
+        try:
+            store = server.LogStore(root)
+            store.write("keep.txt", "kept\r\nbody")
+            store.write("gone.txt", "short lived")
+            for i in range(10):
+                store.write("busy.txt", f"revision {i}")
+            store.delete("gone.txt")
+            store.close()
+            with open(sorted(root.glob("segment-*.log"))[-1], "ab") as f:
+                f.write(b"\x01\x02torn")
+
+            store = server.LogStore(root)
+            self.assertEqual(store.truncated_bytes, 6)
+            self.assertEqual(sorted(name for name, _, _ in store.scan()), ["busy.txt", "keep.txt"])
+            self.assertEqual(store.read("busy.txt"), "revision 9")
+            self.assertEqual(store.read("keep.txt"), "kept\nbody")
+            self.assertIsNone(store.stat("gone.txt"))
+            before = len(list(root.glob("segment-*.log")))
+            self.assertGreater(store.garbage_ratio(), 0.5)
+            # Compaction copies records without holding the store lock.
+            locked = []
+            real_pread = os.pread
+
+            def pread(fd, length, offset):
+                free = store._lock.acquire(blocking=False)
+                if free:
+                    store._lock.release()
+                locked.append(not free)
+                return real_pread(fd, length, offset)
+
+            os.pread = pread
+            try:
+                self.assertGreater(store.compact(), 0)
+            finally:
+                os.pread = real_pread
+            self.assertTrue(locked)
+            self.assertFalse(any(locked))
+            self.assertEqual(store.read("busy.txt"), "revision 9")
+            self.assertLess(len(list(root.glob("segment-*.log"))), before)
+            store.close()
+
+            store = server.LogStore(root)
+            self.assertEqual(sorted(name for name, _, _ in store.scan()), ["busy.txt", "keep.txt"])
+            self.assertEqual(store.read("busy.txt"), "revision 9")
+            store.close()
+        finally:
+            server.LOGSTORE_SEGMENT_MAX_BYTES = segment_max
+
+        server.STORAGE = "log"
+        try:
+            self.api_post("/create_file", {"name": "logged", "content": "appended"})
+            self.api_post("/update_file", {"name": "logged.txt", "content": "appended twice"})
+            status, body = self.api_get("/search_files?q=twice")
+            self.assertEqual([item["name"] for item in body["files"]], ["logged.txt"])
+            self.assertEqual(list(server.DATA_DIR.glob("*.txt")), [])
+            server.current_store().close()
+        finally:
+            server.STORAGE = server.DEFAULT_STORAGE
+
+    def test_log_store_honours_durability(self) -> None:
+        root = server.DATA_DIR / server.LOGSTORE_NAME
+        store = server.LogStore(root, "none")
+        store.write("loose.txt", "left to the os")
+        self.assertEqual(store.stats()["commits"], 0)
+        store.close()
+
+        store = server.LogStore(root, "always")
+        store.write("one.txt", "fsynced")
+        store.delete("one.txt")
+        self.assertEqual(store.stats()["commits"], 2)
+        with store.batch():
+            for i in range(5):
+                store.write(f"batched{i}.txt", "together")
+        self.assertEqual(store.stats()["commits"], 3)
+        self.assertEqual(store.stats()["max_batch"], 5)
+        store.close()
+
+        store = server.LogStore(root, "batch")
+        threads = [threading.Thread(target=store.write, args=(f"grouped{i}.txt", "x")) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = store.stats()
+        self.assertEqual(stats["committed_writes"], 8)
+        self.assertLess(stats["commits"], 8)
+        store.close()
+
+    def test_note_store_requires_the_storage_methods(self) -> None:
+        class ReadOnlyStore(server.NoteStore):
+            def version(self) -> int:
+                return 0
+
+            def scan(self):
+                return []
+
+            def stat(self, name: str):
+                return None
+
+            def read(self, name: str) -> str:
+                raise FileNotFoundError(name)
+
+        with self.assertRaises(TypeError):
+            server.NoteStore()
+        with self.assertRaises(TypeError):
+            ReadOnlyStore()
+
+    def test_request_logs_are_appended_to_one_segment(self) -> None:
+        for _ in range(5):
+            self.api_get("/list_files")
+        server.LOGGER.flush()
+        segments = list(server.LOG_DIR.glob("*.log"))
+        self.assertEqual(len(segments), 1)
+        lines = segments[0].read_text(encoding="utf-8").splitlines()
+        self.assertEqual(sum('"GET /list_files HTTP' in line for line in lines), 5)
+
+    def test_log_retention_removes_expired_segments(self) -> None:
+        expired = server.LOG_DIR / "2000-01-01T00-00-00.log"
+        expired.write_text("old\n", encoding="utf-8")
+        writer = server.LogWriter()
+        writer.write("fresh")
+        writer.flush()
+        writer.close()
+        self.assertFalse(expired.exists())
+
+    def test_keep_alive_reuses_connection_after_errors(self) -> None:
+        server.PASSWORD = "pw"
+        try:
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            body = json.dumps({"name": "ka", "content": "x" * 1000})
+            conn.request("POST", "/create_file", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 401)
+            self.assertEqual(json.loads(resp.read()), {"error": "unauthorized"})
+            sock = conn.sock
+
+            conn.request("POST", "/nope", body=body, headers={"X-Password": "pw"})
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 404)
+            resp.read()
+            conn.request("GET", "/list_files", headers={"X-Password": "pw"})
+            resp = conn.getresponse()
+            self.assertEqual(json.loads(resp.read()), {"files": []})
+            self.assertIs(conn.sock, sock)
+            conn.close()
+        finally:
+            server.PASSWORD = ""
+
+    def test_keep_alive_request_cap_closes_connection(self) -> None:
+        original = server.KEEPALIVE_MAX_REQUESTS
+        server.KEEPALIVE_MAX_REQUESTS = 2
+        try:
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            headers = []
+            for _ in range(2):
+                conn.request("GET", "/list_files")
+                resp = conn.getresponse()
+                resp.read()
+                headers.append(resp.getheader("Connection"))
+            conn.close()
+            self.assertEqual(headers, [None, "close"])
+        finally:
+            server.KEEPALIVE_MAX_REQUESTS = original
+
+    def test_pool_engine_sheds_load_when_queue_is_full(self) -> None:
+        httpd = server.make_server(("127.0.0.1", 0), engine="pool", workers=1, backlog=1)
+        port = httpd.server_address[1]
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            # A client that connects and sends nothing holds the only worker.
+            busy = socket.create_connection(("127.0.0.1", port), timeout=5)
+            deadline = time.monotonic() + 5
+            while httpd.stats()["busy_workers"] < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            queued = HTTPConnection("127.0.0.1", port, timeout=5)
+            queued.request("GET", "/list_files")
+            deadline = time.monotonic() + 5
+            while httpd.stats()["queue_depth"] < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            shed = HTTPConnection("127.0.0.1", port, timeout=5)
+            shed.request("GET", "/list_files")
+            resp = shed.getresponse()
+            self.assertEqual(resp.status, 503)
+            self.assertEqual(resp.getheader("Retry-After"), "1")
+            shed.close()
+
+            busy.close()
+            resp = queued.getresponse()
+            self.assertEqual(resp.status, 200)
+            resp.read()
+            queued.request("GET", "/stats")
+            stats = json.loads(queued.getresponse().read())["server"]
+            queued.close()
+            self.assertEqual((stats["engine"], stats["workers"], stats["busy_workers"]), ("pool", 1, 1))
+            self.assertEqual(stats["shed_connections"], 1)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_pool_engine_parks_idle_connections_and_event_streams(self) -> None:
+        httpd = server.make_server(("127.0.0.1", 0), engine="pool", workers=1, backlog=4)
+        port = httpd.server_address[1]
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            events = socket.create_connection(("127.0.0.1", port), timeout=5)
+            events.sendall(b"GET /events HTTP/1.1\r\nHost: x\r\n\r\n")
+            self.assertIn(b"text/event-stream", events.recv(4096))
+            # Neither the stream nor idle keep-alive connections hold the
+            # only worker between requests.
+            conns = [HTTPConnection("127.0.0.1", port, timeout=5) for _ in range(3)]
+            for _ in range(2):
+                for conn in conns:
+                    conn.request("GET", "/list_files")
+                    resp = conn.getresponse()
+                    resp.read()
+                    self.assertEqual(resp.status, 200)
+            conns[0].request("GET", "/stats")
+            stats = json.loads(conns[0].getresponse().read())["server"]
+            self.assertEqual((stats["busy_workers"], stats["event_subscribers"]), (1, 1))
+            self.assertEqual(stats["idle_connections"], 2)
+            conns[1].request("POST", "/create_file", body=json.dumps({"name": "pushed", "content": "x"}),
+                             headers={"Content-Type": "application/json"})
+            resp = conns[1].getresponse()
+            resp.read()
+            self.assertEqual(resp.status, 201)
+            received = b""
+            while b"pushed.txt" not in received:
+                received += events.recv(4096)
+            for conn in conns:
+                conn.close()
+            events.close()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_pool_engine_drops_event_subscribers_that_fall_behind(self) -> None:
+        httpd = server.make_server(("127.0.0.1", 0), engine="pool", workers=2, backlog=4)
+        port = httpd.server_address[1]
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        pending = server.SSE_MAX_PENDING_BYTES
+        server.SSE_MAX_PENDING_BYTES = 16 * 1024
+        try:
+            fast = socket.create_connection(("127.0.0.1", port), timeout=5)
+            slow = socket.socket()
+            slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            slow.settimeout(5)
+            slow.connect(("127.0.0.1", port))
+            for sock in (fast, slow):
+                sock.sendall(b"GET /events HTTP/1.1\r\nHost: x\r\n\r\n")
+                self.assertIn(b"text/event-stream", sock.recv(4096))
+                while len(httpd._subscribers) < (1 if sock is fast else 2):
+                    time.sleep(0.01)
+            slow_port = slow.getsockname()[1]
+            for subscriber in httpd._subscribers:
+                if subscriber.handler.client_address[1] == slow_port:
+                    subscriber.handler.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+            # The slow stream is never read; it must not hold up the fast one.
+            received = bytearray()
+
+            def read_fast() -> None:
+                while b"note99.txt" not in received:
+                    chunk = fast.recv(65536)
+                    if not chunk:
+                        return
+                    received.extend(chunk)
+
+            reader = threading.Thread(target=read_fast)
+            reader.start()
+            start = time.monotonic()
+            ops = [{"op": "create", "name": f"note{i}", "content": "x" * 200} for i in range(100)]
+            conn = HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("POST", "/batch", body=json.dumps({"ops": ops}), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            self.assertEqual(resp.status, 200)
+            reader.join()
+            self.assertIn(b"note99.txt", received)
+            self.assertLess(time.monotonic() - start, server.SSE_SEND_TIMEOUT_SECONDS)
+            self.assertEqual(httpd.stats()["event_subscribers"], 1)
+            # The dropped stream ends after what was already sent.
+            while slow.recv(65536):
+                pass
+            fast.close()
+            slow.close()
+        finally:
+            server.SSE_MAX_PENDING_BYTES = pending
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_change_journal_skips_torn_and_corrupt_lines(self) -> None:
+        server.ChangeJournal.reset(server.DATA_DIR, 100)
+        writer = server.ChangeJournal(server.DATA_DIR)
+        reader = server.ChangeJournal(server.DATA_DIR)
+        writer.append("create", "a.txt", None)
+        with open(server.DATA_DIR / server.JOURNAL_NAME, "ab") as f:
+            f.write(b"not json\n[102, \"create\", \"torn")
+        self.assertEqual(reader.poll(), [(101, "create", "a.txt", None)])
+        self.assertEqual(reader.poll(), [])
+
+        # The next append ends the torn line instead of running into it.
+        seq, _ = writer.append("create", "b.txt", None)
+        self.assertEqual(seq, 102)
+        self.assertEqual(reader.poll(), [(102, "create", "b.txt", None)])
+        self.assertEqual(server.ChangeJournal(server.DATA_DIR).last_seq, 102)
+
+    def test_change_journal_keeps_catalogs_in_step(self) -> None:
+        original = server.JOURNAL_MAX_BYTES
+        server.JOURNAL_MAX_BYTES = 300
+        try:
+            server.ChangeJournal.reset(server.DATA_DIR, 100)
+            first, second = server.NoteCatalog(), server.NoteCatalog()
+            first.attach_journal(server.ChangeJournal(server.DATA_DIR))
+            second.attach_journal(server.ChangeJournal(server.DATA_DIR))
+            target = server.DATA_DIR / "shared.txt"
+            for i in range(10):
+                target.write_text(f"v{i}", encoding="utf-8")
+                first.record_write("shared.txt", f"v{i}")
+                self.assertEqual(second.get("shared.txt").content, f"v{i}")
+            target.unlink()
+            first.record_delete("shared.txt")
+            self.assertIsNone(second.get("shared.txt"))
+            self.assertEqual(first.current_seq(), second.current_seq())
+            self.assertLess(server.DATA_DIR.joinpath(server.JOURNAL_NAME).stat().st_size, 400)
+        finally:
+            server.JOURNAL_MAX_BYTES = original
+
+        # Only the rescanning catalog records an outside change; followers
+        # learn of it from the journal, so it is recorded once.
+        server.ChangeJournal.reset(server.DATA_DIR, 100)
+        leader = server.NoteCatalog()
+        leader.attach_journal(server.ChangeJournal(server.DATA_DIR))
+        followers = [server.NoteCatalog() for _ in range(3)]
+        for follower in followers:
+            follower.attach_journal(server.ChangeJournal(server.DATA_DIR), follow=True)
+        (server.DATA_DIR / "outside.txt").write_text("dropped in", encoding="utf-8")
+        for follower in followers:
+            follower.refresh()
+            self.assertIsNone(follower.get("outside.txt"))
+        leader.refresh(force=True)
+        for follower in followers:
+            self.assertEqual(follower.get("outside.txt").content, "dropped in")
+        journal = server.DATA_DIR.joinpath(server.JOURNAL_NAME).read_text(encoding="utf-8")
+        self.assertEqual(journal.count("outside.txt"), 1)
+
+    def test_snapshot_warm_start_rereads_only_changed_notes(self) -> None:
+        self.api_post("/create_file", {"name": "kept", "content": "Restart the queue worker"})
+        self.api_post("/create_file", {"name": "edited", "content": "old text"})
+        self.api_post("/create_file", {"name": "gone", "content": "bye"})
+        snapshot = server.DATA_DIR / server.SNAPSHOT_NAME
+        self.assertEqual(server.CATALOG.save_snapshot(snapshot), 3)
+        (server.DATA_DIR / "edited.txt").write_text("new text, longer", encoding="utf-8")
+        (server.DATA_DIR / "gone.txt").unlink()
+        (server.DATA_DIR / "added.txt").write_text("fresh queue", encoding="utf-8")
+
+        # Only metadata and index state: the texts stay in the store.
+        self.assertNotIn(b"Restart the queue worker", snapshot.read_bytes())
+
+        self.assertEqual(server.NoteCatalog().load_snapshot(snapshot), 3)
+        catalog = server.NoteCatalog()
+        store = server.current_store()
+        reads = []
+        store.read = lambda name, read=store.read: reads.append(name) or read(name)
+        try:
+            catalog.warm_up(snapshot)
+        finally:
+            del store.read
+        self.assertEqual(sorted(reads), ["added.txt", "edited.txt"])
+        self.assertEqual(sorted(e.name for e in catalog.entries()), ["added.txt", "edited.txt", "kept.txt"])
+        self.assertEqual(catalog.get("kept.txt").content, "Restart the queue worker")
+        self.assertEqual(catalog.get("edited.txt").content, "new text, longer")
+        self.assertEqual(sorted(e.name for e in catalog.search("queue")), ["added.txt", "kept.txt"])
+        self.assertEqual(catalog.rank("worker", 10, 0)[1][0][0].name, "kept.txt")
+        # A restored note's trigrams are known, so removing it touches only them.
+        catalog._index.remove("kept.txt")
+        self.assertEqual(catalog._index.candidates("restart"), set())
+
+        snapshot.write_bytes(snapshot.read_bytes()[:-3])
+        self.assertEqual(server.NoteCatalog().load_snapshot(snapshot), 0)
+        snapshot.write_bytes(b"garbage")
+        self.assertEqual(server.NoteCatalog().load_snapshot(snapshot), 0)
+
+    def test_content_cache_evicts_and_compresses_within_budget(self) -> None:
+        size = sys.getsizeof("x" * 300)
+        cache = server.ContentCache(3 * size + 10)
+        for i in range(5):
+            cache.put(("n", i, 300), "x" * 300)
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["bytes"], stats["evictions"]), (3, 3 * size, 2))
+        self.assertEqual(cache.get(("n", 0, 300), lambda: "reloaded"), "reloaded")
+        self.assertEqual(cache.get(("n", 4, 300), lambda: "unused"), "x" * 300)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Wider characters take more memory and count for it.
+        cache = server.ContentCache(10_000)
+        cache.put(("wide", 0, 300), "€" * 300)
+        self.assertGreaterEqual(cache.stats()["bytes"], 600)
+
+        cache = server.ContentCache(1000, compress=True)
+        for i in range(10):
+            cache.put(("n", i, 300), "y" * 300)
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 10)
+        self.assertLessEqual(stats["bytes"], 1000)
+        self.assertGreater(stats["compressed_entries"], 0)
+        self.assertEqual(cache.get(("n", 0, 300), lambda: "unused"), "y" * 300)
+        self.assertEqual(cache.compressed_hits, 1)
+
+        original = server.CONTENT_CACHE
+        server.CONTENT_CACHE = server.ContentCache(0)
+        try:
+            self.api_post("/create_file", {"name": "uncached", "content": "from disk"})
+            status, body = self.api_get("/get_file?name=uncached.txt")
+            self.assertEqual(body["content"], "from disk")
+            self.assertEqual(server.CONTENT_CACHE.stats()["entries"], 0)
+            self.assertGreater(server.CONTENT_CACHE.misses, 0)
+        finally:
+            server.CONTENT_CACHE = original
+
+        # A failed read is not cached, and a linear search does not fill the cache.
+        entry = server.CATALOG.get("uncached.txt")
+        server.CONTENT_CACHE.discard(entry.key)
+        path = server.DATA_DIR / "uncached.txt"
+        entry._version = None
+        entry.fragments.clear()
+        path.rename(path.with_suffix(".bak"))
+        self.assertEqual(entry.content, "")
+        entry.version
+        self.assertIsNone(entry._version)
+        self.assertEqual(json.loads(entry.fragment("preview"))["preview"], "")
+        self.assertNotIn("preview", entry.fragments)
+        path.with_suffix(".bak").rename(path)
+        self.assertEqual(entry.content, "from disk")
+        self.assertEqual(entry.version, hashlib.blake2b(b"from disk", digest_size=8).hexdigest())
+        self.assertIn("from disk", json.loads(entry.fragment("preview"))["preview"])
+        server.CONTENT_CACHE.discard(entry.key)
+        self.assertEqual([e.name for e in server.CATALOG.search("fr")], ["uncached.txt"])
+        self.assertIsNone(server.CONTENT_CACHE.peek(entry.key))
+
+    def test_ready_reports_warm_up(self) -> None:
+        server.CATALOG.ready.clear()
+        try:
+            status, body = self.api_get("/ready")
+            self.assertEqual((status, body), (503, {"ready": False}))
+        finally:
+            server.CATALOG.ready.set()
+        status, body = self.api_get("/ready")
+        self.assertEqual((status, body), (200, {"ready": True}))
+
     def test_reject_duplicate_create(self) -> None:
         self.api_post("/create_file", {"name": "dupe", "content": "a"})
         status, body = self.api_post("/create_file", {"name": "dupe", "content": "b"})
@@ -101,5 +1184,145 @@ class NotesServerTests(unittest.TestCase):
         self.assertIn("error", body)
 
 
+class AsyncioNotesServerTests(NotesServerTests):
+    engine = "asyncio"
+
+    def test_handler_crash_is_reported_and_answered_500(self) -> None:
+        def crash(handler) -> None:
+            raise RuntimeError("boom")
+
+        report = io.StringIO()
+        list_files, server.Handler.list_files = server.Handler.list_files, crash
+        try:
+            with contextlib.redirect_stderr(report):
+                status, body = self.api_get("/list_files")
+        finally:
+            server.Handler.list_files = list_files
+        self.assertEqual((status, body), (500, {"error": "internal server error"}))
+        self.assertIn("RuntimeError: boom", report.getvalue())
+
+    def test_stalled_request_body_times_out(self) -> None:
+        timeout, server.Handler.timeout = server.Handler.timeout, 0.3
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=5) as sock:
+                sock.sendall(b"POST /create_file HTTP/1.1\r\nHost: x\r\nContent-Length: 100\r\n\r\n{")
+                start = time.monotonic()
+                self.assertEqual(sock.recv(1024), b"")
+                self.assertLess(time.monotonic() - start, 3)
+        finally:
+            server.Handler.timeout = timeout
+
+
+def random_corpus(count: int, seed: int = 7) -> dict[str, str]:
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(5000)]
+    return {f"note{i}.txt": " ".join(rng.choices(words, k=200)) for i in range(count)}
+
+
+@unittest.skipUnless(os.environ.get("MINIKEEP_BENCH"), "set MINIKEEP_BENCH=1 to run benchmarks")
+class SearchBenchmark(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.original_dirs = (server.DATA_DIR, server.LOG_DIR)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        server.DATA_DIR, server.LOG_DIR = cls.original_dirs
+
+    def test_indexed_vs_linear_search(self) -> None:
+        print("\nnotes    linear ms   indexed ms")
+        for count in (1000, 4000, 16000):
+            with tempfile.TemporaryDirectory() as tmp:
+                server.DATA_DIR = Path(tmp)
+                for name, content in random_corpus(count).items():
+                    (server.DATA_DIR / name).write_text(content, encoding="utf-8")
+                catalog = server.NoteCatalog()
+                catalog.refresh(force=True)
+                entries = catalog.entries()
+                queries = [entry.content[40:47] for entry in entries[:50]]
+
+                start = time.perf_counter()
+                for q in queries:
+                    [e for e in entries if q in e.name.lower() or q in e.content.lower()]
+                linear = (time.perf_counter() - start) / len(queries) * 1000
+
+                start = time.perf_counter()
+                for q in queries:
+                    catalog.search(q)
+                indexed = (time.perf_counter() - start) / len(queries) * 1000
+                print(f"{count:>5} {linear:>12.2f} {indexed:>12.2f}")
+
+
+@unittest.skipUnless(os.environ.get("MINIKEEP_BENCH"), "set MINIKEEP_BENCH=1 to run benchmarks")
+class StorageBenchmark(unittest.TestCase):
+    def test_write_throughput_per_store(self) -> None:
+        corpus = random_corpus(500)
+        names = list(corpus)
+        writes = 5000
+        print("\nstore      writes/s   reads/s")
+        for label, make in (
+            ("files", lambda root: server.FileStore(root, "none")),
+            ("log", lambda root: server.LogStore(root / server.LOGSTORE_NAME)),
+            ("sqlite", lambda root: server.SqliteStore(root / server.SQLITE_NAME)),
+        ):
+            with tempfile.TemporaryDirectory() as tmp:
+                store = make(Path(tmp))
+                start = time.perf_counter()
+                for i in range(writes):
+                    name = names[i % len(names)]
+                    store.write(name, corpus[name])
+                write_rate = writes / (time.perf_counter() - start)
+                start = time.perf_counter()
+                for i in range(writes):
+                    store.read(names[i % len(names)])
+                read_rate = writes / (time.perf_counter() - start)
+                if hasattr(store, "close"):
+                    store.close()
+                print(f"{label:<8} {write_rate:>10.0f} {read_rate:>9.0f}")
+
+
+@unittest.skipUnless(os.environ.get("MINIKEEP_BENCH"), "set MINIKEEP_BENCH=1 to run benchmarks")
+class KeepAliveBenchmark(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.original_dirs = (server.DATA_DIR, server.LOG_DIR)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        server.DATA_DIR, server.LOG_DIR = cls.original_dirs
+
+    def test_keep_alive_vs_connection_per_request(self) -> None:
+        with tempfile.TemporaryDirectory() as data, tempfile.TemporaryDirectory() as logs:
+            server.DATA_DIR = Path(data)
+            server.LOG_DIR = Path(logs)
+            (server.DATA_DIR / "note.txt").write_text("hello", encoding="utf-8")
+            httpd = ThreadingHTTPServer(("127.0.0.1", 0), server.Handler)
+            port = httpd.server_address[1]
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            requests = 2000
+            try:
+                start = time.perf_counter()
+                for _ in range(requests):
+                    conn = HTTPConnection("127.0.0.1", port, timeout=5)
+                    conn.request("GET", "/list_files", headers={"Connection": "close"})
+                    conn.getresponse().read()
+                    conn.close()
+                per_request = requests / (time.perf_counter() - start)
+
+                conn = HTTPConnection("127.0.0.1", port, timeout=5)
+                start = time.perf_counter()
+                for _ in range(requests):
+                    conn.request("GET", "/list_files")
+                    conn.getresponse().read()
+                keep_alive = requests / (time.perf_counter() - start)
+                conn.close()
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+                server.LOGGER.flush()
+            print(f"\nconnection per request: {per_request:8.0f} req/s")
+            print(f"keep-alive:             {keep_alive:8.0f} req/s")
+
+
 if __name__ == "__main__":
     unittest.main()